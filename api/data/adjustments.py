@@ -0,0 +1,232 @@
+import asyncio
+from fastapi import HTTPException, status
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument, UpdateOne
+
+from .counters import update_part_counters
+from .models import MAX_BATCH_SIZE, MAX_INT32
+
+# Stock adjustments change a part's quantity with an atomic $inc, guarded by a filter
+# which only matches parts with enough stock, so concurrent adjustments can't lose updates
+# or take the quantity below zero. Optionally, adjustments are coalesced: the ones arriving
+# within a short window are applied together, with one update per part.
+ADJUSTMENT_PROJECTION = {"_id": 0, "serial_number": 1, "category": 1, "quantity": 1, "price": 1}
+
+
+def get_required_quantity(deltas: list) -> int:
+    """
+    The lowest quantity from which the deltas, applied in order, never go below zero.
+    """
+    total = 0
+    lowest = 0
+    for delta in deltas:
+        total += delta
+        lowest = min(lowest, total)
+    return -lowest
+
+
+def fits_one_update(deltas: list) -> bool:
+    # Coalesced deltas are applied with one $inc only while their sum is in the range of a single delta
+    return -MAX_INT32 - 1 <= sum(deltas) <= MAX_INT32
+
+
+def adjustment_response(part_document: dict) -> dict:
+    return {"serial_number": part_document["serial_number"], "quantity": part_document["quantity"]}
+
+
+def get_adjusted(part_document: dict, delta: int) -> dict:
+    return dict(part_document, quantity=part_document["quantity"] + delta)
+
+
+def get_counter_changes(previous_documents: list, deltas: list) -> dict:
+    # Removing the parts as they were and adding them as they are now
+    # only changes the quantity and value counters of their categories
+    return {
+        "added": [get_adjusted(document, delta) for document, delta in zip(previous_documents, deltas)],
+        "removed": previous_documents,
+    }
+
+
+async def adjust_quantity(db: AsyncIOMotorDatabase, serial_number: str, delta: int) -> dict:
+    """
+    Adds delta to the quantity of a part in one atomic update and adjusts the category counters.
+    Raises 404 if the part doesn't exist and 409 if it doesn't have enough stock.
+    """
+    search_dict = {"serial_number": serial_number}
+    # The previous version tells the new quantity as well
+    part_document = await db.parts.find_one_and_update(
+        {**search_dict, "quantity": {"$gte": get_required_quantity([delta])}},
+        {"$inc": {"quantity": delta}},
+        projection=ADJUSTMENT_PROJECTION,
+        return_document=ReturnDocument.BEFORE,
+    )
+    if part_document is None:
+        if await db.parts.find_one(search_dict, {"_id": 1}) is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, f"part {search_dict} does not exist")
+        raise HTTPException(
+            status.HTTP_409_CONFLICT,
+            f"part {search_dict} doesn't have enough stock for an adjustment of {delta}"
+        )
+    await update_part_counters(db, **get_counter_changes([part_document], [delta]))
+    return adjustment_response(get_adjusted(part_document, delta))
+
+
+async def apply_adjustments(db: AsyncIOMotorDatabase, adjustments: list) -> list:
+    """
+    Applies many (serial_number, delta) adjustments at once, with one update per part.
+    Returns a response or an HTTPException for every adjustment, in the same order.
+
+    Parts whose adjustments can't go below zero (e.g. restocking) are updated with one bulk write.
+    The others get one guarded update each; when a part runs out of stock within the batch,
+    its adjustments are retried one by one, so each of them is accepted or rejected on its own.
+    So are the adjustments of parts whose summed delta would be larger than any single delta.
+    """
+    positions_by_serial = {}
+    for position, (serial_number, _) in enumerate(adjustments):
+        positions_by_serial.setdefault(serial_number, []).append(position)
+    deltas_by_serial = {
+        serial_number: [adjustments[position][1] for position in positions]
+        for serial_number, positions in positions_by_serial.items()
+    }
+    separate = [
+        serial_number for serial_number, deltas in deltas_by_serial.items()
+        if not fits_one_update(deltas)
+    ]
+    unguarded = [
+        serial_number for serial_number, deltas in deltas_by_serial.items()
+        if get_required_quantity(deltas) == 0 and serial_number not in separate
+    ]
+    guarded = [
+        serial_number for serial_number in deltas_by_serial
+        if serial_number not in unguarded and serial_number not in separate
+    ]
+
+    results = [None] * len(adjustments)
+    previous_documents = []
+    applied_deltas = []
+
+    def set_group_result(serial_number: str, result):
+        for position in positions_by_serial[serial_number]:
+            results[position] = result
+
+    def missing(serial_number: str) -> HTTPException:
+        search_dict = {"serial_number": serial_number}
+        return HTTPException(status.HTTP_404_NOT_FOUND, f"part {search_dict} does not exist")
+
+    if len(unguarded) > 0:
+        requests = [
+            UpdateOne(
+                {"serial_number": serial_number},
+                {"$inc": {"quantity": sum(deltas_by_serial[serial_number])}}
+            )
+            for serial_number in unguarded
+            if sum(deltas_by_serial[serial_number]) != 0
+        ]
+        if len(requests) > 0:
+            await db.parts.bulk_write(requests, ordered=False)
+        part_documents = {}
+        async for document in db.parts.find(
+            {"serial_number": {"$in": unguarded}}, ADJUSTMENT_PROJECTION
+        ):
+            part_documents[document["serial_number"]] = document
+        for serial_number in unguarded:
+            document = part_documents.get(serial_number)
+            if document is None:
+                set_group_result(serial_number, missing(serial_number))
+                continue
+            set_group_result(serial_number, adjustment_response(document))
+            delta = sum(deltas_by_serial[serial_number])
+            previous_documents.append(get_adjusted(document, -delta))
+            applied_deltas.append(delta)
+
+    async def apply_guarded(serial_number: str):
+        deltas = deltas_by_serial[serial_number]
+        document = await db.parts.find_one_and_update(
+            {"serial_number": serial_number, "quantity": {"$gte": get_required_quantity(deltas)}},
+            {"$inc": {"quantity": sum(deltas)}},
+            projection=ADJUSTMENT_PROJECTION,
+            return_document=ReturnDocument.BEFORE,
+        )
+        if document is not None:
+            set_group_result(serial_number, adjustment_response(get_adjusted(document, sum(deltas))))
+            previous_documents.append(document)
+            applied_deltas.append(sum(deltas))
+            return
+        await apply_separately(serial_number)
+
+    async def apply_separately(serial_number: str):
+        for position in positions_by_serial[serial_number]:
+            try:
+                results[position] = await adjust_quantity(db, serial_number, adjustments[position][1])
+            except HTTPException as error:
+                results[position] = error
+
+    await asyncio.gather(
+        *[apply_guarded(serial_number) for serial_number in guarded],
+        *[apply_separately(serial_number) for serial_number in separate],
+    )
+    await update_part_counters(db, **get_counter_changes(previous_documents, applied_deltas))
+    return results
+
+
+class AdjustmentCoalescer:
+    """
+    Buffers adjustments for window_seconds (or until MAX_BATCH_SIZE of them are waiting)
+    and applies them together with flush(db, adjustments), which returns a response
+    or an HTTPException for every (serial_number, delta) pair.
+
+    Only used from the event loop, like the inventory mirror.
+    An adjustment whose request was cancelled while waiting is still applied.
+    """
+
+    def __init__(self, window_seconds: float, flush):
+        self.window_seconds = window_seconds
+        self._flush = flush
+        self._pending = []  # (db, serial_number, delta, future)
+        self._timer = None
+        self._tasks = set()  # running flushes, referenced until they're done
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_seconds > 0
+
+    async def submit(self, db: AsyncIOMotorDatabase, serial_number: str, delta: int) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((db, serial_number, delta, future))
+        if len(self._pending) >= MAX_BATCH_SIZE:
+            self._start(self._flush_pending())
+        elif self._timer is None:
+            self._timer = self._start(self._flush_after_window())
+        return await future
+
+    def _start(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window_seconds)
+        self._timer = None
+        await self._flush_pending()
+
+    async def _flush_pending(self):
+        batch, self._pending = self._pending, []
+        batches_by_db = {}
+        for item in batch:
+            batches_by_db.setdefault(id(item[0]), []).append(item)
+
+        for items in batches_by_db.values():
+            try:
+                results = await self._flush(
+                    items[0][0], [(serial_number, delta) for _, serial_number, delta, _ in items]
+                )
+            except Exception as error:  # reported to every waiting request
+                results = [error] * len(items)
+            for (_, _, _, future), result in zip(items, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
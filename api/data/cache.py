@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_MAX_SIZE = 4096
+
+
+class CategoryCache:
+    """
+    In-process LRU cache of category documents, reachable both by ObjectID and by name.
+
+    Categories are few and rarely change while parts reference them constantly,
+    so resolving category IDs through this cache removes most of the category lookups.
+    Every category write of this process has to call clear(). Writes of other processes are noticed
+    through the categories version (see api/data/versions.py): check_version() clears the cache
+    when the version changed since the cache was filled.
+
+    Documents are copied on the way in and out because callers mutate them
+    when converting them to the API representation.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._by_id = OrderedDict()
+        self._id_by_name = {}
+        self._lock = Lock()
+        self.version = None
+        self._checked_at = None  # time.monotonic() of the last version check
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def get_by_id(self, category_id):
+        with self._lock:
+            document = self._by_id.get(category_id)
+            if document is None:
+                return None
+            self._by_id.move_to_end(category_id)
+            return document.copy()
+
+    def get_by_name(self, name: str):
+        with self._lock:
+            category_id = self._id_by_name.get(name)
+        if category_id is None:
+            return None
+        return self.get_by_id(category_id)
+
+    def put(self, document: dict):
+        with self._lock:
+            category_id = document["_id"]
+            old_document = self._by_id.pop(category_id, None)
+            if old_document is not None:
+                self._id_by_name.pop(old_document["name"], None)
+
+            self._by_id[category_id] = document.copy()
+            self._id_by_name[document["name"]] = category_id
+
+            while len(self._by_id) > self.max_size:
+                _, evicted = self._by_id.popitem(last=False)
+                self._id_by_name.pop(evicted["name"], None)
+
+    def clear(self):
+        with self._lock:
+            self._by_id.clear()
+            self._id_by_name.clear()
+
+    def needs_check(self, max_age: float) -> bool:
+        # Whether the version was last checked more than max_age seconds ago
+        return self._checked_at is None or time.monotonic() - self._checked_at >= max_age
+
+    def check_version(self, version, checked_at: float):
+        """
+        Clears the cache if the categories version differs from the one it was filled at.
+        checked_at is when the version was read, before any document cached with it.
+        """
+        with self._lock:
+            if version != self.version:
+                self._by_id.clear()
+                self._id_by_name.clear()
+                self.version = version
+            self._checked_at = checked_at
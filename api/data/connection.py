@@ -0,0 +1,141 @@
+import multiprocessing
+import os
+from threading import Lock
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+# The connection is configured with environment variables. Without MONGO_URI and MONGO_DB,
+# the connection string and database name are read from the first two lines of connect_info.txt.
+CONNECT_INFO_FILE = "connect_info.txt"
+
+# Client options set from environment variables, with the types they're parsed to
+CLIENT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": ("maxPoolSize", int),
+    "MONGO_MIN_POOL_SIZE": ("minPoolSize", int),
+    "MONGO_MAX_IDLE_TIME_MS": ("maxIdleTimeMS", int),
+    "MONGO_CONNECT_TIMEOUT_MS": ("connectTimeoutMS", int),
+    "MONGO_SOCKET_TIMEOUT_MS": ("socketTimeoutMS", int),
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": ("waitQueueTimeoutMS", int),
+    # e.g. "zstd,snappy"; needs the zstandard / python-snappy packages
+    "MONGO_COMPRESSORS": ("compressors", str),
+    "MONGO_READ_CONCERN": ("readConcernLevel", str),  # e.g. "majority"
+}
+
+
+class ConnectionSettingsError(RuntimeError):
+    pass
+
+
+def get_motor_threads() -> int:
+    """
+    Number of threads Motor runs pymongo operations in (see motor.frameworks.asyncio).
+    Each thread uses at most one connection at a time, so a bigger pool would never be used fully.
+    """
+    if "MOTOR_MAX_WORKERS" in os.environ:
+        return int(os.environ["MOTOR_MAX_WORKERS"])
+    return multiprocessing.cpu_count() * 5
+
+
+def get_connection_info() -> tuple:
+    connection_string = os.environ.get("MONGO_URI")
+    db_name = os.environ.get("MONGO_DB")
+    if connection_string is not None and db_name is not None:
+        return connection_string, db_name
+    try:
+        with open(CONNECT_INFO_FILE, "r", encoding="utf-8") as file:
+            file_connection_string = file.readline().strip()
+            file_db_name = file.readline().strip()
+    except FileNotFoundError as error:
+        raise ConnectionSettingsError(
+            f"set MONGO_URI and MONGO_DB or create {CONNECT_INFO_FILE}"
+        ) from error
+    return connection_string or file_connection_string, db_name or file_db_name
+
+
+def get_client_options() -> dict:
+    options = {"maxPoolSize": get_motor_threads()}
+    for variable, (option, parse) in CLIENT_OPTIONS.items():
+        if variable in os.environ:
+            try:
+                options[option] = parse(os.environ[variable])
+            except ValueError as error:
+                raise ConnectionSettingsError(
+                    f"invalid {variable}: {os.environ[variable]}"
+                ) from error
+    return options
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Tracks the connections of all pools of the client, for health checks.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.open = 0
+        self.checked_out = 0
+        self.checkout_failures = 0
+        self.pools_cleared = 0
+
+    def _add(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def connection_created(self, event):
+        self._add(open=1)
+
+    def connection_closed(self, event):
+        self._add(open=-1)
+
+    def connection_checked_out(self, event):
+        self._add(checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._add(checked_out=-1)
+
+    def connection_check_out_failed(self, event):
+        self._add(checkout_failures=1)
+
+    def pool_cleared(self, event):
+        self._add(pools_cleared=1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "open": self.open,
+                "checked_out": self.checked_out,
+                "checkout_failures": self.checkout_failures,
+                "pools_cleared": self.pools_cleared,
+            }
+
+
+pool_monitor = PoolMonitor()
+
+
+def create_client(connection_string: str, event_listeners=()) -> AsyncIOMotorClient:
+    """
+    Builds the client with the options from the environment.
+    No connection is made until the first operation.
+    """
+    return AsyncIOMotorClient(
+        connection_string,
+        event_listeners=[pool_monitor, *event_listeners],
+        **get_client_options(),
+    )
@@ -0,0 +1,107 @@
+import math
+from collections import defaultdict
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+from .tree import ANCESTORS_FIELD
+
+# Every category document keeps the number of parts assigned directly to it,
+# the sum of their quantities and their stock value (quantity * price).
+# The counters are adjusted with $inc on every part write, so checking whether a category
+# has parts or reporting its stock doesn't touch the parts collection.
+PART_COUNT_FIELD = "part_count"
+TOTAL_QUANTITY_FIELD = "total_quantity"
+TOTAL_VALUE_FIELD = "total_value"
+COUNTER_FIELDS = (PART_COUNT_FIELD, TOTAL_QUANTITY_FIELD, TOTAL_VALUE_FIELD)
+
+# Values are sums of floats, added up in a different order by $inc and by the recount
+VALUE_TOLERANCE = 1e-6
+
+
+def get_empty_counters() -> dict:
+    return {PART_COUNT_FIELD: 0, TOTAL_QUANTITY_FIELD: 0, TOTAL_VALUE_FIELD: 0.0}
+
+
+def get_part_value(part_document: dict) -> float:
+    return part_document["quantity"] * part_document["price"]
+
+
+async def update_part_counters(db: AsyncIOMotorDatabase, added=(), removed=()):
+    """
+    Adjusts the counters of the categories of added and removed part documents with one bulk write.
+    An update of a part is a removal of its previous version and an addition of the new one.
+    """
+    deltas = defaultdict(lambda: [0, 0, 0.0])
+    for sign, part_documents in ((1, added), (-1, removed)):
+        for part_document in part_documents:
+            category_deltas = deltas[part_document["category"]]
+            category_deltas[0] += sign
+            category_deltas[1] += sign * part_document["quantity"]
+            category_deltas[2] += sign * get_part_value(part_document)
+
+    requests = [
+        UpdateOne(
+            {"_id": category_id},
+            {"$inc": dict(zip(COUNTER_FIELDS, category_deltas))},
+        )
+        for category_id, category_deltas in deltas.items()
+        if any(delta != 0 for delta in category_deltas)
+    ]
+    if len(requests) > 0:
+        await db.categories.bulk_write(requests, ordered=False)
+
+
+async def reconcile_part_counters(db: AsyncIOMotorDatabase) -> list:
+    """
+    Recounts the parts of every category with one aggregation and repairs the counters which drifted,
+    e.g. after a write failed halfway or data was modified outside of the API.
+    Returns the names of the repaired categories.
+    """
+    totals = {}
+    pipeline = [{"$group": {
+        "_id": "$category",
+        "count": {"$sum": 1},
+        "quantity": {"$sum": "$quantity"},
+        "value": {"$sum": {"$multiply": ["$quantity", "$price"]}},
+    }}]
+    async for group in db.parts.aggregate(pipeline):
+        totals[group["_id"]] = (group["count"], group["quantity"], group["value"])
+
+    requests = []
+    repaired = []
+    projection = {"name": 1, **{field: 1 for field in COUNTER_FIELDS}}
+    async for document in db.categories.find({}, projection):
+        count, quantity, value = totals.get(document["_id"], (0, 0, 0.0))
+        stored_value = document.get(TOTAL_VALUE_FIELD)
+        if (
+            document.get(PART_COUNT_FIELD) != count
+            or document.get(TOTAL_QUANTITY_FIELD) != quantity
+            or stored_value is None
+            or not math.isclose(stored_value, value, abs_tol=VALUE_TOLERANCE)
+        ):
+            requests.append(UpdateOne(
+                {"_id": document["_id"]},
+                {"$set": dict(zip(COUNTER_FIELDS, (count, quantity, value)))},
+            ))
+            repaired.append(document["name"])
+    if len(requests) > 0:
+        await db.categories.bulk_write(requests, ordered=False)
+    return repaired
+
+
+async def get_subtree_counters(db: AsyncIOMotorDatabase, category_id) -> dict:
+    """
+    Sums the counters of a category and all categories below it.
+    """
+    pipeline = [
+        {"$match": {"$or": [{"_id": category_id}, {ANCESTORS_FIELD: category_id}]}},
+        {"$group": {
+            "_id": None,
+            PART_COUNT_FIELD: {"$sum": f"${PART_COUNT_FIELD}"},
+            TOTAL_QUANTITY_FIELD: {"$sum": f"${TOTAL_QUANTITY_FIELD}"},
+        }},
+    ]
+    results = await db.categories.aggregate(pipeline).to_list(None)
+    if len(results) == 0:
+        return get_empty_counters()
+    return {field: results[0][field] for field in (PART_COUNT_FIELD, TOTAL_QUANTITY_FIELD)}
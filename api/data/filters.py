@@ -0,0 +1,154 @@
+import math
+from fastapi import HTTPException, status
+from pymongo import ASCENDING, DESCENDING
+
+from .indexes import LOCATION_FIELDS
+
+# Structured filters of GET /parts. Each one takes an exact value or an inclusive range:
+# "3", "1..5", "1.." (at least 1) or "..5" (at most 5), compared with index-friendly predicates.
+# Prices and quantities have indexes of their own, location filters use the location index
+# (which covers filters on its leading fields, e.g. the room and the bookcase).
+RANGE_SEPARATOR = ".."
+FILTER_FIELDS = {
+    "price": ("price", float),
+    "quantity": ("quantity", int),
+    **{field: (f"location.{field}", str if field == "room" else int) for field in LOCATION_FIELDS},
+}
+
+# Fields parts can be sorted by (descending with a leading "-"), each backed by an index.
+# Ties are broken by the serial number, which makes the order stable for keyset pagination.
+SORT_FIELDS = ("serial_number", "price", "quantity")
+SCORE_FIELD = "score"
+
+# Facets count the matching parts per value of a field, in the same aggregation as the parts
+FACET_FIELDS = {
+    "room": "location.room",
+    "category": "category",
+}
+
+
+def parse_range(name: str, value: str, parse):
+    """
+    Parses a filter value into a MongoDB predicate: the value itself or a $gte / $lte range.
+    """
+    try:
+        if RANGE_SEPARATOR not in value or parse is str:
+            return parse(value)
+        low, high = value.split(RANGE_SEPARATOR, 1)
+        predicate = {}
+        if low != "":
+            predicate["$gte"] = parse(low)
+        if high != "":
+            predicate["$lte"] = parse(high)
+    except ValueError as error:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST, f"invalid {name} filter: {value}"
+        ) from error
+    if len(predicate) == 0:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"invalid {name} filter: {value}")
+    return predicate
+
+
+def get_part_filter(values: dict) -> dict:
+    """
+    Builds the query of the given filter values (by filter name, None for unused filters).
+    """
+    query = {}
+    for name, value in values.items():
+        if value is not None:
+            field, parse = FILTER_FIELDS[name]
+            query[field] = parse_range(name, value, parse)
+    return query
+
+
+def get_sort_keys(sort: str | None, q: str | None) -> list:
+    """
+    Returns the (field, direction) pairs parts are sorted by.
+    Search results are ordered by relevance unless another order is requested.
+    """
+    if sort is None:
+        primary = (SCORE_FIELD, DESCENDING) if q is not None else ("serial_number", ASCENDING)
+    else:
+        field = sort.removeprefix("-")
+        if field not in SORT_FIELDS:
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST,
+                f"invalid sort: {sort}, choose from: {', '.join(SORT_FIELDS)}"
+            )
+        primary = (field, DESCENDING if sort.startswith("-") else ASCENDING)
+    if primary[0] == "serial_number":
+        return [primary]
+    if primary[0] == SCORE_FIELD:
+        return [primary, ("serial_number", ASCENDING)]
+    # The tie-breaker follows the primary direction, so the (field, serial_number) indexes
+    # serve descending orders too, read backwards
+    return [primary, ("serial_number", primary[1])]
+
+
+def is_sort_value(field: str, value) -> bool:
+    """
+    Whether value can be a sort value of field, so cursors can't inject operators into the filter.
+    """
+    if field == "serial_number":
+        return isinstance(value, str)
+    # Prices, quantities and relevance scores; bool is a subclass of int
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def get_after_filter(sort_keys: list, sort_values: list) -> dict:
+    """
+    Keyset pagination filter matching the documents after the one with sort_values.
+    """
+    alternatives = []
+    for i, (field, direction) in enumerate(sort_keys):
+        # Equal in all the preceding keys, after it in this one
+        alternative = {
+            previous_field: value for (previous_field, _), value in zip(sort_keys[:i], sort_values)
+        }
+        alternative[field] = {"$gt" if direction == ASCENDING else "$lt": sort_values[i]}
+        alternatives.append(alternative)
+    return alternatives[0] if len(alternatives) == 1 else {"$or": alternatives}
+
+
+def parse_facets(facets: str | None) -> tuple:
+    if facets is None:
+        return ()
+    names = tuple(dict.fromkeys(name for name in facets.split(",") if name != ""))
+    if len(names) == 0 or any(name not in FACET_FIELDS for name in names):
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            f"invalid facets: {facets}, choose from: {', '.join(FACET_FIELDS)}"
+        )
+    return names
+
+
+def get_facet_pipelines(names: tuple) -> dict:
+    """
+    $facet sub-pipelines counting the parts per value, most common values first.
+    Categories are counted by ObjectID and their names are joined afterwards.
+    """
+    pipelines = {}
+    for name in names:
+        pipeline = [{"$group": {"_id": f"${FACET_FIELDS[name]}", "count": {"$sum": 1}}}]
+        if name == "category":
+            pipeline += [
+                {"$lookup": {
+                    "from": "categories",
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "as": "_category",
+                }},
+                {"$project": {"_id": {"$arrayElemAt": ["$_category.name", 0]}, "count": 1}},
+            ]
+        pipeline.append({"$sort": {"count": DESCENDING, "_id": ASCENDING}})
+        pipelines[name] = pipeline
+    return pipelines
+
+
+def get_facet_counts(facet_document: dict, names: tuple) -> dict:
+    counts = {}
+    for name in names:
+        counts[name] = [
+            {"value": bucket["_id"], "count": bucket["count"]} for bucket in facet_document[name]
+        ]
+    return counts
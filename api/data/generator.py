@@ -0,0 +1,207 @@
+"""
+Deterministic synthetic inventory of any size, for performance testing.
+
+    python -m api.data.generator --parts 1000000 --seed 0 --categories 55 --fan-out 10
+
+Replaces all data in the database from the connection settings (see api/data/connection.py)
+with the generated categories and parts. The same parameters always produce the same data.
+"""
+import argparse
+import asyncio
+import json
+import random
+from bson.objectid import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from . import search, tree, counters, occupancy, versions, connection
+from .indexes import ensure_indexes
+
+# Categories form a forest: the first base_categories categories are base categories and every
+# category after them is a child of an earlier one, fan_out children per parent, in breadth-first order.
+# Category ObjectIDs are derived from their numbers, so paths can be computed without reading parents.
+# Parts are spread over the categories which aren't base categories and fill the bookcases slot by slot,
+# so their serial numbers and locations never collide. Documents are generated and inserted in chunks,
+# with their derived data (search grams, category paths and counters, location occupancy),
+# so memory use doesn't depend on the number of parts.
+DEFAULT_PARTS = 1000
+MAX_PARTS = 100_000_000  # serial numbers stay within the length limit of the model
+DEFAULT_CATEGORIES = 55
+MAX_CATEGORIES = 10000
+DEFAULT_BASE_CATEGORIES = 5
+DEFAULT_FAN_OUT = 10
+CHUNK_SIZE = 10000
+BOOKCASES_PER_ROOM = 10
+WORDS = [
+    "Resistor", "Capacitor", "Diode", "Transistor", "Relay", "Fuse", "Switch", "Coil", "Socket",
+]
+
+
+class GeneratorSettingsError(ValueError):
+    pass
+
+
+def validate_shape(categories: int, base_categories: int, fan_out: int):
+    if base_categories < 1 or fan_out < 1:
+        raise GeneratorSettingsError("base_categories and fan_out have to be at least 1")
+    if categories > MAX_CATEGORIES:
+        raise GeneratorSettingsError(f"categories can't be greater than {MAX_CATEGORIES}")
+    if categories <= base_categories:
+        raise GeneratorSettingsError(
+            "categories has to be greater than base_categories, parts can't be in base categories"
+        )
+
+
+def get_category_name(index: int, base_categories: int) -> str:
+    return f"base{index}" if index < base_categories else f"cat{index}"
+
+
+def get_category_id(index: int) -> ObjectId:
+    return ObjectId(index.to_bytes(12, "big"))
+
+
+def get_parent_index(index: int, base_categories: int, fan_out: int) -> int | None:
+    if index < base_categories:
+        return None
+    return (index - base_categories) // fan_out
+
+
+def iter_categories(categories: int, base_categories: int, fan_out: int):
+    """
+    Yields the category documents, parents before their children.
+    """
+    for index in range(categories):
+        parent_index = get_parent_index(index, base_categories, fan_out)
+        ancestors = []
+        while parent_index is not None:
+            ancestors.insert(0, get_category_id(parent_index))
+            parent_index = get_parent_index(parent_index, base_categories, fan_out)
+        document = {
+            "_id": get_category_id(index),
+            "name": get_category_name(index, base_categories),
+            "parent_id": ancestors[-1] if len(ancestors) > 0 else None,
+            tree.ANCESTORS_FIELD: ancestors,
+            **counters.get_empty_counters(),
+        }
+        document[search.GRAMS_FIELD] = search.get_category_grams(document)
+        yield document
+
+
+def get_serial(index: int) -> str:
+    return f"P{index:07d}"
+
+
+def get_location(index: int) -> dict:
+    # Parts fill the bookcases slot by slot, BOOKCASES_PER_ROOM bookcases per room
+    bookcase_index, slot = divmod(index, occupancy.SLOTS_PER_BOOKCASE)
+    room_index, bookcase = divmod(bookcase_index, BOOKCASES_PER_ROOM)
+    return occupancy.get_slot_location(f"room{room_index}", bookcase + 1, slot)
+
+
+def get_part(rng: random.Random, index: int, category) -> dict:
+    """
+    Part number index with random fields, in the API representation if category is a name.
+    """
+    return {
+        "serial_number": get_serial(index),
+        "name": f"{rng.choice(WORDS)} {rng.randint(1, 999)}",
+        "description": f"{rng.choice(WORDS)} for {rng.choice(WORDS).lower()}s",
+        "category": category,
+        "quantity": rng.randint(0, 100),
+        "price": round(rng.uniform(0.1, 100.0), 2),
+        "location": get_location(index),
+    }
+
+
+def iter_parts(parts: int, seed: int, categories: int, base_categories: int):
+    """
+    Yields the part documents, with their categories as ObjectIDs.
+    """
+    rng = random.Random(seed)
+    for index in range(parts):
+        category_index = rng.randrange(base_categories, categories)
+        document = get_part(rng, index, get_category_id(category_index))
+        document[search.GRAMS_FIELD] = search.get_part_grams(document)
+        yield document
+
+
+def iter_chunks(documents, chunk_size: int):
+    chunk = []
+    for document in documents:
+        chunk.append(document)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+async def generate(
+    db: AsyncIOMotorDatabase,
+    parts: int = DEFAULT_PARTS,
+    seed: int = 0,
+    categories: int = DEFAULT_CATEGORIES,
+    base_categories: int = DEFAULT_BASE_CATEGORIES,
+    fan_out: int = DEFAULT_FAN_OUT,
+    chunk_size: int = CHUNK_SIZE,
+) -> dict:
+    """
+    Replaces all categories and parts with generated ones and returns their numbers.
+    Every chunk of parts is inserted with one insert_many, followed by one bulk write
+    of the category counters and one of the location occupancy.
+    Doesn't change the collection versions, callers record the write.
+    """
+    validate_shape(categories, base_categories, fan_out)
+    await asyncio.gather(
+        db.categories.delete_many({}), db.parts.delete_many({}), db.occupancy.delete_many({})
+    )
+    for chunk in iter_chunks(iter_categories(categories, base_categories, fan_out), chunk_size):
+        await db.categories.insert_many(chunk, ordered=False)
+    for chunk in iter_chunks(iter_parts(parts, seed, categories, base_categories), chunk_size):
+        await db.parts.insert_many(chunk, ordered=False)
+        await counters.update_part_counters(db, added=chunk)
+        await occupancy.update_occupancy(db, taken=[document["location"] for document in chunk])
+    return {"categories": categories, "parts": parts}
+
+
+async def generate_with_connection(**parameters) -> dict:
+    connection_string, db_name = connection.get_connection_info()
+    client = connection.create_client(connection_string)
+    try:
+        db = client[db_name]
+        await ensure_indexes(db)
+        counts = await generate(db, **parameters)
+        # Running apps reload their category caches, occupancy bitmaps and mirrors
+        # and change their ETags when they see the new versions
+        await versions.bump_versions(db, *versions.VERSIONED_COLLECTIONS)
+        return counts
+    finally:
+        client.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0].strip())
+    parser.add_argument("--parts", type=int, default=DEFAULT_PARTS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--categories", type=int, default=DEFAULT_CATEGORIES)
+    parser.add_argument("--base-categories", type=int, default=DEFAULT_BASE_CATEGORIES)
+    parser.add_argument("--fan-out", type=int, default=DEFAULT_FAN_OUT, help="children per category")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    try:
+        validate_shape(args.categories, args.base_categories, args.fan_out)
+    except GeneratorSettingsError as error:
+        parser.error(str(error))
+
+    counts = asyncio.run(generate_with_connection(
+        parts=args.parts,
+        seed=args.seed,
+        categories=args.categories,
+        base_categories=args.base_categories,
+        fan_out=args.fan_out,
+        chunk_size=args.chunk_size,
+    ))
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,134 @@
+import logging
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import IndexModel, ASCENDING, TEXT
+from pymongo.errors import OperationFailure
+
+from .reports import REPORT_EXPIRE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+LOCATION_FIELDS = ("room", "bookcase", "shelf", "cuvette", "column", "row")
+
+# Every index the app relies on, per collection.
+# Index names are part of the declaration: reconciliation matches existing indexes by name.
+INDEXES = {
+    "categories": [
+        IndexModel([("name", ASCENDING)], name="name_unique", unique=True),
+        IndexModel([("parent_id", ASCENDING)], name="parent_id"),
+        IndexModel([("ancestors", ASCENDING)], name="ancestors"),
+        IndexModel([("search_grams", ASCENDING)], name="search_grams"),
+    ],
+    "parts": [
+        IndexModel([("serial_number", ASCENDING)], name="serial_number_unique", unique=True),
+        IndexModel(
+            [(f"location.{field}", ASCENDING) for field in LOCATION_FIELDS],
+            name="location",
+            unique=True,
+        ),
+        IndexModel([("category", ASCENDING)], name="category"),
+        IndexModel([("search_grams", ASCENDING)], name="search_grams"),
+        # Range filters and sorts on prices and quantities, with the serial number as the tie-breaker
+        IndexModel([("price", ASCENDING), ("serial_number", ASCENDING)], name="price"),
+        IndexModel([("quantity", ASCENDING), ("serial_number", ASCENDING)], name="quantity"),
+    ],
+    "reports": [
+        IndexModel(
+            [("computed_at", ASCENDING)],
+            name="computed_at_ttl",
+            expireAfterSeconds=REPORT_EXPIRE_SECONDS,
+        ),
+    ],
+    "occupancy": [
+        IndexModel(
+            [("room", ASCENDING), ("bookcase", ASCENDING)],
+            name="room_bookcase_unique",
+            unique=True,
+        ),
+    ],
+}
+
+# Indexes created by earlier versions of the app which are dropped during reconciliation
+RETIRED_INDEXES = {
+    "categories": ["$**_text"],
+}
+
+
+def _index_signature(index_spec: dict) -> dict:
+    """
+    Reduces an index description to the properties that matter for reconciliation.
+    Accepts both IndexModel documents and index_information() entries.
+    """
+    key = index_spec["key"]
+    keys = [tuple(item) for item in (key.items() if isinstance(key, dict) else key)]
+
+    # The server reports text indexes as internal _fts/_ftsx keys plus the text field weights
+    if ("_fts", TEXT) in keys:
+        keys = [item for item in keys if item[0] not in ("_fts", "_ftsx")]
+        keys += [(field, TEXT) for field in index_spec.get("weights", {})]
+    text_keys = sorted(item for item in keys if item[1] == TEXT)
+    keys = [item for item in keys if item[1] != TEXT] + text_keys
+
+    return {"key": keys, "unique": bool(index_spec.get("unique", False))}
+
+
+async def get_index_drift(db: AsyncIOMotorDatabase) -> dict:
+    """
+    Compares the indexes in the database with the declared ones.
+    Returns missing, changed and undeclared index names per collection;
+    collections without any drift are left out.
+    """
+    drift = {}
+    for collection_name, declared_indexes in INDEXES.items():
+        existing = await db[collection_name].index_information()
+        existing.pop("_id_", None)
+        declared = {model.document["name"]: model.document for model in declared_indexes}
+
+        missing = [name for name in declared if name not in existing]
+        changed = [
+            name for name in declared
+            if name in existing
+            and _index_signature(existing[name]) != _index_signature(declared[name])
+        ]
+        undeclared = [name for name in existing if name not in declared]
+
+        if missing or changed or undeclared:
+            drift[collection_name] = {
+                "missing": missing,
+                "changed": changed,
+                "undeclared": undeclared,
+            }
+    return drift
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase, drop_undeclared: bool = False) -> dict:
+    """
+    Creates missing indexes and rebuilds the ones whose definition changed.
+    Undeclared indexes are only reported unless drop_undeclared is set or they're retired.
+    Returns the drift that remains afterwards.
+    """
+    drift = await get_index_drift(db)
+    for collection_name, collection_drift in drift.items():
+        collection = db[collection_name]
+        to_drop = collection_drift["changed"]
+        if drop_undeclared:
+            to_drop = to_drop + collection_drift["undeclared"]
+        else:
+            retired = RETIRED_INDEXES.get(collection_name, [])
+            to_drop = to_drop + [name for name in collection_drift["undeclared"] if name in retired]
+        for name in to_drop:
+            await collection.drop_index(name)
+
+        to_create = collection_drift["missing"] + collection_drift["changed"]
+        models = [model for model in INDEXES[collection_name] if model.document["name"] in to_create]
+        if len(models) == 0:
+            continue
+        try:
+            await collection.create_indexes(models)
+        except OperationFailure as error:
+            # e.g. existing duplicates prevent building a unique index
+            logger.error("could not create indexes on %s: %s", collection_name, error)
+
+    remaining_drift = await get_index_drift(db)
+    if remaining_drift:
+        logger.warning("index drift: %s", remaining_drift)
+    return remaining_drift
@@ -0,0 +1,125 @@
+import asyncio
+import math
+import os
+from fastapi import status
+from fastapi.responses import JSONResponse
+from starlette.routing import Match
+
+# Requests are divided into classes (e.g. point reads, listings and writes) which each have their own
+# limit of concurrently handled requests. A request over the limit waits in its class's queue
+# until a slot frees up or its deadline passes; requests which would wait too long, or find
+# the queue full, are rejected right away with 503 and Retry-After instead of piling up.
+# Slow listings can then only use up their own slots, and point reads keep flowing next to them.
+QUEUE_LENGTH_FACTOR = 2  # waiting requests per slot before new ones are rejected
+DEFAULT_QUEUE_SECONDS = 1.0
+
+
+class ConcurrencyLimit:
+    """
+    Limit of concurrent requests of one class, with a bounded queue.
+    Only used from the event loop.
+    """
+
+    def __init__(self, limit: int, queue_seconds: float = DEFAULT_QUEUE_SECONDS):
+        self.limit = limit
+        self.queue_seconds = queue_seconds
+        self.max_waiting = limit * QUEUE_LENGTH_FACTOR
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self) -> bool:
+        """
+        Takes a slot, waiting for at most queue_seconds. Returns False if the request is rejected.
+        """
+        if self._semaphore.locked() and self.waiting >= self.max_waiting:
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_seconds)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    def get_retry_after(self) -> int:
+        # Whole seconds; a queue deadline worth of time is a fair guess for a slot to free up
+        return max(1, math.ceil(self.queue_seconds))
+
+    def get_status(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+        }
+
+
+def get_limits_from_env(class_names, queue_seconds: float) -> dict:
+    """
+    Reads CONCURRENCY_LIMIT_<CLASS> variables (e.g. CONCURRENCY_LIMIT_LISTINGS=8).
+    Classes without a positive limit are left out, their requests aren't limited.
+    """
+    limits = {}
+    for class_name in class_names:
+        limit = int(os.environ.get(f"CONCURRENCY_LIMIT_{class_name.upper()}", "0"))
+        if limit > 0:
+            limits[class_name] = ConcurrencyLimit(limit, queue_seconds)
+    return limits
+
+
+class ConcurrencyLimitMiddleware:
+    """
+    ASGI middleware holding a slot of the request's class for the whole request,
+    streamed responses included. get_route_class(method, route_path) returns the class of a route
+    (None for requests which are never limited); routes are matched the same way the router does.
+    """
+
+    def __init__(self, app, routes: list, get_route_class, limits: dict):
+        self.app = app
+        self.routes = routes
+        self.get_route_class = get_route_class
+        self.limits = limits
+
+    def _match_route(self, scope):
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or len(self.limits) == 0:
+            await self.app(scope, receive, send)
+            return
+
+        route = self._match_route(scope)
+        route_path = route.path if route is not None else None
+        limit = self.limits.get(self.get_route_class(scope["method"], route_path))
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await limit.acquire():
+            if route is not None:
+                scope["route"] = route  # for the request metrics
+            response = JSONResponse(
+                {"detail": "server is busy, try again later"},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(limit.get_retry_after())},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limit.release()
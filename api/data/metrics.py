@@ -0,0 +1,242 @@
+import contextvars
+import logging
+import time
+from collections import Counter
+from threading import Lock
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Database commands are timed with pymongo command monitoring and attributed to the request
+# which is being handled in the current context. Motor runs pymongo in executor threads
+# with a copy of the context, so the listener sees the request of the command.
+_request_stats = contextvars.ContextVar("request_stats", default=None)
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMAND_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 1000)
+UNMATCHED_ROUTE = "<unmatched>"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+SHAPE_VALUE = "?"
+MAX_LOGGED_SHAPES = 20
+
+# Command fields which describe the shape of a query; everything else (documents, session ids...)
+# is left out of the slow request log
+SHAPE_FIELDS = ("filter", "pipeline", "sort", "projection", "query", "key")
+
+
+class RequestStats:
+    def __init__(self, record_shapes: bool):
+        self.command_count = 0
+        self.command_seconds = 0.0
+        self.record_shapes = record_shapes
+        self.shapes = Counter()
+        self._lock = Lock()  # commands of one request may finish in different threads
+
+    def add_command(self, seconds: float):
+        with self._lock:
+            self.command_count += 1
+            self.command_seconds += seconds
+
+    def add_shape(self, shape: str):
+        with self._lock:
+            self.shapes[shape] += 1
+
+
+def get_shape(value):
+    """
+    Replaces the values in a query with placeholders, keeping field names and operators.
+    """
+    if isinstance(value, dict):
+        return {key: get_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for item in value:
+            shape = get_shape(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return SHAPE_VALUE
+
+
+def get_command_shape(command_name: str, command: dict) -> str:
+    collection = command.get(command_name)
+    parts = [f"{command_name} {collection}"]
+    for field in SHAPE_FIELDS:
+        if field in command:
+            parts.append(f"{field}={get_shape(command[field])}")
+    for field in ("updates", "deletes"):
+        for statement in command.get(field, [])[:1]:
+            parts.append(f"q={get_shape(statement.get('q', {}))}")
+    return " ".join(parts)
+
+
+class CommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        stats = _request_stats.get()
+        if stats is not None and stats.record_shapes:
+            stats.add_shape(get_command_shape(event.command_name, event.command))
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.add_command(event.duration_micros / 1e6)
+
+
+command_timer = CommandTimer()
+
+
+# -------------------------- Prometheus metrics -------------------------- #
+
+
+class Histogram:
+    """
+    Minimal Prometheus histogram with labels, rendered in the text exposition format.
+    """
+
+    def __init__(self, name: str, description: str, label_names: tuple, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = Lock()
+        self._series = {}  # label values -> [bucket counts, sum, count]
+
+    def observe(self, label_values: tuple, value: float):
+        with self._lock:
+            series = self._series.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _labels(self, label_values: tuple, **extra) -> str:
+        pairs = list(zip(self.label_names, label_values)) + list(extra.items())
+        escaped = [
+            (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in pairs
+        ]
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {
+                labels: (list(counts), total, count)
+                for labels, (counts, total, count) in self._series.items()
+            }
+        for label_values, (bucket_counts, total, count) in sorted(series.items()):
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                labels = self._labels(label_values, le=bound)
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            lines.append(f"{self.name}_bucket{self._labels(label_values, le='+Inf')} {count}")
+            lines.append(f"{self.name}_sum{self._labels(label_values)} {total}")
+            lines.append(f"{self.name}_count{self._labels(label_values)} {count}")
+        return lines
+
+
+REQUEST_LABELS = ("method", "route", "status")
+
+request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling requests, including streaming the response.",
+    REQUEST_LABELS,
+    DURATION_BUCKETS,
+)
+request_db_commands = Histogram(
+    "http_request_db_commands",
+    "Database commands sent while handling a request.",
+    REQUEST_LABELS,
+    COMMAND_COUNT_BUCKETS,
+)
+request_db_duration = Histogram(
+    "http_request_db_duration_seconds",
+    "Time spent in database commands while handling a request.",
+    REQUEST_LABELS,
+    DURATION_BUCKETS,
+)
+HISTOGRAMS = (request_duration, request_db_commands, request_db_duration)
+
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    return "\n".join(lines) + "\n"
+
+
+# -------------------------- Middleware -------------------------- #
+
+
+def get_server_timing(stats: RequestStats, elapsed: float) -> str:
+    return (
+        f'db;dur={stats.command_seconds * 1000:.3f};desc="{stats.command_count} commands", '
+        f"total;dur={elapsed * 1000:.3f}"
+    )
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware attributing database commands and time to requests.
+    Adds a Server-Timing header with the database time and command count
+    until the response starts, and records the metrics once the whole response is sent.
+    With slow_request_seconds, requests which took longer are logged with the shapes of their queries.
+    """
+
+    def __init__(self, app, slow_request_seconds: float = None):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(record_shapes=self.slow_request_seconds is not None)
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_metrics(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                timing = get_server_timing(stats, time.perf_counter() - start)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", timing.encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            _request_stats.reset(token)
+            self._record(scope, stats, status_code, time.perf_counter() - start)
+
+    def _record(self, scope, stats: RequestStats, status_code: int, elapsed: float):
+        route = scope.get("route")
+        route_path = route.path if route is not None else UNMATCHED_ROUTE
+        label_values = (scope["method"], route_path, str(status_code))
+        request_duration.observe(label_values, elapsed)
+        request_db_commands.observe(label_values, stats.command_count)
+        request_db_duration.observe(label_values, stats.command_seconds)
+
+        if self.slow_request_seconds is not None and elapsed >= self.slow_request_seconds:
+            shapes = [
+                f"{count}x {shape}" for shape, count in stats.shapes.most_common(MAX_LOGGED_SHAPES)
+            ]
+            logger.warning(
+                "slow request: %s %s took %.1f ms, %d database commands (%.1f ms): %s",
+                scope["method"],
+                scope["path"],
+                elapsed * 1000,
+                stats.command_count,
+                stats.command_seconds * 1000,
+                "; ".join(shapes),
+            )
@@ -0,0 +1,346 @@
+import asyncio
+import bisect
+import logging
+import time
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .indexes import LOCATION_FIELDS
+from .search import GRAMS_FIELD, get_part_score
+from . import versions
+
+logger = logging.getLogger(__name__)
+
+# The mirror is an optional in-process copy of the categories and parts which reads are served from.
+# It's kept current by a change stream, which needs a replica set or a sharded cluster.
+# For development and tests (standalone servers and mongomock), it can poll the collection versions
+# instead and reload the collections which changed; a reload reads the whole collection,
+# so writes never wait for it and reads go to the database until the mirror has caught up with them.
+# Data is only ever changed by the stream or the polling, so the mirror always holds
+# a state the database went through, and its versions never count changes it doesn't have yet.
+WATCHED_COLLECTIONS = ("versions", *versions.VERSIONED_COLLECTIONS)
+WAIT_INTERVAL_SECONDS = 0.002
+
+MIRROR_PROJECTIONS = {
+    "categories": {"name": 1, "parent_id": 1},
+    "parts": {GRAMS_FIELD: 0},
+}
+
+
+class PartRecord:
+    # Slots instead of per-record dicts: the whole inventory is held in memory
+    __slots__ = (
+        "id", "serial_number", "name", "description", "category_id", "quantity", "price", "location"
+    )
+
+    def __init__(self, document: dict):
+        self.id = document["_id"]
+        self.serial_number = document["serial_number"]
+        self.name = document["name"]
+        self.description = document["description"]
+        self.category_id = document["category"]
+        self.quantity = document["quantity"]
+        self.price = document["price"]
+        self.location = tuple(document["location"][field] for field in LOCATION_FIELDS)
+
+    def to_dict(self, category_name: str | None) -> dict:
+        # Same fields in the same order as the database reads (see part_read_pipeline)
+        part = {
+            "serial_number": self.serial_number,
+            "name": self.name,
+            "description": self.description,
+            "category": category_name,
+            "quantity": self.quantity,
+            "price": self.price,
+            "location": dict(zip(LOCATION_FIELDS, self.location)),
+        }
+        if category_name is None:  # the $lookup leaves out the names of missing categories
+            del part["category"]
+        return part
+
+
+class CategoryRecord:
+    __slots__ = ("id", "name", "parent_id")
+
+    def __init__(self, document: dict):
+        self.id = document["_id"]
+        self.name = document["name"]
+        self.parent_id = document["parent_id"]
+
+
+async def supports_change_streams(db: AsyncIOMotorDatabase) -> bool:
+    try:
+        hello = await db.command("hello")
+    except (OperationFailure, NotImplementedError):  # old servers and mongomock
+        return False
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+
+class InventoryMirror:
+    """
+    In-memory copy of the categories and parts, indexed by ObjectID, serial number,
+    category and location. Lookups don't touch the database.
+
+    Only used from the event loop, so it needs no locking: every change is applied
+    between two awaits and readers never see it half-done.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.polling = True
+        self.versions = {}  # (epoch, version) of the loaded data, per collection
+        self._expected = {}  # versions of this process's writes which the polling hasn't loaded yet
+        self._load_categories([])
+        self._load_parts([])
+
+    @property
+    def current(self) -> bool:
+        """
+        Whether the mirror is loaded and has all writes of this process, so it can serve reads.
+        """
+        return self.loaded and versions.is_at_least(self.versions, self._expected)
+
+    def clear(self):
+        self.loaded = False
+        self.versions = {}
+        self._expected = {}
+        self._load_categories([])
+        self._load_parts([])
+
+    # ----- Changes -----
+
+    def _load_categories(self, documents: list):
+        self._categories_by_id = {}
+        self._category_ids_by_name = {}
+        for document in documents:
+            self._put_category(document)
+
+    def _load_parts(self, documents: list):
+        self._parts_by_id = {}
+        self._parts_by_serial = {}
+        self._serials_by_category = {}
+        self._serial_by_location = {}
+        self._sorted_serials = None
+        for document in documents:
+            self._put_part(document)
+
+    def _put_category(self, document: dict):
+        previous = self._categories_by_id.get(document["_id"])
+        if previous is not None and self._category_ids_by_name.get(previous.name) == previous.id:
+            del self._category_ids_by_name[previous.name]
+        record = CategoryRecord(document)
+        self._categories_by_id[record.id] = record  # an updated category keeps its position
+        self._category_ids_by_name[record.name] = record.id
+
+    def _remove_category(self, category_id):
+        record = self._categories_by_id.pop(category_id, None)
+        if record is not None and self._category_ids_by_name.get(record.name) == category_id:
+            del self._category_ids_by_name[record.name]
+
+    def _put_part(self, document: dict):
+        previous = self._remove_part(document["_id"])
+        record = PartRecord(document)
+        self._parts_by_id[record.id] = record
+        self._parts_by_serial[record.serial_number] = record
+        self._serials_by_category.setdefault(record.category_id, set()).add(record.serial_number)
+        self._serial_by_location[record.location] = record.serial_number
+        if previous is None or previous.serial_number != record.serial_number:
+            self._sorted_serials = None
+
+    def _remove_part(self, part_id) -> PartRecord | None:
+        record = self._parts_by_id.pop(part_id, None)
+        if record is None:
+            return None
+        serial = record.serial_number
+        if self._parts_by_serial.get(serial) is record:
+            del self._parts_by_serial[serial]
+        category_serials = self._serials_by_category.get(record.category_id, set())
+        category_serials.discard(serial)
+        if len(category_serials) == 0:
+            self._serials_by_category.pop(record.category_id, None)
+        if self._serial_by_location.get(record.location) == serial:
+            del self._serial_by_location[record.location]
+        self._sorted_serials = None
+        return record
+
+    async def sync(self, db: AsyncIOMotorDatabase, force: bool = False):
+        """
+        Reloads the collections whose versions changed since they were loaded.
+        The versions are read first, so the data is at least as new as the versions stored with it.
+        """
+        current = await versions.get_versions(db, versions.VERSIONED_COLLECTIONS)
+        stale = [
+            name for name in versions.VERSIONED_COLLECTIONS
+            if force or not self.loaded or current[name] != self.versions.get(name)
+        ]
+        if len(stale) == 0:
+            return
+        results = await asyncio.gather(*[
+            db[name].find({}, MIRROR_PROJECTIONS[name]).to_list(None) for name in stale
+        ])
+        target = {name: current[name] for name in stale}
+        if self.loaded and not force and versions.is_at_least(self.versions, target):
+            return  # a concurrent sync has loaded these or newer changes in the meantime
+
+        for name, documents in zip(stale, results):
+            if name == "categories":
+                self._load_categories(documents)
+            else:
+                self._load_parts(documents)
+        self.versions.update(target)
+        self.loaded = True
+        # Epochs only change when the versions collection is dropped, writes of older epochs are loaded
+        self._expected = {
+            name: version for name, version in self._expected.items()
+            if not versions.is_at_least(self.versions, {name: version})
+            and version[0] == self.versions.get(name, versions.DEFAULT_VERSION)[0]
+        }
+
+    async def apply_change(self, db: AsyncIOMotorDatabase, change: dict):
+        operation = change["operationType"]
+        collection_name = change.get("ns", {}).get("coll")
+        if collection_name == "versions" and operation in ("insert", "update", "replace", "delete"):
+            self._apply_version_change(change)
+        elif operation in ("insert", "update", "replace"):
+            document = change.get("fullDocument")
+            if document is None:  # removed since, its delete event follows
+                return
+            if collection_name == "categories":
+                self._put_category(document)
+            else:
+                self._put_part(document)
+        elif operation == "delete":
+            if collection_name == "categories":
+                self._remove_category(change["documentKey"]["_id"])
+            else:
+                self._remove_part(change["documentKey"]["_id"])
+        else:  # drops, renames and invalidation: start over
+            await self.sync(db, force=True)
+
+    def _apply_version_change(self, change: dict):
+        collection_name = change["documentKey"]["_id"]
+        if change["operationType"] == "delete":
+            self.versions.pop(collection_name, None)
+        elif change["operationType"] == "update":
+            # The full document is looked up when the event is read and may already count
+            # later changes, so only the updated value is exact
+            updated_fields = change["updateDescription"]["updatedFields"]
+            if "version" in updated_fields:
+                epoch, _ = self.versions.get(collection_name, versions.DEFAULT_VERSION)
+                self.versions[collection_name] = (epoch, updated_fields["version"])
+        else:
+            self.versions[collection_name] = versions.get_version(change["fullDocument"])
+
+    async def watch(self, db: AsyncIOMotorDatabase):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(WATCHED_COLLECTIONS)}}}]
+        async with db.watch(pipeline, full_document="updateLookup") as stream:
+            # Loaded once the stream is open, so no change is missed in between
+            await self.sync(db, force=True)
+            async for change in stream:
+                await self.apply_change(db, change)
+
+    async def run(self, db: AsyncIOMotorDatabase, poll_seconds: float, allow_polling: bool = False):
+        """
+        Loads the mirror and keeps it current until cancelled.
+        Without change streams, the mirror is only loaded if polling is allowed.
+        """
+        self.polling = not await supports_change_streams(db)
+        if self.polling and not allow_polling:
+            logger.warning("inventory mirror needs change streams (a replica set), reads go to the database")
+            return
+        while True:
+            try:
+                if self.polling:
+                    await self.sync(db)
+                    await asyncio.sleep(poll_seconds)
+                else:
+                    await self.watch(db)
+            except PyMongoError:
+                # Reads go to the database until the mirror is reloaded
+                self.loaded = False
+                logger.exception("inventory mirror update failed")
+                await asyncio.sleep(poll_seconds)
+
+    async def wait_for(self, db: AsyncIOMotorDatabase, target: dict, timeout: float):
+        """
+        Waits until the mirror has the changes counted in target, so a client reads its own writes.
+        When polling, doesn't wait: the mirror stops serving reads until a poll has loaded the changes.
+        """
+        if self.polling:
+            for name, version in target.items():
+                expected = self._expected.get(name)
+                if expected is None or expected[0] != version[0] or expected[1] < version[1]:
+                    self._expected[name] = version
+            return
+        deadline = time.monotonic() + timeout
+        while self.loaded and not versions.is_at_least(self.versions, target):
+            if time.monotonic() >= deadline:
+                logger.warning("inventory mirror is behind the database: %s", target)
+                return
+            await asyncio.sleep(WAIT_INTERVAL_SECONDS)
+
+    # ----- Reads -----
+
+    def _part_response(self, record: PartRecord) -> dict:
+        category = self._categories_by_id.get(record.category_id)
+        return record.to_dict(None if category is None else category.name)
+
+    def get_part(self, serial_number: str) -> dict | None:
+        record = self._parts_by_serial.get(serial_number)
+        return None if record is None else self._part_response(record)
+
+    def find_parts(self, q: str = None, after: list = None, limit: int = None) -> list:
+        """
+        Parts in their API representation, in the same order as the database reads:
+        by relevance and serial number with q, otherwise by serial number.
+        after holds the sort values of the last part of the previous page.
+        """
+        if self._sorted_serials is None:
+            self._sorted_serials = sorted(self._parts_by_serial)
+        serials = self._sorted_serials
+
+        if q is None:
+            start = 0 if after is None else bisect.bisect_right(serials, after[0])
+            end = len(serials) if limit is None else start + limit
+            return [
+                self._part_response(self._parts_by_serial[serial]) for serial in serials[start:end]
+            ]
+
+        matches = []
+        for serial in serials:
+            part = self._part_response(self._parts_by_serial[serial])
+            score = get_part_score(part, q)
+            # Any matching field has a positive weight
+            if score > 0 and (after is None or (-score, serial) > (-after[0], after[1])):
+                matches.append((-score, serial, part))
+        matches.sort(key=lambda match: match[:2])
+        return [part for _, _, part in matches[:limit]]
+
+    def get_category_documents(self) -> list:
+        return [
+            {"_id": record.id, "name": record.name, "parent_id": record.parent_id}
+            for record in self._categories_by_id.values()
+        ]
+
+    def get_category_id(self, name: str):
+        return self._category_ids_by_name.get(name)
+
+    def category_has_parts(self, category_id) -> bool:
+        return category_id in self._serials_by_category
+
+    def subtree_has_parts(self, category_id) -> bool:
+        """
+        Whether any category below category_id has parts, at any depth.
+        """
+        for other_id in self._serials_by_category:
+            seen = set()  # guards against cycles
+            record = self._categories_by_id.get(other_id)
+            while record is not None and record.parent_id not in seen:
+                if record.parent_id == category_id:
+                    return True
+                seen.add(record.parent_id)
+                record = self._categories_by_id.get(record.parent_id)
+        return False
+
+    def get_serial_at(self, location_key: tuple) -> str | None:
+        return self._serial_by_location.get(location_key)
@@ -1,6 +1,8 @@
 from pydantic import BaseModel, Field
 
 DEFAULT_MAX_LEN = 20
+MAX_BATCH_SIZE = 1000
+MAX_INT32 = 2**31 - 1  # keeps numbers from requests within BSON's integer types
 
 
 class Category(BaseModel):
@@ -38,3 +40,18 @@ class Part(BaseModel):
     quantity: int = Field(ge=0, default=10)  # greater than or equal to 0
     price: float = Field(gt=0.0, default=2.0)  # greater than
     location: Location
+
+
+class PartSerials(BaseModel):
+    """
+    Serial numbers of the parts requested at once with POST /parts/batch.
+    """
+    serial_numbers: list[str] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+
+
+class QuantityAdjustment(BaseModel):
+    """
+    Change of a part's quantity applied with POST /parts/{serial_number}/adjust,
+    negative for parts taken out of stock.
+    """
+    delta: int = Field(default=-1, ge=-MAX_INT32 - 1, le=MAX_INT32)
@@ -0,0 +1,255 @@
+from threading import Lock
+from bson.int64 import Int64
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReplaceOne, UpdateOne
+
+# Every bookcase has the same grid (see models.Location), so the occupancy of a bookcase
+# is a packed bitmap with one bit per slot, ordered by shelf, cuvette, column and row.
+SHELVES = 6
+CUVETTES = 10
+COLUMNS = 8
+ROWS = 8
+SLOTS_PER_BOOKCASE = SHELVES * CUVETTES * COLUMNS * ROWS
+BITMAP_SIZE = SLOTS_PER_BOOKCASE // 8
+
+# In the occupancy collection, a bitmap is stored as 32-bit words keyed by their position.
+# Words are changed with $bit (or to take slots, and to free them), which is atomic and idempotent,
+# so a word which got out of sync with the parts never spills a change over into its neighbouring slots.
+WORD_BITS = 32
+WORDS_FIELD = "words"
+
+
+def get_slot(location: dict) -> int:
+    cuvette_index = (location["shelf"] - 1) * CUVETTES + (location["cuvette"] - 1)
+    return cuvette_index * COLUMNS * ROWS + (location["column"] - 1) * ROWS + (location["row"] - 1)
+
+
+def get_slot_location(room: str, bookcase: int, slot: int) -> dict:
+    cuvette_index, cuvette_slot = divmod(slot, COLUMNS * ROWS)
+    shelf_index, cuvette = divmod(cuvette_index, CUVETTES)
+    column, row = divmod(cuvette_slot, ROWS)
+    return {
+        "room": room,
+        "bookcase": bookcase,
+        "shelf": shelf_index + 1,
+        "cuvette": cuvette + 1,
+        "column": column + 1,
+        "row": row + 1,
+    }
+
+
+class OccupancyIndex:
+    """
+    In-memory occupancy bitmaps of all bookcases, keyed by room and bookcase number.
+    Bookcases without a bitmap are empty. The bitmaps are loaded from the occupancy collection
+    together with the parts version they're current at, and then follow the writes of this process.
+    Writes of other processes change the parts version, after which the bitmaps are reloaded.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._bitmaps = {}
+        self.loaded = False
+        self.version = None
+
+    def is_current(self, version) -> bool:
+        return self.loaded and self.version == version
+
+    def follow_write(self, version):
+        """
+        Moves the bitmaps to the parts version of a write of this process, which they already have.
+        If another write came in between, they stay behind and are reloaded.
+        """
+        with self._lock:
+            epoch, number = version
+            if self.loaded and self.version == (epoch, number - 1):
+                self.version = version
+
+    def load(self, documents, version=None):
+        bitmaps = {}
+        for document in documents:
+            bitmap = bytearray(BITMAP_SIZE)
+            for word_index, word in document[WORDS_FIELD].items():
+                offset = int(word_index) * WORD_BITS // 8
+                bitmap[offset:offset + WORD_BITS // 8] = word.to_bytes(WORD_BITS // 8, "little")
+            bitmaps[(document["room"], document["bookcase"])] = bitmap
+        with self._lock:
+            self._bitmaps = bitmaps
+            self.loaded = True
+            self.version = version
+
+    def clear(self):
+        with self._lock:
+            self._bitmaps = {}
+            self.loaded = False
+            self.version = None
+
+    def is_taken(self, location: dict) -> bool:
+        slot = get_slot(location)
+        with self._lock:
+            bitmap = self._bitmaps.get((location["room"], location["bookcase"]))
+            return bitmap is not None and bool(bitmap[slot // 8] & (1 << slot % 8))
+
+    def set_taken(self, location: dict, taken: bool):
+        # Before loading, the changes are already in the collection the bitmaps will be loaded from
+        if not self.loaded:
+            return
+        slot = get_slot(location)
+        with self._lock:
+            key = (location["room"], location["bookcase"])
+            bitmap = self._bitmaps.setdefault(key, bytearray(BITMAP_SIZE))
+            if taken:
+                bitmap[slot // 8] |= 1 << slot % 8
+            else:
+                bitmap[slot // 8] &= ~(1 << slot % 8) & 0xFF
+
+    def find_free(self, room: str, count: int) -> list:
+        """
+        Returns the locations of the first count free slots in the room,
+        in the order of bookcase, shelf, cuvette, column and row.
+        """
+        with self._lock:
+            bitmaps = {
+                bookcase: bytes(bitmap)
+                for (bitmap_room, bookcase), bitmap in self._bitmaps.items()
+                if bitmap_room == room
+            }
+        free = []
+        bookcase = 1
+        while len(free) < count:
+            bitmap = bitmaps.get(bookcase, bytes(BITMAP_SIZE))
+            for byte_index, byte in enumerate(bitmap):
+                if byte == 0xFF:
+                    continue  # skips full bytes without checking their bits
+                for bit in range(8):
+                    if not byte & (1 << bit):
+                        free.append(get_slot_location(room, bookcase, byte_index * 8 + bit))
+                        if len(free) == count:
+                            return free
+            bookcase += 1
+        return free
+
+
+def get_words(locations) -> dict:
+    """
+    Bitmap words of the given taken locations, keyed by room and bookcase.
+    """
+    bookcases = {}
+    for location in locations:
+        slot = get_slot(location)
+        words = bookcases.setdefault((location["room"], location["bookcase"]), {})
+        word_index = str(slot // WORD_BITS)
+        words[word_index] = words.get(word_index, 0) | 1 << slot % WORD_BITS
+    return bookcases
+
+
+def get_word_changes(taken, freed) -> dict:
+    """
+    Masks of the bits to set and to clear in every changed word, keyed by room and bookcase.
+    """
+    changes = {}
+    for locations, position in ((taken, 0), (freed, 1)):
+        for bookcase_key, words in get_words(locations).items():
+            bookcase_changes = changes.setdefault(bookcase_key, {})
+            for word_index, word in words.items():
+                masks = bookcase_changes.setdefault(word_index, [0, 0])
+                masks[position] |= word
+    return changes
+
+
+def get_bit_update(words: dict) -> dict:
+    operations = {}
+    for word_index, (set_mask, clear_mask) in words.items():
+        operation = {}
+        if clear_mask != 0:
+            operation["and"] = Int64(~clear_mask)
+        if set_mask != 0:
+            operation["or"] = Int64(set_mask)
+        operations[f"{WORDS_FIELD}.{word_index}"] = operation
+    return {"$bit": operations}
+
+
+async def update_words_guarded(db: AsyncIOMotorDatabase, room: str, bookcase: int, words: dict):
+    """
+    Read-modify-write fallback for databases without $bit (mongomock).
+    The update only applies if the words are still as they were read, otherwise it's retried.
+    """
+    while True:
+        document = await db.occupancy.find_one({"room": room, "bookcase": bookcase})
+        previous = document[WORDS_FIELD] if document is not None else {}
+        changed = {
+            f"{WORDS_FIELD}.{word_index}": (previous.get(word_index, 0) | set_mask) & ~clear_mask
+            for word_index, (set_mask, clear_mask) in words.items()
+        }
+        if document is None:
+            result = await db.occupancy.update_one(
+                {"room": room, "bookcase": bookcase}, {"$setOnInsert": changed}, upsert=True
+            )
+            if result.upserted_id is not None:
+                return
+            continue
+        guard = {f"{WORDS_FIELD}.{word_index}": previous.get(word_index) for word_index in words}
+        result = await db.occupancy.update_one({"_id": document["_id"], **guard}, {"$set": changed})
+        if result.matched_count == 1:
+            return
+
+
+async def update_occupancy(
+    db: AsyncIOMotorDatabase, index: OccupancyIndex = None, taken=(), freed=()
+):
+    """
+    Marks locations as taken or free, both in memory (if an index is given) and in the occupancy collection.
+    Locations which are both freed and taken (a part moved in place) are left as they are.
+    """
+    taken, freed = (
+        [location for location in taken if location not in freed],
+        [location for location in freed if location not in taken],
+    )
+    changes = get_word_changes(taken, freed)
+    requests = [
+        UpdateOne({"room": room, "bookcase": bookcase}, get_bit_update(words), upsert=True)
+        for (room, bookcase), words in changes.items()
+    ]
+    if len(requests) > 0:
+        try:
+            await db.occupancy.bulk_write(requests)
+        except (ValueError, NotImplementedError):  # mongomock doesn't support $bit
+            for (room, bookcase), words in changes.items():
+                await update_words_guarded(db, room, bookcase, words)
+    if index is None:
+        return
+    for location in taken:
+        index.set_taken(location, True)
+    for location in freed:
+        index.set_taken(location, False)
+
+
+async def rebuild_occupancy(db: AsyncIOMotorDatabase, index: OccupancyIndex = None):
+    """
+    Recomputes the occupancy collection from the part locations,
+    e.g. after the parts were replaced or modified outside of the API.
+    Every bookcase is replaced in place (upserted), so part writes running meanwhile,
+    which upsert their bookcases too, never collide with the rebuild on the unique index.
+    """
+    locations = [document["location"] async for document in db.parts.find({}, {"location": 1})]
+    bookcases = get_words(locations)
+    requests = [
+        ReplaceOne(
+            {"room": room, "bookcase": bookcase},
+            {"room": room, "bookcase": bookcase, WORDS_FIELD: words},
+            upsert=True,
+        )
+        for (room, bookcase), words in bookcases.items()
+    ]
+    if len(requests) > 0:
+        await db.occupancy.bulk_write(requests, ordered=False)
+    # Bookcases without any parts left
+    empty_ids = [
+        document["_id"]
+        async for document in db.occupancy.find({}, {"room": 1, "bookcase": 1})
+        if (document["room"], document["bookcase"]) not in bookcases
+    ]
+    if len(empty_ids) > 0:
+        await db.occupancy.delete_many({"_id": {"$in": empty_ids}})
+    if index is not None:
+        index.clear()
@@ -0,0 +1,144 @@
+from datetime import datetime, timezone
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING
+
+from .counters import COUNTER_FIELDS, PART_COUNT_FIELD, TOTAL_VALUE_FIELD
+from .tree import ANCESTORS_FIELD
+
+# Inventory reports are computed by aggregations on the server and stored in the reports collection,
+# one document per report and parameters, together with the ETag of the data they were computed from.
+# A stored report is served until a write changes the ETag; the next request recomputes it.
+# The valuation is rolled up from the category counters, which every part write updates with $inc,
+# so recomputing it reads the categories only.
+REPORT_EXPIRE_SECONDS = 24 * 60 * 60  # unused reports are removed by a TTL index
+DEFAULT_LOW_STOCK_THRESHOLD = 5
+MAX_REPORT_PARTS = 1000
+VALUE_DECIMALS = 2
+
+
+async def get_report(db: AsyncIOMotorDatabase, report_id: str, etag: str, compute) -> dict:
+    """
+    Returns the stored report if it was computed from the data with the given ETag,
+    otherwise computes it with compute(db) and stores it.
+    The ETag is read before the data, so a report is never stored as newer than it is.
+    """
+    document = await db.reports.find_one({"_id": report_id, "etag": etag}, {"report": 1})
+    if document is not None:
+        return document["report"]
+    report = await compute(db)
+    await db.reports.replace_one(
+        {"_id": report_id},
+        {"etag": etag, "computed_at": datetime.now(timezone.utc), "report": report},
+        upsert=True,
+    )
+    return report
+
+
+def round_counters(counters: dict) -> dict:
+    # Values are sums of floats, reported in whole cents
+    return {**counters, TOTAL_VALUE_FIELD: round(counters[TOTAL_VALUE_FIELD], VALUE_DECIMALS)}
+
+
+async def compute_valuation(db: AsyncIOMotorDatabase) -> dict:
+    """
+    Stock value of every category, both of its own parts and of its whole subtree.
+    Descendants are found through the materialized paths, with one $lookup per category.
+    """
+    pipeline = [
+        {"$lookup": {
+            "from": "categories",
+            "localField": "_id",
+            "foreignField": ANCESTORS_FIELD,
+            "as": "_descendants",
+        }},
+        {"$lookup": {
+            "from": "categories",
+            "localField": "parent_id",
+            "foreignField": "_id",
+            "as": "_parent",
+        }},
+        {"$project": {
+            "_id": 0,
+            "name": 1,
+            "parent_name": {"$ifNull": [{"$arrayElemAt": ["$_parent.name", 0]}, ""]},
+            **{field: 1 for field in COUNTER_FIELDS},
+            "subtree": {
+                field: {"$add": [f"${field}", {"$sum": f"$_descendants.{field}"}]}
+                for field in COUNTER_FIELDS
+            },
+        }},
+        {"$sort": {"name": ASCENDING}},
+    ]
+    categories = []
+    total = dict.fromkeys(COUNTER_FIELDS, 0)
+    async for document in db.categories.aggregate(pipeline):
+        for field in COUNTER_FIELDS:
+            total[field] += document[field]
+        categories.append({
+            "name": document["name"],
+            "parent_name": document["parent_name"],
+            **round_counters({field: document[field] for field in COUNTER_FIELDS}),
+            "subtree": round_counters(document["subtree"]),
+        })
+    return {"categories": categories, "total": round_counters(total)}
+
+
+async def compute_low_stock(db: AsyncIOMotorDatabase, threshold: int) -> dict:
+    """
+    Parts with a quantity of at most threshold, the scarcest first (at most MAX_REPORT_PARTS of them),
+    and the number of such parts in every category and its subtree.
+    The parts are found through the quantity index and counted in the same aggregation.
+    """
+    pipeline = [
+        {"$match": {"quantity": {"$lte": threshold}}},
+        {"$facet": {
+            "parts": [
+                {"$sort": {"quantity": ASCENDING, "serial_number": ASCENDING}},
+                {"$limit": MAX_REPORT_PARTS},
+                {"$lookup": {
+                    "from": "categories",
+                    "localField": "category",
+                    "foreignField": "_id",
+                    "as": "_category",
+                }},
+                {"$project": {
+                    "_id": 0,
+                    "serial_number": 1,
+                    "name": 1,
+                    "category": {"$arrayElemAt": ["$_category.name", 0]},
+                    "quantity": 1,
+                    "location": 1,
+                }},
+            ],
+            "categories": [{"$group": {"_id": "$category", "count": {"$sum": 1}}}],
+        }},
+    ]
+    result = (await db.parts.aggregate(pipeline).to_list(None))[0]
+    counts = {group["_id"]: group["count"] for group in result["categories"]}
+
+    # Roll the counts up to all ancestors of the categories with low stock
+    category_documents = await db.categories.find(
+        {"_id": {"$in": list(counts)}}, {"name": 1, ANCESTORS_FIELD: 1}
+    ).to_list(None)
+    subtree_counts = {}
+    for document in category_documents:
+        for category_id in document[ANCESTORS_FIELD] + [document["_id"]]:
+            subtree_counts[category_id] = subtree_counts.get(category_id, 0) + counts[document["_id"]]
+    names = await db.categories.find(
+        {"_id": {"$in": list(subtree_counts)}}, {"name": 1}
+    ).to_list(None)
+    categories = [
+        {
+            "name": document["name"],
+            PART_COUNT_FIELD: counts.get(document["_id"], 0),
+            "subtree": {PART_COUNT_FIELD: subtree_counts[document["_id"]]},
+        }
+        for document in names
+    ]
+    categories.sort(key=lambda category: (-category["subtree"][PART_COUNT_FIELD], category["name"]))
+    return {
+        "threshold": threshold,
+        PART_COUNT_FIELD: sum(counts.values()),
+        "parts": result["parts"],
+        "categories": categories,
+    }
@@ -0,0 +1,114 @@
+import re
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+# Substring search is backed by n-grams: every searchable document stores the set of
+# character trigrams of its text fields in a multikey-indexed array.
+# A query's trigrams must all be present in a matching document, so the index narrows
+# the search down to a few candidates which are then checked against the actual substring.
+GRAM_LENGTH = 3
+GRAMS_FIELD = "search_grams"
+BACKFILL_BATCH_SIZE = 1000
+
+PART_SEARCH_FIELDS = ("serial_number", "name", "description", "location.room")
+
+# Relevance of a match in each field. Matching parts are ordered by the sum of the weights.
+SEARCH_WEIGHTS = {
+    "serial_number": 8,
+    "name": 4,
+    "category": 2,
+    "description": 1,
+    "location.room": 1,
+}
+
+
+def get_grams(text: str) -> set:
+    return {text[i:i + GRAM_LENGTH] for i in range(len(text) - GRAM_LENGTH + 1)}
+
+
+def get_field_value(document: dict, field: str):
+    for key in field.split("."):
+        document = document[key]
+    return document
+
+
+def get_part_grams(part_document: dict) -> list:
+    grams = set()
+    for field in PART_SEARCH_FIELDS:
+        grams |= get_grams(get_field_value(part_document, field))
+    return sorted(grams)
+
+
+def get_category_grams(category_document: dict) -> list:
+    return sorted(get_grams(category_document["name"]))
+
+
+def get_substring_filter(q: str, fields) -> dict:
+    """
+    Filter matching documents with q as a substring of any of the fields.
+    Uses the n-gram index, unless q is too short to have any n-grams.
+    """
+    pattern = re.escape(q)
+    substring_filter = {"$or": [{field: {"$regex": pattern}} for field in fields]}
+    grams = sorted(get_grams(q))
+    if len(grams) == 0:
+        return substring_filter
+    return {"$and": [{GRAMS_FIELD: {"$all": grams}}, substring_filter]}
+
+
+async def get_matching_category_ids(db: AsyncIOMotorDatabase, q: str) -> list:
+    cursor = db.categories.find(get_substring_filter(q, ["name"]), {"_id": 1})
+    return [document["_id"] async for document in cursor]
+
+
+def get_part_search_filter(q: str, matching_category_ids: list) -> dict:
+    return {
+        "$or": [
+            get_substring_filter(q, PART_SEARCH_FIELDS),
+            {"category": {"$in": matching_category_ids}},
+        ]
+    }
+
+
+def get_part_score_expression(q: str, matching_category_ids: list) -> dict:
+    """
+    Aggregation expression computing the relevance of a part matching q.
+    """
+    pattern = re.escape(q)
+    terms = []
+    for field, weight in SEARCH_WEIGHTS.items():
+        if field == "category":
+            matches = {"$in": ["$category", matching_category_ids]}
+        else:
+            matches = {"$regexMatch": {"input": f"${field}", "regex": pattern}}
+        terms.append({"$cond": [matches, weight, 0]})
+    return {"$add": terms}
+
+
+async def add_missing_search_grams(db: AsyncIOMotorDatabase):
+    """
+    Fills in the n-grams of documents written before search indexing existed.
+    """
+    collections = [(db.parts, get_part_grams), (db.categories, get_category_grams)]
+    for collection, get_document_grams in collections:
+        requests = []
+        async for document in collection.find({GRAMS_FIELD: {"$exists": False}}):
+            grams = get_document_grams(document)
+            requests.append(UpdateOne({"_id": document["_id"]}, {"$set": {GRAMS_FIELD: grams}}))
+            if len(requests) == BACKFILL_BATCH_SIZE:
+                await collection.bulk_write(requests, ordered=False)
+                requests = []
+        if len(requests) > 0:
+            await collection.bulk_write(requests, ordered=False)
+
+
+def get_part_score(part: dict, q: str) -> int:
+    """
+    Relevance of a part in its API representation (with the category name),
+    the same as computed by get_part_score_expression.
+    """
+    score = 0
+    for field, weight in SEARCH_WEIGHTS.items():
+        if q in get_field_value(part, field):
+            score += weight
+    return score
@@ -0,0 +1,105 @@
+import struct
+import zlib
+import bson
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+# A snapshot is a stream of concatenated BSON documents (each one starts with its int32 length).
+# A document with only the SECTION_KEY field starts the documents of the named collection,
+# every other document is stored in the database as it is, including its _id.
+SECTION_KEY = "$collection"
+COLLECTIONS = ("categories", "parts")
+
+GZIP_WBITS = 31  # zlib window bits selecting the gzip container
+BUFFER_SIZE = 64 * 1024
+IMPORT_BATCH_SIZE = 1000
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+async def iter_snapshot(db: AsyncIOMotorDatabase, compress: bool):
+    """
+    Yields the snapshot of all collections in chunks of roughly BUFFER_SIZE bytes,
+    reading the documents from cursors so the data set is never held in memory.
+    """
+    compressor = zlib.compressobj(wbits=GZIP_WBITS) if compress else None
+    buffer = bytearray()
+    for collection_name in COLLECTIONS:
+        buffer += bson.encode({SECTION_KEY: collection_name})
+        async for document in db[collection_name].find({}):
+            buffer += bson.encode(document)
+            if len(buffer) >= BUFFER_SIZE:
+                yield compressor.compress(buffer) if compress else bytes(buffer)
+                buffer.clear()
+
+    if compress:
+        yield compressor.compress(buffer) + compressor.flush()
+    else:
+        yield bytes(buffer)
+
+
+async def iter_snapshot_documents(chunks, compressed: bool):
+    """
+    Parses a snapshot from an async iterable of byte chunks.
+    Yields (collection name, document) pairs.
+    """
+    decompressor = zlib.decompressobj(wbits=GZIP_WBITS) if compressed else None
+    buffer = bytearray()
+    collection_name = None
+    async for chunk in chunks:
+        buffer += decompressor.decompress(chunk) if compressed else chunk
+        offset = 0
+        while len(buffer) - offset >= 4:
+            length, = struct.unpack_from("<i", buffer, offset)
+            if length < 5:
+                raise SnapshotError("invalid document length")
+            if len(buffer) - offset < length:
+                break
+            try:
+                document = bson.decode(bytes(buffer[offset:offset + length]))
+            except bson.errors.InvalidBSON as error:
+                raise SnapshotError(str(error)) from error
+            offset += length
+
+            if document.keys() == {SECTION_KEY}:
+                collection_name = document[SECTION_KEY]
+                if collection_name not in COLLECTIONS:
+                    raise SnapshotError(f"unknown collection {collection_name}")
+            elif collection_name is None:
+                raise SnapshotError("document outside of a collection section")
+            else:
+                yield collection_name, document
+        del buffer[:offset]
+
+    if compressed:
+        buffer += decompressor.flush()
+    if len(buffer) > 0:
+        raise SnapshotError("snapshot ends with an incomplete document")
+
+
+async def restore_snapshot(db: AsyncIOMotorDatabase, chunks, compressed: bool) -> dict:
+    """
+    Replaces the contents of all collections with the snapshot.
+    Documents are inserted in batches as they are parsed.
+    Returns the number of restored documents per collection.
+    """
+    for collection_name in COLLECTIONS:
+        await db[collection_name].delete_many({})
+
+    counts = {collection_name: 0 for collection_name in COLLECTIONS}
+    batch = []
+    batch_collection = None
+    async for collection_name, document in iter_snapshot_documents(chunks, compressed):
+        if collection_name != batch_collection or len(batch) == IMPORT_BATCH_SIZE:
+            if len(batch) > 0:
+                await db[batch_collection].insert_many(batch, ordered=False)
+                counts[batch_collection] += len(batch)
+            batch = []
+            batch_collection = collection_name
+        batch.append(document)
+
+    if len(batch) > 0:
+        await db[batch_collection].insert_many(batch, ordered=False)
+        counts[batch_collection] += len(batch)
+    return counts
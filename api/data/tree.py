@@ -0,0 +1,82 @@
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+# Besides parent_id, every category stores a materialized path: the ObjectIDs of all of its
+# ancestors, ordered from the root down to the parent. With an index on it, a whole subtree
+# can be found with one query, whatever its depth or fan-out.
+ANCESTORS_FIELD = "ancestors"
+
+
+def get_ancestors(parent_document: dict) -> list:
+    """
+    Materialized path of a category with the given parent (None for base categories).
+    """
+    if parent_document is None:
+        return []
+    return parent_document[ANCESTORS_FIELD] + [parent_document["_id"]]
+
+
+async def update_descendant_ancestors(db: AsyncIOMotorDatabase, category_id, new_ancestors: list):
+    """
+    Rewrites the paths of all descendants of a category which was moved under new ancestors.
+    """
+    requests = []
+    async for document in db.categories.find({ANCESTORS_FIELD: category_id}):
+        ancestors = document[ANCESTORS_FIELD]
+        below_category = ancestors[ancestors.index(category_id) + 1:]
+        requests.append(UpdateOne(
+            {"_id": document["_id"]},
+            {"$set": {ANCESTORS_FIELD: new_ancestors + [category_id] + below_category}},
+        ))
+    if len(requests) > 0:
+        await db.categories.bulk_write(requests, ordered=False)
+
+
+async def rebuild_ancestors(db: AsyncIOMotorDatabase):
+    """
+    Recomputes all materialized paths from parent_id with a single read,
+    e.g. for categories written before the paths existed. Only outdated paths are written.
+    """
+    documents = {}
+    async for document in db.categories.find({}, {"parent_id": 1, ANCESTORS_FIELD: 1}):
+        documents[document["_id"]] = document
+
+    paths = {}
+
+    def get_path(category_id) -> list:
+        # Iterative walk up the tree, also guards against parent_id cycles
+        chain = []
+        current_id = category_id
+        while current_id is not None and current_id not in paths and current_id not in chain:
+            chain.append(current_id)
+            parent_id = documents[current_id]["parent_id"] if current_id in documents else None
+            current_id = parent_id
+        path = paths.get(current_id, []) + ([current_id] if current_id in paths else [])
+        for chain_id in reversed(chain):
+            paths[chain_id] = path
+            path = path + [chain_id]
+        return paths[category_id]
+
+    requests = []
+    for category_id, document in documents.items():
+        path = get_path(category_id)
+        if document.get(ANCESTORS_FIELD) != path:
+            requests.append(UpdateOne({"_id": category_id}, {"$set": {ANCESTORS_FIELD: path}}))
+    if len(requests) > 0:
+        await db.categories.bulk_write(requests, ordered=False)
+
+
+def build_tree(documents: list) -> list:
+    """
+    Nests categories (with name and parent_id) into a list of base categories,
+    each with a list of children.
+    """
+    nodes = {document["_id"]: {"name": document["name"], "children": []} for document in documents}
+    roots = []
+    for document in documents:
+        parent_node = nodes.get(document["parent_id"])
+        if parent_node is None:
+            roots.append(nodes[document["_id"]])
+        else:
+            parent_node["children"].append(nodes[document["_id"]])
+    return roots
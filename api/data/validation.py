@@ -1,34 +1,36 @@
-from pymongo import database
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from fastapi import HTTPException, status
+from pymongo.errors import DuplicateKeyError
 
 # NOTE: This gets marked by pylint as an error but it's a false positive
 from .models import Category, Location, Part
+from .indexes import INDEXES, LOCATION_FIELDS
+from .tree import ANCESTORS_FIELD
+from .counters import PART_COUNT_FIELD
+from .mirror import InventoryMirror
 
+# The checks taking a mirror answer from it when one is given, without querying the database.
 
-# -------------------------- Validation of new data -------------------------- #
-
-
-def validate_category_unique_name(db: database, category: Category):
-    duplicate = db.categories.find_one({"name": category.name})
-    if duplicate is not None:
-        raise HTTPException(status.HTTP_409_CONFLICT, f"category {category.name} already exists")
 
-
-def validate_part_unique_serial(db: database, part: Part):
-    duplicate = db.parts.find_one({"serial_number": part.serial_number})
-    if duplicate is not None:
-        raise HTTPException(status.HTTP_409_CONFLICT, f"serial {part.serial_number} already exists")
+# -------------------------- Validation of new data -------------------------- #
 
 
-def validate_category_fields(db: database, category: Category):
+async def validate_category_fields(
+    db: AsyncIOMotorDatabase,
+    category: Category,
+    mirror: InventoryMirror = None
+):
     if category.parent_name == category.name:
         raise HTTPException(
             status.HTTP_400_BAD_REQUEST,
             "category parent name can't be same as category name"
         )
 
-    parent_category_document = db.categories.find_one({"name": category.parent_name})
-    if parent_category_document is None and category.parent_name != "":
+    if mirror is not None:
+        parent_exists = mirror.get_category_id(category.parent_name) is not None
+    else:
+        parent_exists = await db.categories.find_one({"name": category.parent_name}) is not None
+    if not parent_exists and category.parent_name != "":
         raise HTTPException(
             status.HTTP_400_BAD_REQUEST,
             f"parent category with name {category.parent_name} does not exist"
@@ -39,10 +41,20 @@ def validate_category_fields(db: database, category: Category):
 # -------------------------- Validation of existing documents -------------------------- #
 
 
-def validate_category_no_parts(db: database, category_document: dict):
+async def validate_category_no_parts(
+    db: AsyncIOMotorDatabase,
+    category_document: dict,
+    mirror: InventoryMirror = None
+):
     # Ensure that a category cannot be edited/removed if there are parts assigned to it.
-    part = db.parts.find_one({"category": category_document["_id"]})
-    if part is not None:
+    # Reads the part counter instead of the parts; cached category documents may have stale counters.
+    if mirror is not None:
+        has_parts = mirror.category_has_parts(category_document["_id"])
+    else:
+        has_parts = await db.categories.find_one(
+            {"_id": category_document["_id"], PART_COUNT_FIELD: {"$gt": 0}}, {"_id": 1}
+        ) is not None
+    if has_parts:
         category_name = category_document["name"]
         raise HTTPException(
             status.HTTP_400_BAD_REQUEST,
@@ -50,18 +62,37 @@ def validate_category_no_parts(db: database, category_document: dict):
         )
 
 
-def validate_category_children_have_no_parts(db: database, category_document: dict):
-    # Ensure that a parent category can't be removed if it has child categories with parts assigned.
-    cursor = db.categories.find({"parent_id": category_document["_id"]})
-    for child_document in cursor:
-        child_category_id = child_document["_id"]
-        child_part = db.parts.find_one({"category": child_category_id})
-        if child_part is not None:
-            name = category_document["name"]
-            raise HTTPException(
-                status.HTTP_400_BAD_REQUEST,
-                f"can't update/remove category {name}: child categories have parts assigned"
-            )
+async def validate_category_children_have_no_parts(
+    db: AsyncIOMotorDatabase,
+    category_document: dict,
+    mirror: InventoryMirror = None
+):
+    # Ensure that a parent category can't be removed if any category below it has parts assigned.
+    # A single query on the materialized paths and part counters covers the subtree at any depth.
+    if mirror is not None:
+        descendants_have_parts = mirror.subtree_has_parts(category_document["_id"])
+    else:
+        descendants_have_parts = await db.categories.find_one(
+            {ANCESTORS_FIELD: category_document["_id"], PART_COUNT_FIELD: {"$gt": 0}}, {"_id": 1}
+        ) is not None
+    if descendants_have_parts:
+        name = category_document["name"]
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            f"can't update/remove category {name}: child categories have parts assigned"
+        )
+
+
+def validate_category_parent_not_descendant(category_document: dict, parent_document: dict):
+    # Ensure that a category isn't moved below itself, which would detach its subtree in a cycle.
+    name = category_document["name"]
+    if parent_document["_id"] == category_document["_id"]:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"category {name} can't be its own parent")
+    if category_document["_id"] in parent_document[ANCESTORS_FIELD]:
+        raise HTTPException(
+            status.HTTP_400_BAD_REQUEST,
+            f"can't move category {name} under its own child category {parent_document['name']}"
+        )
 
 
 def validate_category_accepts_parts(category_document: dict):
@@ -74,11 +105,125 @@ def validate_category_accepts_parts(category_document: dict):
         )
 
 
-def validate_part_cuvette_not_taken(db: database, location: Location):
-    part_in_location = db.parts.find_one({"location": vars(location)})
-    if part_in_location is not None:
-        part_serial = part_in_location["serial_number"]
+def get_location_filter(location: Location) -> dict:
+    # Dotted field names let the query use the compound location index
+    return {f"location.{field}": value for field, value in vars(location).items()}
+
+
+def get_location_key(location: dict) -> tuple:
+    return tuple(location[field] for field in LOCATION_FIELDS)
+
+
+async def validate_part_cuvette_not_taken(
+    db: AsyncIOMotorDatabase,
+    location: Location,
+    exclude_serial: str = None,
+    mirror: InventoryMirror = None
+):
+    if mirror is not None:
+        part_serial = mirror.get_serial_at(get_location_key(vars(location)))
+        if part_serial == exclude_serial:
+            part_serial = None
+    else:
+        location_filter = get_location_filter(location)
+        if exclude_serial is not None:
+            location_filter["serial_number"] = {"$ne": exclude_serial}
+        part_in_location = await db.parts.find_one(location_filter)
+        part_serial = None if part_in_location is None else part_in_location["serial_number"]
+    if part_serial is not None:
         raise HTTPException(
             status.HTTP_400_BAD_REQUEST,
             f"another part (serial: {part_serial}) is already at location: {location}"
         )
+
+
+# -------------------------- Conflicts detected by unique indexes -------------------------- #
+# Uniqueness of serial numbers, locations and category names isn't checked before writing.
+# The unique indexes reject conflicting writes and the errors are translated here instead,
+# which saves the extra queries and can't be raced by concurrent requests.
+
+
+def get_duplicate_key_fields(error: DuplicateKeyError) -> set:
+    """
+    Returns the fields of the unique index which rejected a write.
+    """
+    key_pattern = (error.details or {}).get("keyPattern")
+    if key_pattern:
+        return set(key_pattern)
+    # Older servers only name the index in the error message
+    for declared_indexes in INDEXES.values():
+        for model in declared_indexes:
+            if f"index: {model.document['name']} " in str(error):
+                return set(model.document["key"])
+    return set()
+
+
+async def raise_part_conflict(
+    db: AsyncIOMotorDatabase,
+    part: Part,
+    error: DuplicateKeyError,
+    current_serial: str = None
+):
+    """
+    Translates a rejected write of part into an API error.
+    current_serial is the serial number of the part being updated, if any:
+    a part can't conflict with itself, even if an index reports so.
+    """
+    fields = get_duplicate_key_fields(error)
+    if "serial_number" in fields and part.serial_number != current_serial:
+        raise HTTPException(status.HTTP_409_CONFLICT, f"serial {part.serial_number} already exists")
+    # Report which part is in the way
+    await validate_part_cuvette_not_taken(db, part.location, exclude_serial=current_serial)
+    raise HTTPException(
+        status.HTTP_409_CONFLICT,
+        f"part {part.serial_number} conflicts with an existing part"
+    ) from error
+
+
+def raise_category_conflict(category: Category, error: DuplicateKeyError):
+    raise HTTPException(
+        status.HTTP_409_CONFLICT,
+        f"category {category.name} already exists"
+    ) from error
+
+
+async def get_bulk_part_conflicts(db: AsyncIOMotorDatabase, parts: dict) -> dict:
+    """
+    Explains why parts (keyed by their position in a bulk write) were rejected by the unique indexes.
+    Returns an HTTPException per position. Makes one query for all the serial numbers
+    and one for all the locations, instead of two queries per rejected part.
+    """
+    serials = list({part.serial_number for part in parts.values()})
+    taken_serials = set(await db.parts.distinct("serial_number", {"serial_number": {"$in": serials}}))
+
+    location_filters = [
+        get_location_filter(part.location)
+        for part in parts.values()
+        if part.serial_number not in taken_serials
+    ]
+    serials_by_location = {}
+    if len(location_filters) > 0:
+        cursor = db.parts.find({"$or": location_filters}, {"serial_number": 1, "location": 1})
+        async for document in cursor:
+            serials_by_location[get_location_key(document["location"])] = document["serial_number"]
+
+    errors = {}
+    for position, part in parts.items():
+        if part.serial_number in taken_serials:
+            errors[position] = HTTPException(
+                status.HTTP_409_CONFLICT,
+                f"serial {part.serial_number} already exists"
+            )
+        elif get_location_key(vars(part.location)) in serials_by_location:
+            occupying_serial = serials_by_location[get_location_key(vars(part.location))]
+            errors[position] = HTTPException(
+                status.HTTP_400_BAD_REQUEST,
+                f"another part (serial: {occupying_serial}) "
+                f"is already at location: {part.location}"
+            )
+        else:
+            errors[position] = HTTPException(
+                status.HTTP_409_CONFLICT,
+                f"part {part.serial_number} conflicts with an existing part"
+            )
+    return errors
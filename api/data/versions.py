@@ -0,0 +1,77 @@
+import asyncio
+from bson.objectid import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReturnDocument
+
+# Every write endpoint increments the version of the collections it changed.
+# A version document also holds the epoch it was created in, so versions can't repeat
+# even if the document is removed and the counting starts over.
+# Responses carry an ETag made of the versions of the collections they were read from.
+VERSIONED_COLLECTIONS = ("categories", "parts")
+DEFAULT_VERSION = ("0", 0)  # of collections which were never written to
+
+
+async def bump_versions(db: AsyncIOMotorDatabase, *collection_names) -> dict:
+    """
+    Increments the versions of the collections and returns them, as (epoch, version) pairs.
+    """
+    documents = await asyncio.gather(*[
+        db.versions.find_one_and_update(
+            {"_id": collection_name},
+            {"$inc": {"version": 1}, "$setOnInsert": {"epoch": str(ObjectId())}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        for collection_name in collection_names
+    ])
+    return {document["_id"]: get_version(document) for document in documents}
+
+
+def get_version(document: dict) -> tuple:
+    return document["epoch"], document["version"]
+
+
+async def get_versions(db: AsyncIOMotorDatabase, collection_names) -> dict:
+    versions = dict.fromkeys(collection_names, DEFAULT_VERSION)
+    async for document in db.versions.find({"_id": {"$in": list(collection_names)}}):
+        versions[document["_id"]] = get_version(document)
+    return versions
+
+
+def is_at_least(versions: dict, target: dict) -> bool:
+    """
+    Whether versions include all the changes counted in target.
+    Versions of different epochs can't be compared, so they never include each other.
+    """
+    for collection_name, (target_epoch, target_version) in target.items():
+        epoch, version = versions.get(collection_name, DEFAULT_VERSION)
+        if epoch != target_epoch or version < target_version:
+            return False
+    return True
+
+
+def format_etag(versions: dict, collection_names: tuple, variant: str = "") -> str:
+    """
+    Weak ETag of a representation read from the given collections.
+    variant tells apart different representations of the same data (e.g. media types).
+    """
+    tags = [variant] if variant else []
+    for collection_name in collection_names:
+        epoch, version = versions.get(collection_name, DEFAULT_VERSION)
+        tags.append(f"{epoch}.{version}")
+    return 'W/"' + "-".join(tags) + '"'
+
+
+async def get_etag(db: AsyncIOMotorDatabase, collection_names: tuple, variant: str = "") -> str:
+    # One query, on the versions collection only
+    return format_etag(await get_versions(db, collection_names), collection_names, variant)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison: W/ prefixes are ignored
+    def opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    tags = [opaque(tag) for tag in if_none_match.split(",")]
+    return "*" in tags or opaque(etag) in tags
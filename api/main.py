@@ -1,31 +1,158 @@
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+import time
+import zlib
+from contextlib import asynccontextmanager
 from typing import Annotated
-from fastapi import FastAPI, status, HTTPException, Depends, Query
-from pymongo import MongoClient, ReturnDocument, database
+from fastapi import FastAPI, status, HTTPException, Depends, Query, Header, Request
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pydantic import ValidationError
+from pymongo import ReturnDocument, InsertOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError, PyMongoError
 
-from .data.models import Part, Category
-from .data import validation
+from .data.models import Part, Category, PartSerials, QuantityAdjustment, MAX_BATCH_SIZE, MAX_INT32
+from .data import validation, indexes, search, snapshot, tree, counters, occupancy, metrics
+from .data import serialization, connection, versions, mirror, filters, reports, adjustments, limits
+from .data import generator
+from .data.cache import CategoryCache
 from .tests.example_data import add_test_data
 
 tags_metadata = [
     {"name": "parts"},
     {"name": "categories"},
+    {"name": "locations"},
+    {"name": "reports"},
     {"name": "extra"},
+    {"name": "health"},
 ]
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
-# -------------------------- Init database -------------------------- #
+# Set in the lifespan handler, so importing the app doesn't need a database
+client = None
+_database = None
+maintenance_status = "not started"
 
-with open('connect_info.txt', 'r', encoding="utf-8") as file:
-    connection_string = file.readline()
-    db_name = file.readline()
+category_cache = CategoryCache()
+# How long reads may use the category cache without checking for category writes of other workers
+CATEGORY_CACHE_MAX_AGE_SECONDS = float(os.environ.get("CATEGORY_CACHE_MAX_AGE_MS", "1000")) / 1000
+occupancy_index = occupancy.OccupancyIndex()
+
+# Opt-in in-memory copy of the inventory which reads are served from, see api/data/mirror.py
+MIRROR_ENABLED = os.environ.get("INVENTORY_MIRROR", "false").lower() == "true"
+MIRROR_POLLING = os.environ.get("MIRROR_POLLING", "false").lower() == "true"
+MIRROR_POLL_SECONDS = float(os.environ.get("MIRROR_POLL_SECONDS", "1"))
+MIRROR_WAIT_SECONDS = 1
+inventory_mirror = mirror.InventoryMirror()
+
+
+async def repair_derived_data(db: AsyncIOMotorDatabase):
+    """
+    Recomputes the search grams, category paths and counters and the location occupancy
+    of the data as it is in the database.
+    """
+    await search.add_missing_search_grams(db)
+    await tree.rebuild_ancestors(db)
+    await counters.reconcile_part_counters(db)
+    await occupancy.rebuild_occupancy(db, occupancy_index)
+
+
+async def run_startup_maintenance(db: AsyncIOMotorDatabase):
+    """
+    Reconciles the indexes and repairs derived data (search grams, category paths and counters,
+    location occupancy). Runs in the background, the app reports ready once it's done.
+    """
+    global maintenance_status
+    maintenance_status = "running"
+    try:
+        await indexes.ensure_indexes(db)
+        await repair_derived_data(db)
+        # Repairs may have changed what the reads return
+        await record_write(db, *versions.VERSIONED_COLLECTIONS)
+    except Exception:
+        maintenance_status = "failed"
+        logger.exception("startup maintenance failed")
+    else:
+        maintenance_status = "done"
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global client, _database, maintenance_status
+    connection_string, db_name = connection.get_connection_info()
+    client = connection.create_client(connection_string, [metrics.command_timer])
+    _database = client[db_name]
+
+    # Several workers sharing a database only need one of them to do the maintenance
+    maintenance_task = None
+    if os.environ.get("STARTUP_MAINTENANCE", "true").lower() == "false":
+        maintenance_status = "skipped"
+    else:
+        maintenance_task = asyncio.create_task(run_startup_maintenance(_database))
+    mirror_task = None
+    if MIRROR_ENABLED:
+        mirror_task = asyncio.create_task(
+            inventory_mirror.run(_database, MIRROR_POLL_SECONDS, MIRROR_POLLING)
+        )
+    yield
+    for task in (maintenance_task, mirror_task):
+        if task is not None:
+            task.cancel()
+    inventory_mirror.clear()
+    client.close()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=serialization.FastJSONResponse)
+
+# Opt-in concurrency limits per class of routes, see api/data/limits.py.
+# Point reads, listings and writes are limited separately, so slow listings can't hold up point reads.
+ROUTE_CLASSES = ("point_reads", "listings", "writes")
+POINT_READ_ROUTES = {
+    ("GET", "/parts/{serial_number}"),
+    ("POST", "/parts/batch"),
+    ("GET", "/categories/{name}"),
+    ("GET", "/categories/{name}/stats"),
+    ("GET", "/locations/free"),
+}
+UNLIMITED_ROUTES = {"/health/live", "/health/ready", "/metrics"}
+CONCURRENCY_QUEUE_SECONDS = float(os.environ.get("CONCURRENCY_QUEUE_MS", "1000")) / 1000
+concurrency_limits = limits.get_limits_from_env(ROUTE_CLASSES, CONCURRENCY_QUEUE_SECONDS)
+
+
+def get_route_class(method: str, route_path: str | None) -> str | None:
+    if route_path in UNLIMITED_ROUTES:
+        return None
+    if (method, route_path) in POINT_READ_ROUTES:
+        return "point_reads"
+    if method in ("GET", "HEAD"):
+        return "listings"
+    return "writes"
+
+
+app.add_middleware(
+    limits.ConcurrencyLimitMiddleware,
+    routes=app.router.routes,
+    get_route_class=get_route_class,
+    limits=concurrency_limits,
+)
+
+# Opt-in log of requests slower than SLOW_REQUEST_MS milliseconds, with their query shapes
+slow_request_ms = os.environ.get("SLOW_REQUEST_MS")
+app.add_middleware(
+    metrics.MetricsMiddleware,
+    slow_request_seconds=float(slow_request_ms) / 1000 if slow_request_ms else None,
+)
 
-client = MongoClient(connection_string)
-_database = client[db_name]
-_database.categories.create_index({"$**": "text"})  # all text fields
 
 # Dependency - note that this is ran each time a function with Depends is called
-def get_db():
+async def get_db():
+    if _database is None:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "database is not connected")
     try:
         yield _database
     finally:
@@ -35,129 +162,825 @@ def get_db():
 # -------------------------- Utilities -------------------------- #
 
 
-def get_category_document(db: database, search_dict: dict):
-    result = db.categories.find_one(search_dict)
+async def gather_checks(*checks):
+    """
+    Runs independent validation coroutines concurrently.
+    If several of them fail, the error of the first one in argument order is raised,
+    so the API reports the same error as when the checks were ran one after another.
+    """
+    results = await asyncio.gather(*checks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def check_category_cache(db: AsyncIOMotorDatabase, max_age: float = None):
+    """
+    Clears the category cache if the categories changed since it was filled, also in other workers.
+    The version is read at most every max_age seconds (CATEGORY_CACHE_MAX_AGE_SECONDS by default);
+    writes pass 0, so they never act on a category which no longer exists.
+    """
+    if max_age is None:
+        max_age = CATEGORY_CACHE_MAX_AGE_SECONDS
+    if not category_cache.needs_check(max_age):
+        return
+    checked_at = time.monotonic()
+    source = get_mirror()
+    if source is not None and max_age > 0:
+        version = source.versions.get("categories", versions.DEFAULT_VERSION)
+    else:
+        version = (await versions.get_versions(db, ("categories",)))["categories"]
+    category_cache.check_version(version, checked_at)
+
+
+async def get_category_document(db: AsyncIOMotorDatabase, search_dict: dict, max_age: float = None):
+    # Lookups by a single ID or name go through the cache, anything else hits the database
+    await check_category_cache(db, max_age)
+    result = None
+    if search_dict.keys() == {"_id"}:
+        result = category_cache.get_by_id(search_dict["_id"])
+    elif search_dict.keys() == {"name"}:
+        result = category_cache.get_by_name(search_dict["name"])
+
     if result is None:
-        raise HTTPException(
-            status.HTTP_404_NOT_FOUND,
-            f"category {search_dict} does not exist"
-        )
+        result = await db.categories.find_one(search_dict)
+        if result is None:
+            raise HTTPException(
+                status.HTTP_404_NOT_FOUND,
+                f"category {search_dict} does not exist"
+            )
+        category_cache.put(result)
     return result
 
 
-def get_part_document(db: database, search_dict: dict):
-    result = db.parts.find_one(search_dict)
-    if result is None:
+async def get_part_category_document(db: AsyncIOMotorDatabase, name: str):
+    category_document = await get_category_document(db, {"name": name}, max_age=0)
+    validation.validate_category_accepts_parts(category_document)
+    return category_document
+
+
+async def get_category_names(db: AsyncIOMotorDatabase, category_ids) -> dict:
+    """
+    Maps category ObjectIDs to category names.
+    Uses the cache and fetches all the missing categories with a single query.
+    """
+    await check_category_cache(db)
+    names = {}
+    missing_ids = []
+    for category_id in set(category_ids):
+        document = category_cache.get_by_id(category_id)
+        if document is None:
+            missing_ids.append(category_id)
+        else:
+            names[category_id] = document["name"]
+
+    if len(missing_ids) > 0:
+        async for document in db.categories.find({"_id": {"$in": missing_ids}}):
+            category_cache.put(document)
+            names[document["_id"]] = document["name"]
+
+    for category_id in missing_ids:
+        if category_id not in names:
+            raise HTTPException(
+                status.HTTP_404_NOT_FOUND,
+                f"category {{'_id': {category_id!r}}} does not exist"
+            )
+    return names
+
+
+async def get_category_documents_by_name(
+    db: AsyncIOMotorDatabase, names, max_age: float = None
+) -> dict:
+    """
+    Maps category names to category documents, skipping names which don't exist.
+    Uses the cache and fetches all the missing categories with a single query.
+    """
+    await check_category_cache(db, max_age)
+    documents = {}
+    missing_names = []
+    for name in set(names):
+        document = category_cache.get_by_name(name)
+        if document is None:
+            missing_names.append(name)
+        else:
+            documents[name] = document
+
+    if len(missing_names) > 0:
+        async for document in db.categories.find({"name": {"$in": missing_names}}):
+            category_cache.put(document)
+            documents[document["name"]] = document
+    return documents
+
+
+async def get_occupancy_index(db: AsyncIOMotorDatabase) -> occupancy.OccupancyIndex:
+    # Reloaded when the parts changed in another process; the version is read first,
+    # so the loaded bitmaps are at least as new as it
+    version = (await versions.get_versions(db, ("parts",)))["parts"]
+    if not occupancy_index.is_current(version):
+        occupancy_index.load(await db.occupancy.find({}).to_list(None), version)
+    return occupancy_index
+
+
+def get_mirror() -> mirror.InventoryMirror | None:
+    # The mirror serves reads only once it's loaded and has this process's writes
+    return inventory_mirror if inventory_mirror.current else None
+
+
+async def record_write(db: AsyncIOMotorDatabase, *collection_names):
+    """
+    Bumps the versions of the changed collections.
+    With the mirror, waits for it to catch up, so a client reads its own writes.
+    """
+    new_versions = await versions.bump_versions(db, *collection_names)
+    if "parts" in new_versions:
+        occupancy_index.follow_write(new_versions["parts"])
+    if inventory_mirror.loaded:
+        await inventory_mirror.wait_for(db, new_versions, MIRROR_WAIT_SECONDS)
+
+
+async def flush_adjustments(db: AsyncIOMotorDatabase, items: list) -> list:
+    # One version bump for all adjustments flushed together
+    results = await adjustments.apply_adjustments(db, items)
+    if any(not isinstance(result, HTTPException) for result in results):
+        await record_write(db, "parts")
+    return results
+
+
+# Opt-in coalescing of stock adjustments arriving within ADJUST_COALESCE_MS milliseconds
+ADJUST_COALESCE_SECONDS = float(os.environ.get("ADJUST_COALESCE_MS", "0")) / 1000
+adjustment_coalescer = adjustments.AdjustmentCoalescer(ADJUST_COALESCE_SECONDS, flush_adjustments)
+
+
+async def check_not_modified(
+    db: AsyncIOMotorDatabase,
+    if_none_match: str | None,
+    collection_names: tuple,
+    variant: str = "",
+    source: mirror.InventoryMirror = None
+) -> str:
+    """
+    Returns the ETag of a read from the given collections,
+    or answers with 304 Not Modified if the client already has it.
+    The ETag is computed before the data is read, so a concurrent write can only make it stale.
+    Reads served from the mirror use the versions of the mirrored data instead.
+    The category cache is checked against the same categories version, so cached categories
+    are never older than the ETag.
+    """
+    checked_at = time.monotonic()
+    if source is not None:
+        current = source.versions
+    else:
+        current = await versions.get_versions(db, collection_names)
+    if "categories" in collection_names:
+        category_cache.check_version(
+            current.get("categories", versions.DEFAULT_VERSION), checked_at
+        )
+    etag = versions.format_etag(current, collection_names, variant)
+    if if_none_match is not None and versions.etag_matches(if_none_match, etag):
+        raise HTTPException(status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return etag
+
+
+def part_to_document(part: Part, category_id) -> dict:
+    """
+    Database representation of a part: the category is referenced by its ObjectID
+    and the search n-grams are stored alongside the fields.
+    """
+    part_document = part.model_dump()
+    part_document["category"] = category_id
+    part_document[search.GRAMS_FIELD] = search.get_part_grams(part_document)
+    return part_document
+
+
+def category_response(category_document: dict, parent_name: str) -> dict:
+    # The API representation uses the parent name instead of the parent ObjectID
+    return {"name": category_document["name"], "parent_name": parent_name}
+
+
+# Only the model fields leave the database, internal fields (like search n-grams) are dropped
+PART_FIELDS = tuple(Part.model_fields)
+PART_PROJECTION = {"_id": 0, **{field: 1 for field in PART_FIELDS}}
+CATEGORY_FIELDS = ("name", "parent_name")
+CATEGORY_STATS_FIELDS = (
+    "name", counters.PART_COUNT_FIELD, counters.TOTAL_QUANTITY_FIELD, "subtree"
+)
+
+
+def parse_fields(fields: str | None, allowed: tuple) -> tuple | None:
+    """
+    Parses a comma-separated fields parameter into the requested fields, in the order of allowed.
+    Returns None when the parameter is missing, meaning all fields.
+    """
+    if fields is None:
+        return None
+    requested = {field for field in fields.split(",") if field != ""}
+    unknown = requested - set(allowed)
+    if len(requested) == 0 or len(unknown) > 0:
         raise HTTPException(
-            status.HTTP_404_NOT_FOUND,
-            f"part {search_dict} does not exist"
+            status.HTTP_400_BAD_REQUEST,
+            f"invalid fields: {fields}, choose from: {', '.join(allowed)}"
         )
-    return result
+    return tuple(field for field in allowed if field in requested)
+
+
+def get_fields_variant(fields: tuple | None) -> str:
+    # Representations with different fields get different ETags
+    return "" if fields is None else "fields=" + ",".join(fields)
+
+
+def project(document: dict, fields: tuple | None) -> dict:
+    # Keeps the order of the document, like a MongoDB projection
+    if fields is None:
+        return document
+    return {field: value for field, value in document.items() if field in fields}
+
+
+def part_read_pipeline(
+    match: dict,
+    limit: int = 0,
+    sort: dict = None,
+    score: dict = None,
+    after: dict = None,
+    fields: tuple = None
+) -> list:
+    """
+    Aggregation pipeline returning parts in their API representation.
+    The category name is joined on the server, so reading parts takes a single round trip.
+
+    score is an optional relevance expression stored in the temporary score field,
+    which can then be used in sort and in the after filter.
+    fields limits the returned fields (all model fields by default; "score" can be included too).
+    The categories are only joined if the category is one of them.
+    """
+    pipeline = [{"$match": match}]
+    if score is not None:
+        pipeline.append({"$set": {"score": score}})
+    if after is not None:
+        pipeline.append({"$match": after})
+    if sort is not None:
+        pipeline.append({"$sort": sort})
+    if limit > 0:
+        pipeline.append({"$limit": limit})
+    if fields is None or "category" in fields:
+        pipeline += [
+            {"$lookup": {
+                "from": "categories",
+                "localField": "category",
+                "foreignField": "_id",
+                "as": "_category",
+            }},
+            {"$set": {"category": {"$arrayElemAt": ["$_category.name", 0]}}},
+        ]
+    projection = PART_PROJECTION
+    if fields is not None:
+        projection = {"_id": 0, **{field: 1 for field in fields}}
+    pipeline.append({"$project": projection})
+    return pipeline
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+MAX_PAGE_SIZE = 1000
+BULK_CHUNK_SIZE = 1000
+DUPLICATE_KEY_ERROR_CODE = 11000
+HEALTH_PING_TIMEOUT_SECONDS = 2
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def encode_cursor(sort_values: list) -> str:
+    return base64.urlsafe_b64encode(serialization.encode_json(sort_values)).decode("ascii")
+
+
+def decode_cursor(cursor: str, sort_keys: list) -> list:
+    # Cursors hold the sort key values of the last returned document
+    try:
+        sort_values = json.loads(base64.b64decode(cursor, altchars=b"-_", validate=True))
+    except (binascii.Error, ValueError) as error:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"invalid cursor: {cursor}") from error
+    if (
+        not isinstance(sort_values, list)
+        or len(sort_values) != len(sort_keys)
+        or not all(
+            filters.is_sort_value(field, value) for (field, _), value in zip(sort_keys, sort_values)
+        )
+    ):
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"invalid cursor: {cursor}")
+    return sort_values
+
+
+async def stream_parts(first_document: dict, cursor, ndjson: bool):
+    """
+    Encodes parts as they arrive from the cursor, either as a JSON array or as newline-delimited JSON.
+    Encoded parts are sent in chunks of about STREAM_CHUNK_SIZE bytes.
+    """
+    separator = b"\n" if ndjson else b","
+    try:
+        buffer = bytearray() if ndjson else bytearray(b"[")
+        buffer += serialization.encode_part(first_document)
+        async for document in cursor:
+            if len(buffer) >= STREAM_CHUNK_SIZE:
+                yield bytes(buffer + separator)
+                buffer.clear()
+            else:
+                buffer += separator
+            buffer += serialization.encode_part(document)
+        buffer += b"\n" if ndjson else b"]"
+        yield bytes(buffer)
+    finally:
+        await cursor.close()
+
+
+async def read_parts_by_serial(
+    db: AsyncIOMotorDatabase,
+    serial_numbers: list,
+    source: mirror.InventoryMirror = None,
+    fields: tuple = None
+) -> dict:
+    """
+    Fetches the parts with the given serial numbers with a single query
+    (which also joins their categories), in the requested order.
+    Serial numbers of parts which don't exist are listed as missing.
+    """
+    serial_numbers = list(dict.fromkeys(serial_numbers))
+    if source is not None:
+        parts = {serial: source.get_part(serial) for serial in serial_numbers}
+        parts = {serial: part for serial, part in parts.items() if part is not None}
+    else:
+        # The serial numbers are needed to match the parts to the request
+        read_fields = None if fields is None else ("serial_number", *fields)
+        serial_filter = {"serial_number": {"$in": serial_numbers}}
+        pipeline = part_read_pipeline(serial_filter, fields=read_fields)
+        cursor = db.parts.aggregate(pipeline)
+        parts = {document["serial_number"]: document async for document in cursor}
+    return {
+        "parts": [project(parts[serial], fields) for serial in serial_numbers if serial in parts],
+        "missing": [serial for serial in serial_numbers if serial not in parts],
+    }
+
+
+def get_sort_values(part: dict, sort_keys: list, q: str | None) -> list:
+    sort_values = []
+    for field, _ in sort_keys:
+        if field == filters.SCORE_FIELD and field not in part:
+            sort_values.append(search.get_part_score(part, q))
+        else:
+            sort_values.append(part[field])
+    return sort_values
+
+
+def parts_page_response(
+    results: list,
+    q: str | None,
+    sort_keys: list,
+    limit: int | None,
+    after: str | None,
+    ndjson: bool,
+    headers: dict,
+    fields: tuple = None,
+    facets: dict = None
+) -> Response:
+    """
+    Encodes the parts read for GET /parts, with the facet counts if there are any.
+    With limit, results hold one part more than the page if there is a next page.
+    Fields besides the requested ones, which are read for the cursor, are dropped here.
+    """
+    if len(results) == 0 and after is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "no parts match the query")
+
+    if limit is not None and len(results) > limit:
+        results = results[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(get_sort_values(results[-1], sort_keys, q))
+    if fields is not None:
+        results = [project(document, fields) for document in results]
+
+    if facets is not None:
+        return serialization.FastJSONResponse({"parts": results, "facets": facets}, headers=headers)
+
+    if ndjson:
+        content = b"".join(serialization.encode_part(document) + b"\n" for document in results)
+        return Response(content, media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    content = serialization.encode_parts(results)
+    return Response(content, media_type="application/json", headers=headers)
+
+
+async def iter_request_items(request: Request):
+    """
+    Yields the items of a JSON array or, with the NDJSON content type,
+    the lines of newline-delimited JSON as they are received.
+    Lines which aren't valid JSON are yielded as ValueError instances.
+    """
+    if NDJSON_MEDIA_TYPE not in request.headers.get("content-type", ""):
+        try:
+            items = json.loads(await request.body())
+        except ValueError as error:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, "request body is not valid JSON") from error
+        if not isinstance(items, list):
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, "request body must be a JSON array")
+        for item in items:
+            yield item
+        return
+
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield parse_ndjson_line(line)
+    if buffer.strip():
+        yield parse_ndjson_line(buffer)
+
+
+def parse_ndjson_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError as error:
+        return error
+
+
+def bulk_item_result(position: int, serial_number, error: HTTPException = None) -> dict:
+    if error is None:
+        return {"index": position, "serial_number": serial_number, "status_code": status.HTTP_200_OK}
+    return {
+        "index": position,
+        "serial_number": serial_number,
+        "status_code": error.status_code,
+        "detail": error.detail,
+    }
+
+
+async def create_parts_chunk(db: AsyncIOMotorDatabase, chunk: list) -> list:
+    """
+    Validates and inserts a chunk of (position, item) pairs of a bulk import.
+    Categories are resolved with one query and the parts are inserted with one unordered bulk write.
+    Returns a result for every item, in the same order.
+    """
+    results = {}
+    parts = {}
+    for position, item in chunk:
+        serial_number = item.get("serial_number") if isinstance(item, dict) else None
+        if isinstance(item, ValueError):
+            error = HTTPException(status.HTTP_400_BAD_REQUEST, "invalid JSON")
+            results[position] = bulk_item_result(position, None, error)
+            continue
+        try:
+            parts[position] = Part.model_validate(item)
+        except ValidationError as validation_error:
+            details = validation_error.errors(
+                include_url=False, include_context=False, include_input=False
+            )
+            error = HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, details)
+            results[position] = bulk_item_result(position, serial_number, error)
+
+    category_names = {part.category for part in parts.values()}
+    category_documents = await get_category_documents_by_name(db, category_names, max_age=0)
+    part_documents = {}
+    for position, part in parts.items():
+        try:
+            category_document = category_documents.get(part.category)
+            if category_document is None:
+                raise HTTPException(
+                    status.HTTP_404_NOT_FOUND,
+                    f"category { {'name': part.category} } does not exist"
+                )
+            validation.validate_category_accepts_parts(category_document)
+        except HTTPException as error:
+            results[position] = bulk_item_result(position, part.serial_number, error)
+            continue
+        part_documents[position] = part_to_document(part, category_document["_id"])
+
+    # Serial number and location conflicts are detected by the unique indexes
+    positions = list(part_documents)
+    rejected_parts = {}
+    write_errors = {}
+    if len(positions) > 0:
+        requests = [InsertOne(part_documents[position]) for position in positions]
+        try:
+            await db.parts.bulk_write(requests, ordered=False)
+        except BulkWriteError as bulk_error:
+            for write_error in bulk_error.details["writeErrors"]:
+                position = positions[write_error["index"]]
+                if write_error["code"] == DUPLICATE_KEY_ERROR_CODE:
+                    rejected_parts[position] = parts[position]
+                else:
+                    write_errors[position] = HTTPException(
+                        status.HTTP_500_INTERNAL_SERVER_ERROR, write_error["errmsg"]
+                    )
+
+    inserted_documents = [
+        part_documents[position]
+        for position in positions
+        if position not in rejected_parts and position not in write_errors
+    ]
+    await counters.update_part_counters(db, added=inserted_documents)
+    await occupancy.update_occupancy(
+        db, occupancy_index, taken=[document["location"] for document in inserted_documents]
+    )
+    if len(inserted_documents) > 0:
+        await record_write(db, "parts")
+
+    if len(rejected_parts) > 0:
+        write_errors.update(await validation.get_bulk_part_conflicts(db, rejected_parts))
+    for position in positions:
+        error = write_errors.get(position)
+        results[position] = bulk_item_result(position, parts[position].serial_number, error)
+    return [results[position] for position, _ in chunk]
 
 
 # -------------------------- Parts -------------------------- #
 
 
 @app.post("/parts", tags=["parts"])
-def create_part(part: Part, db: database = Depends(get_db)):
-    category_document = get_category_document(db, {"name": part.category})
-    validation.validate_category_accepts_parts(category_document)
-    validation.validate_part_unique_serial(db, part)
-    validation.validate_part_cuvette_not_taken(db, part.location)
+async def create_part(part: Part, db: AsyncIOMotorDatabase = Depends(get_db)):
+    # Serial number and location conflicts are detected by the unique indexes on write
+    category_document = await get_part_category_document(db, part.category)
+    # Known taken slots are reported without attempting the write
+    if occupancy_index.is_taken(vars(part.location)):
+        await validation.validate_part_cuvette_not_taken(db, part.location, mirror=get_mirror())
 
-    # Create a part dict
-    part_document = vars(part)
-    part_document["location"] = vars(part_document["location"])
+    part_document = part_to_document(part, category_document["_id"])
+    try:
+        await db.parts.insert_one(part_document)  # NOTE this implicitly adds _id to part_document
+    except DuplicateKeyError as error:
+        await validation.raise_part_conflict(db, part, error)
+    await counters.update_part_counters(db, added=[part_document])
+    await occupancy.update_occupancy(db, occupancy_index, taken=[part_document["location"]])
+    await record_write(db, "parts")
 
-    # Add category ID for the database representation
-    part_document["category"] = category_document["_id"]
-    db.parts.insert_one(part_document)  # NOTE this implicitly adds _id to part_document
+    return part.model_dump()
 
-    # Replace ObjectIDs with string names for the API and remove the unnecessary ones
-    part_document["category"] = category_document["name"]
-    del part_document["_id"]
-    return part_document
+
+@app.post("/parts/bulk", tags=["parts"])
+async def create_parts_bulk(request: Request, db: AsyncIOMotorDatabase = Depends(get_db)):
+    """
+    Creates many parts at once from a JSON array of parts,
+    or from newline-delimited JSON with the `application/x-ndjson` content type.
+    Parts are validated and inserted in chunks; a failing part doesn't stop the others.
+    Returns the number of inserted and failed parts and a result for every part.
+    """
+    results = []
+    chunk = []
+    async for item in iter_request_items(request):
+        chunk.append((len(results) + len(chunk), item))
+        if len(chunk) == BULK_CHUNK_SIZE:
+            results += await create_parts_chunk(db, chunk)
+            chunk = []
+    if len(chunk) > 0:
+        results += await create_parts_chunk(db, chunk)
+
+    inserted = sum(1 for result in results if result["status_code"] == status.HTTP_200_OK)
+    return {"inserted": inserted, "failed": len(results) - inserted, "results": results}
+
+
+@app.post("/parts/batch", tags=["parts"])
+async def read_parts_batch(
+    request: PartSerials,
+    fields: str | None = None,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Fetches many parts by their serial numbers at once.
+    Returns the found parts in the requested order and the serial numbers which don't exist.
+    """
+    part_fields = parse_fields(fields, PART_FIELDS)
+    return await read_parts_by_serial(db, request.serial_numbers, get_mirror(), part_fields)
 
 
 @app.get("/parts/{serial_number}", tags=["parts"])
-def read_part(serial_number: str, db: database = Depends(get_db)):
+async def read_part(
+    serial_number: str,
+    fields: str | None = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """
     Fetches data of the part with the requested serial number.
+    Returns only the comma-separated `fields` if given, e.g. `serial_number,quantity`.
     """
-    part_document = get_part_document(db, {"serial_number": serial_number})
-    category_document = get_category_document(db, {"_id": part_document["category"]})
-
-    # Replace ObjectIDs with string names for the API and remove the unnecessary ones
-    part_document["category"] = category_document["name"]
-    del part_document["_id"]
-    return part_document
+    part_fields = parse_fields(fields, PART_FIELDS)
+    source = get_mirror()
+    etag = await check_not_modified(
+        db, if_none_match, ("parts", "categories"), get_fields_variant(part_fields), source
+    )
+    search_dict = {"serial_number": serial_number}
+    if source is not None:
+        results = [part for part in [source.get_part(serial_number)] if part is not None]
+    else:
+        pipeline = part_read_pipeline(search_dict, limit=1, fields=part_fields)
+        results = await db.parts.aggregate(pipeline).to_list(None)
+    if len(results) == 0:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, f"part {search_dict} does not exist")
+    return Response(
+        serialization.encode_part(project(results[0], part_fields)),
+        media_type="application/json",
+        headers={"ETag": etag},
+    )
 
 
 @app.get("/parts", tags=["parts"])
-def read_parts(q: Annotated[str | None, Query(max_length=50)] = None, db: database = Depends(get_db)):
+async def read_parts(
+    q: Annotated[str | None, Query(max_length=50)] = None,
+    limit: Annotated[int | None, Query(ge=1, le=MAX_PAGE_SIZE)] = None,
+    after: Annotated[str | None, Query(max_length=100)] = None,
+    serials: str | None = None,
+    fields: str | None = None,
+    sort: Annotated[str | None, Query(max_length=20)] = None,
+    facets: Annotated[str | None, Query(max_length=50)] = None,
+    price: Annotated[str | None, Query(max_length=50)] = None,
+    quantity: Annotated[str | None, Query(max_length=50)] = None,
+    room: Annotated[str | None, Query(max_length=50)] = None,
+    bookcase: Annotated[str | None, Query(max_length=50)] = None,
+    shelf: Annotated[str | None, Query(max_length=50)] = None,
+    cuvette: Annotated[str | None, Query(max_length=50)] = None,
+    column: Annotated[str | None, Query(max_length=50)] = None,
+    row: Annotated[str | None, Query(max_length=50)] = None,
+    accept: Annotated[str | None, Header()] = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """
     Searches parts using their text fields.
     Fetches all parts if no search query is supplied.
+
+    Search results are ordered by relevance, in which a match in the serial number
+    counts the most, followed by the name, the category, the description and the room.
+
+    With `limit`, returns one page of parts ordered by relevance and serial number.
+    The `X-Next-Cursor` response header holds the `after` value for the next page.
+    Without `limit`, all matching parts are streamed as they are read from the database.
+    Send `Accept: application/x-ndjson` to get newline-delimited JSON instead of an array.
+
+    With `serials` (comma-separated serial numbers), fetches those parts like `POST /parts/batch`;
+    it can't be combined with searching, paging, filters, sorting or facets.
+    With `fields`, e.g. `serial_number,quantity`, returns only these fields of the parts;
+    the category names are only looked up if `category` is one of them.
+
+    `price`, `quantity` and the location fields (`room`, `bookcase`, ...) filter the parts
+    by an exact value or an inclusive range: `1..5`, `1..` or `..5`.
+    `sort` orders them by `serial_number`, `price` or `quantity`, descending with a leading `-`.
+    `facets` (`room`, `category` or both) adds the number of matching parts per value
+    and returns `{"parts": [...], "facets": {...}}`, always as one page.
+
+    Responses carry an `ETag`; with a matching `If-None-Match` the answer is 304 Not Modified.
     """
-    results = []
-    if q is None:
-        results = list(db.parts.find({}))
-    else:
-        matching_category_ids = []
-        for doc in db.categories.find({"name": {"$regex": q}}, {"_id": 1}):
-            matching_category_ids.append(doc["_id"])
-        search_filter = {
-            "$or": [
-                {"serial_number":{"$regex": q}},
-                {"name":{"$regex": q}},
-                {"description":{"$regex": q}},
-                {"location.room":{"$regex": q}},
-                {"category": {"$in": matching_category_ids}},
-            ]
-        }
-        results = list(db.parts.find(search_filter))
+    part_fields = parse_fields(fields, PART_FIELDS)
+    ndjson = accept is not None and NDJSON_MEDIA_TYPE in accept
+    media_type = NDJSON_MEDIA_TYPE if ndjson else "application/json"
+    source = get_mirror()
+    variant = ("ndjson" if ndjson else "json") + get_fields_variant(part_fields)
+    etag = await check_not_modified(db, if_none_match, ("parts", "categories"), variant, source)
+    headers = {"ETag": etag, "Vary": "Accept"}
 
-    if len(results) == 0:
-        raise HTTPException(status.HTTP_404_NOT_FOUND, "no parts match the query")
+    filter_values = {
+        "price": price,
+        "quantity": quantity,
+        "room": room,
+        "bookcase": bookcase,
+        "shelf": shelf,
+        "cuvette": cuvette,
+        "column": column,
+        "row": row,
+    }
+    if serials is not None:
+        other_parameters = {"q": q, "limit": limit, "after": after, "sort": sort, "facets": facets}
+        other_parameters.update(filter_values)
+        given = [name for name, value in other_parameters.items() if value is not None]
+        if len(given) > 0:
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST, f"serials can't be combined with {', '.join(given)}"
+            )
+        serial_numbers = [serial for serial in serials.split(",") if serial != ""]
+        if not 1 <= len(serial_numbers) <= MAX_BATCH_SIZE:
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST, f"between 1 and {MAX_BATCH_SIZE} serials are required"
+            )
+        parts = await read_parts_by_serial(db, serial_numbers, source, part_fields)
+        return serialization.FastJSONResponse(parts, headers=headers)
 
-    for document in results:
-        # Replace ObjectIDs with string names for the API and remove the unnecessary ones
-        category_document = get_category_document(db, {"_id": document["category"]})
-        document["category"] = category_document["name"]
-        del document["_id"]
-    return results
+    part_filter = filters.get_part_filter(filter_values)
+    sort_keys = filters.get_sort_keys(sort, q)
+    facet_names = filters.parse_facets(facets)
+    if (after is not None or len(facet_names) > 0) and limit is None:
+        limit = MAX_PAGE_SIZE
+    after_values = None if after is None else decode_cursor(after, sort_keys)
+
+    # The mirror answers reads in the default order, without filters and facets
+    if source is not None and len(part_filter) == 0 and sort is None and len(facet_names) == 0:
+        # Nothing to stream from memory, all matching parts are encoded at once
+        results = source.find_parts(q, after_values, None if limit is None else limit + 1)
+        return parts_page_response(
+            results, q, sort_keys, limit, after, ndjson, headers, part_fields
+        )
+
+    search_filter = part_filter
+    score = None
+    if q is not None:
+        matching_category_ids = await search.get_matching_category_ids(db, q)
+        search_filter = search.get_part_search_filter(q, matching_category_ids)
+        if len(part_filter) > 0:
+            search_filter = {"$and": [part_filter, search_filter]}
+        score = search.get_part_score_expression(q, matching_category_ids)
+    sort_dict = dict(sort_keys)
+
+    if after is None and limit is None:
+        # Without a query or a requested order the order doesn't matter, so the parts aren't sorted
+        unsorted = q is None and sort is None
+        pipeline = part_read_pipeline(
+            search_filter, sort=None if unsorted else sort_dict, score=score, fields=part_fields
+        )
+        cursor = db.parts.aggregate(pipeline)
+        first_document = await anext(cursor, None)
+        if first_document is None:
+            await cursor.close()
+            raise HTTPException(status.HTTP_404_NOT_FOUND, "no parts match the query")
+        return StreamingResponse(
+            stream_parts(first_document, cursor, ndjson), media_type=media_type, headers=headers
+        )
+
+    # Keyset pagination: the sort keys end with the unique serial number, giving a stable order
+    after_filter = None
+    if after_values is not None:
+        after_filter = filters.get_after_filter(sort_keys, after_values)
+    # The cursor is made of the sort values, which are read even if they weren't requested
+    read_fields = part_fields
+    if part_fields is not None:
+        read_fields = tuple(dict.fromkeys([*(field for field, _ in sort_keys), *part_fields]))
+    # One extra document tells whether there is a next page
+    pipeline = part_read_pipeline(
+        search_filter,
+        limit=limit + 1,
+        sort=sort_dict,
+        score=score,
+        after=after_filter,
+        fields=read_fields,
+    )
+    facet_counts = None
+    if len(facet_names) > 0:
+        # The facets count all matching parts, in the same aggregation the page is read in
+        match, *page = pipeline
+        pipeline = [match, {"$facet": {"parts": page, **filters.get_facet_pipelines(facet_names)}}]
+        facet_document, = await db.parts.aggregate(pipeline).to_list(None)
+        results = facet_document["parts"]
+        facet_counts = filters.get_facet_counts(facet_document, facet_names)
+    else:
+        results = await db.parts.aggregate(pipeline).to_list(None)
+    return parts_page_response(
+        results, q, sort_keys, limit, after, ndjson, headers, part_fields, facet_counts
+    )
 
 
 @app.put("/parts/{serial_number}", tags=["parts"])
-def update_part(serial_number: str, new_part_data: Part, db: database = Depends(get_db)):
-    new_category_document = get_category_document(db, {"name": new_part_data.category})
-    validation.validate_category_accepts_parts(new_category_document)
-    if new_part_data.serial_number != serial_number:
-        validation.validate_part_unique_serial(db, new_part_data)
-    validation.validate_part_cuvette_not_taken(db, new_part_data.location)
-
-    update_data = vars(new_part_data)
-    update_data["location"] = vars(update_data["location"])
-    update_data["category"] = new_category_document["_id"]
-
-    updated_part = db.parts.find_one_and_update(
-        {"serial_number": serial_number},
-        {"$set": update_data},
-        return_document=ReturnDocument.AFTER
+async def update_part(
+    serial_number: str,
+    new_part_data: Part,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    new_category_document = await get_part_category_document(db, new_part_data.category)
+
+    update_data = part_to_document(new_part_data, new_category_document["_id"])
+
+    search_dict = {"serial_number": serial_number}
+    try:
+        previous_part = await db.parts.find_one_and_update(search_dict, {"$set": update_data})
+    except DuplicateKeyError as error:
+        await validation.raise_part_conflict(db, new_part_data, error, serial_number)
+    if previous_part is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, f"part {search_dict} does not exist")
+    await counters.update_part_counters(db, added=[update_data], removed=[previous_part])
+    await occupancy.update_occupancy(
+        db, occupancy_index, taken=[update_data["location"]], freed=[previous_part["location"]]
     )
+    await record_write(db, "parts")
+    return new_part_data.model_dump()
 
-    # Replace ObjectIDs with string names for the API and remove the unnecessary ones
-    updated_part["category"] = new_category_document["name"]
-    del updated_part["_id"]
-    return updated_part
+
+@app.post("/parts/{serial_number}/adjust", tags=["parts"])
+async def adjust_part_quantity(
+    serial_number: str,
+    adjustment: QuantityAdjustment,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Adds `delta` to the quantity of a part (negative to take parts out of stock) with one atomic update.
+    Responds with 409 if the part doesn't have enough stock.
+    Returns the serial number and the new quantity.
+    """
+    if adjustment_coalescer.enabled:
+        return await adjustment_coalescer.submit(db, serial_number, adjustment.delta)
+    part = await adjustments.adjust_quantity(db, serial_number, adjustment.delta)
+    await record_write(db, "parts")
+    return part
 
 
 @app.delete("/parts/{serial_number}", tags=["parts"])
-def delete_part(serial_number: str, db: database = Depends(get_db)):
+async def delete_part(serial_number: str, db: AsyncIOMotorDatabase = Depends(get_db)):
     delete_filter = {"serial_number": serial_number}
-    result = db.parts.find_one_and_delete(delete_filter)
+    result = await db.parts.find_one_and_delete(delete_filter)
     if result is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND, f"part {delete_filter} does not exist")
+    await counters.update_part_counters(db, removed=[result])
+    await occupancy.update_occupancy(db, occupancy_index, freed=[result["location"]])
+    await record_write(db, "parts")
     return {}
 
 
@@ -165,116 +988,414 @@ def delete_part(serial_number: str, db: database = Depends(get_db)):
 
 
 @app.post("/categories", tags=["categories"])
-def create_category(category: Category, db: database = Depends(get_db)):
-    validation.validate_category_unique_name(db, category)
-    validation.validate_category_fields(db, category)
+async def create_category(category: Category, db: AsyncIOMotorDatabase = Depends(get_db)):
+    await validation.validate_category_fields(db, category, get_mirror())
 
     # Get ObjectID from string name for database representation
     parent_id = None
+    parent_category = None
     if category.parent_name != "":
-        parent_category = get_category_document(db, {"name": category.parent_name})
+        parent_category = await get_category_document(db, {"name": category.parent_name}, max_age=0)
         if parent_category is not None:
             parent_id = parent_category["_id"]
 
     category_document = {
         "name": category.name,
         "parent_id": parent_id,
+        tree.ANCESTORS_FIELD: tree.get_ancestors(parent_category),
+        **counters.get_empty_counters(),
     }
-    db.categories.insert_one(category_document)  # NOTE implicitly adds _id to doc
+    category_document[search.GRAMS_FIELD] = search.get_category_grams(category_document)
+    try:
+        await db.categories.insert_one(category_document)  # NOTE implicitly adds _id to doc
+    except DuplicateKeyError as error:
+        validation.raise_category_conflict(category, error)
+    category_cache.clear()
+    await record_write(db, "categories")
 
-    # Replace ObjectIDs with string names for the API and remove the unnecessary ones
-    category_document["parent_name"] = category.parent_name
-    del category_document["_id"]
-    del category_document["parent_id"]
-    return category_document
+    return category_response(category_document, category.parent_name)
 
 
 @app.get("/categories", tags=["categories"])
-def read_categories(db: database = Depends(get_db)):
+async def read_categories(
+    response: Response,
+    fields: str | None = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """
     Fetches all categories.
+    Returns only the comma-separated `fields` if given; parents are only resolved for `parent_name`.
     """
+    category_fields = parse_fields(fields, CATEGORY_FIELDS)
+    source = get_mirror()
+    response.headers["ETag"] = await check_not_modified(
+        db, if_none_match, ("categories",), get_fields_variant(category_fields), source
+    )
+    if source is not None:
+        documents = source.get_category_documents()
+    elif category_fields == ("name",):
+        documents = await db.categories.find({}, {"_id": 0, "name": 1}).to_list(None)
+    else:
+        documents = await db.categories.find({}, {"name": 1, "parent_id": 1}).to_list(None)
+    if category_fields == ("name",):
+        return [{"name": document["name"]} for document in documents]
+
+    category_names = {document["_id"]: document["name"] for document in documents}
+    parent_ids = [document["parent_id"] for document in documents]
+    # Parents are normally in the same result set, so this only queries for dangling references
+    missing_parent_ids = [i for i in parent_ids if i is not None and i not in category_names]
+    category_names.update(await get_category_names(db, missing_parent_ids))
+
     categories = []
-    for document in db.categories.find({}):
-        # Replace ObjectIDs with string names for the API and remove the unnecessary ones
-        if document["parent_id"] is None:
-            document["parent_name"] = ""
-        else:
-            category = get_category_document(db, {"_id": document["parent_id"]})
-            document["parent_name"] = category["name"]
-        del document["_id"]
-        del document["parent_id"]
-        categories.append(document)
+    for document in documents:
+        parent_name = ""
+        if document["parent_id"] is not None:
+            parent_name = category_names[document["parent_id"]]
+        categories.append(project(category_response(document, parent_name), category_fields))
     return categories
 
 
+@app.get("/categories/tree", tags=["categories"])
+async def read_category_tree(
+    response: Response,
+    if_none_match: Annotated[str | None, Header()] = None,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Fetches the whole category hierarchy with a single query,
+    as a list of base categories with their nested children.
+    """
+    response.headers["ETag"] = await check_not_modified(db, if_none_match, ("categories",))
+    documents = await db.categories.find({}, {"name": 1, "parent_id": 1}).to_list(None)
+    return tree.build_tree(documents)
+
+
 @app.get("/categories/{name}", tags=["categories"])
-def read_category(name: str, db: database = Depends(get_db)):
+async def read_category(
+    name: str,
+    response: Response,
+    fields: str | None = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """
     Fetches data of a category with the requested name.
+    Returns only the comma-separated `fields` if given.
     """
-    category_document = get_category_document(db, {"name": name})
+    category_fields = parse_fields(fields, CATEGORY_FIELDS)
+    response.headers["ETag"] = await check_not_modified(
+        db, if_none_match, ("categories",), get_fields_variant(category_fields)
+    )
+    category_document = await get_category_document(db, {"name": name})
 
-    # Replace ObjectIDs with string names for the API and remove the unnecessary ones
+    parent_name = ""
     parent_id = category_document["parent_id"]
-    if parent_id is None:
-        category_document["parent_name"] = ""
-    else:
-        parent_category_document = get_category_document(db, {"_id": parent_id})
-        category_document["parent_name"] = parent_category_document["name"]
+    if parent_id is not None and (category_fields is None or "parent_name" in category_fields):
+        parent_category_document = await get_category_document(db, {"_id": parent_id})
+        parent_name = parent_category_document["name"]
+    return project(category_response(category_document, parent_name), category_fields)
 
-    del category_document["_id"]
-    del category_document["parent_id"]
-    return category_document
+
+@app.get("/categories/{name}/stats", tags=["categories"])
+async def read_category_stats(
+    name: str,
+    response: Response,
+    fields: str | None = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Fetches the number of parts and their total quantity in a category,
+    both for the category alone and including all categories below it.
+    Returns only the comma-separated `fields` if given; the subtree is only counted for `subtree`.
+    """
+    stats_fields = parse_fields(fields, CATEGORY_STATS_FIELDS)
+    response.headers["ETag"] = await check_not_modified(
+        db, if_none_match, ("parts", "categories"), get_fields_variant(stats_fields)
+    )
+    # Not read through the cache, which doesn't follow part writes
+    category_document = await db.categories.find_one(
+        {"name": name}, {counters.PART_COUNT_FIELD: 1, counters.TOTAL_QUANTITY_FIELD: 1}
+    )
+    if category_document is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, f"category { {'name': name} } does not exist")
+    stats = {
+        "name": name,
+        counters.PART_COUNT_FIELD: category_document[counters.PART_COUNT_FIELD],
+        counters.TOTAL_QUANTITY_FIELD: category_document[counters.TOTAL_QUANTITY_FIELD],
+    }
+    if stats_fields is None or "subtree" in stats_fields:
+        stats["subtree"] = await counters.get_subtree_counters(db, category_document["_id"])
+    return project(stats, stats_fields)
 
 
 @app.put("/categories/{name}", tags=["categories"])
-def update_category(name: str, new_category_data: Category, db: database = Depends(get_db)):
-    validation.validate_category_fields(db, new_category_data)
-    category_document = get_category_document(db, {"name": name})
+async def update_category(
+    name: str,
+    new_category_data: Category,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    _, category_document = await gather_checks(
+        validation.validate_category_fields(db, new_category_data, get_mirror()),
+        get_category_document(db, {"name": name}, max_age=0),
+    )
 
     # Find the right category ID for the database representation
     new_parent_id = None
+    new_parent_document = None
     if new_category_data.parent_name == "":
-        validation.validate_category_no_parts(db, category_document)
+        await validation.validate_category_no_parts(db, category_document, get_mirror())
     else:
-        new_parent_document = get_category_document(db, {"name": new_category_data.parent_name})
+        new_parent_document = await get_category_document(
+            db, {"name": new_category_data.parent_name}
+        )
+        validation.validate_category_parent_not_descendant(category_document, new_parent_document)
         new_parent_id = new_parent_document["_id"]
+    new_ancestors = tree.get_ancestors(new_parent_document)
 
-    updated_category = db.categories.find_one_and_update(
-        {"_id": category_document["_id"]},
-        {"$set": {"name": new_category_data.name, "parent_id": new_parent_id}},
-        return_document=ReturnDocument.AFTER
-    )
+    try:
+        updated_category = await db.categories.find_one_and_update(
+            {"_id": category_document["_id"]},
+            {"$set": {
+                "name": new_category_data.name,
+                "parent_id": new_parent_id,
+                tree.ANCESTORS_FIELD: new_ancestors,
+                search.GRAMS_FIELD: search.get_category_grams(vars(new_category_data)),
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError as error:
+        validation.raise_category_conflict(new_category_data, error)
+    if new_ancestors != category_document[tree.ANCESTORS_FIELD]:
+        await tree.update_descendant_ancestors(db, category_document["_id"], new_ancestors)
+    category_cache.clear()
+    await record_write(db, "categories")
 
-    # Replace ObjectIDs with string names for the API and remove the unnecessary ones
-    updated_category["parent_name"] = new_category_data.parent_name
-    del updated_category["_id"]
-    del updated_category["parent_id"]
-    return updated_category
+    return category_response(updated_category, new_category_data.parent_name)
 
 
 @app.delete("/categories/{name}", tags=["categories"])
-def delete_category(name: str, db: database = Depends(get_db)):
-    category = get_category_document(db, {"name": name})
-    validation.validate_category_no_parts(db, category)
-    validation.validate_category_children_have_no_parts(db, category)
+async def delete_category(name: str, db: AsyncIOMotorDatabase = Depends(get_db)):
+    category = await get_category_document(db, {"name": name}, max_age=0)
+    await gather_checks(
+        validation.validate_category_no_parts(db, category, get_mirror()),
+        validation.validate_category_children_have_no_parts(db, category, get_mirror()),
+    )
 
-    result = db.categories.find_one_and_delete({"_id": category["_id"]})
+    result = await db.categories.find_one_and_delete({"_id": category["_id"]})
+    category_cache.clear()
     if result is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND, f"category with name {name} does not exist")
+    await record_write(db, "categories")
     return {}
 
 
+# -------------------------- Locations -------------------------- #
+
+
+@app.get("/locations/free", tags=["locations"])
+async def read_free_locations(
+    room: Annotated[str, Query(min_length=1, max_length=20)],
+    count: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = 1,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Finds the first `count` free locations in a room, in the order of bookcase, shelf, cuvette,
+    column and row. Answered from the in-memory occupancy bitmaps without querying the parts.
+    """
+    index = await get_occupancy_index(db)
+    return index.find_free(room, count)
+
+
+# -------------------------- Reports -------------------------- #
+
+
+@app.get("/reports/valuation", tags=["reports"])
+async def read_valuation_report(
+    response: Response,
+    if_none_match: Annotated[str | None, Header()] = None,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Fetches the number of parts, their total quantity and their stock value (quantity * price)
+    of every category, both for the category alone and including all categories below it,
+    and the totals of the whole inventory. Served from the stored report until the data changes.
+    """
+    etag = await check_not_modified(db, if_none_match, ("parts", "categories"), "valuation")
+    response.headers["ETag"] = etag
+    return await reports.get_report(db, "valuation", etag, reports.compute_valuation)
+
+
+@app.get("/reports/low-stock", tags=["reports"])
+async def read_low_stock_report(
+    response: Response,
+    threshold: Annotated[int, Query(ge=0, le=MAX_INT32)] = reports.DEFAULT_LOW_STOCK_THRESHOLD,
+    if_none_match: Annotated[str | None, Header()] = None,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
+    """
+    Fetches the parts with a quantity of at most `threshold`, the scarcest first,
+    and the number of such parts in every category and its subtree.
+    Served from the stored report until the data changes.
+    """
+    report_id = f"low-stock-{threshold}"
+    etag = await check_not_modified(db, if_none_match, ("parts", "categories"), report_id)
+    response.headers["ETag"] = etag
+    return await reports.get_report(
+        db, report_id, etag, lambda db: reports.compute_low_stock(db, threshold)
+    )
+
+
 # -------------------------- Extra -------------------------- #
 
 
+@app.get("/metrics", tags=["extra"], response_class=PlainTextResponse)
+async def read_metrics():
+    """
+    Request latency and per-request database command counts and time,
+    as Prometheus histograms by method, route and status code.
+    """
+    return PlainTextResponse(metrics.render_metrics(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/indexes", tags=["extra"])
+async def read_index_drift(db: AsyncIOMotorDatabase = Depends(get_db)):
+    """
+    Reports differences between the declared and the existing database indexes.
+    """
+    return await indexes.get_index_drift(db)
+
+
+@app.post("/reconcile", tags=["extra"])
+async def reconcile_counters(db: AsyncIOMotorDatabase = Depends(get_db)):
+    """
+    Recounts the parts of every category and repairs the category counters which drifted.
+    Returns the names of the repaired categories.
+    """
+    repaired = await counters.reconcile_part_counters(db)
+    await occupancy.rebuild_occupancy(db, occupancy_index)
+    if len(repaired) > 0:
+        await record_write(db, "categories")  # the counters are part of the category
+    return {"repaired": repaired}
+
+
+@app.get("/export", tags=["extra"])
+async def export_snapshot(compress: bool = False, db: AsyncIOMotorDatabase = Depends(get_db)):
+    """
+    Streams a snapshot of all categories and parts as concatenated BSON documents,
+    gzip compressed with `?compress=true`. The snapshot can be restored with `/import`.
+    """
+    filename = "inventory.bson.gz" if compress else "inventory.bson"
+    return StreamingResponse(
+        snapshot.iter_snapshot(db, compress),
+        media_type="application/gzip" if compress else "application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.post("/import", tags=["extra"])
+async def import_snapshot(request: Request, db: AsyncIOMotorDatabase = Depends(get_db)):
+    """
+    Removes all existing data and restores a snapshot created by `/export`.
+    Send gzip compressed snapshots with `Content-Encoding: gzip` or `Content-Type: application/gzip`.
+    The snapshot is restored while it's received, so a damaged snapshot is only restored partially.
+    """
+    compressed = (
+        request.headers.get("content-encoding") == "gzip"
+        or request.headers.get("content-type") == "application/gzip"
+    )
+    try:
+        counts = await snapshot.restore_snapshot(db, request.stream(), compressed)
+    except BulkWriteError as error:
+        # e.g. documents violating a unique index
+        write_error = error.details["writeErrors"][0]["errmsg"]
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"invalid snapshot: {write_error}") from error
+    except (snapshot.SnapshotError, zlib.error, PyMongoError) as error:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"invalid snapshot: {error}") from error
+    finally:
+        category_cache.clear()
+        # Even a failed restore has already replaced some data,
+        # and snapshots from older versions may lack derived fields
+        await repair_derived_data(db)
+        await record_write(db, *versions.VERSIONED_COLLECTIONS)
+    return counts
+
+
 @app.post("/repopulate", tags=["extra"])
-def add_example_data(db: database = Depends(get_db)):
+async def add_example_data(
+    parts: Annotated[int | None, Query(ge=0, le=generator.MAX_PARTS)] = None,
+    seed: int = 0,
+    categories: Annotated[int, Query(ge=2, le=generator.MAX_CATEGORIES)] = generator.DEFAULT_CATEGORIES,
+    base_categories: Annotated[int, Query(ge=1)] = generator.DEFAULT_BASE_CATEGORIES,
+    fan_out: Annotated[int, Query(ge=1)] = generator.DEFAULT_FAN_OUT,
+    db: AsyncIOMotorDatabase = Depends(get_db)
+):
     """
     Removes all existing data and creates several categories and parts for testing.
+    With `parts`, generates that many parts instead, spread over `categories` categories:
+    `base_categories` base categories with `fan_out` children per category.
+    The same `seed` always generates the same data. Returns the numbers of generated categories and parts.
     """
-    db.categories.delete_many({})
-    db.parts.delete_many({})
-    add_test_data(db)
-    return {}
+    if parts is not None:
+        try:
+            generator.validate_shape(categories, base_categories, fan_out)
+        except generator.GeneratorSettingsError as error:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, str(error)) from error
+    try:
+        if parts is None:
+            await asyncio.gather(db.categories.delete_many({}), db.parts.delete_many({}))
+            await add_test_data(db)
+            counts = {}
+        else:
+            counts = await generator.generate(
+                db, parts, seed, categories, base_categories, fan_out
+            )
+    finally:
+        category_cache.clear()
+        occupancy_index.clear()
+        await record_write(db, *versions.VERSIONED_COLLECTIONS)
+    return counts
+
+
+# -------------------------- Health -------------------------- #
+
+
+@app.get("/health/live", tags=["health"])
+async def read_liveness():
+    """
+    Reports that the app is running; doesn't touch the database.
+    """
+    return {"status": "alive"}
+
+
+@app.get("/health/ready", tags=["health"])
+async def read_readiness(db: AsyncIOMotorDatabase = Depends(get_db)):
+    """
+    Reports whether the app can serve requests: the database answers a ping
+    and the startup maintenance is finished. Responds with 503 otherwise.
+    Includes the state of the connection pool.
+    """
+    database_status = {}
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(db.command("ping"), HEALTH_PING_TIMEOUT_SECONDS)
+        database_status["ping_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    except (PyMongoError, asyncio.TimeoutError) as error:
+        database_status["error"] = str(error) or type(error).__name__
+
+    ready = "error" not in database_status and maintenance_status in ("done", "skipped")
+    content = {
+        "status": "ready" if ready else "not ready",
+        "database": database_status,
+        "maintenance": maintenance_status,
+        "pool": {
+            "max_size": connection.get_client_options()["maxPoolSize"],
+            **connection.pool_monitor.get_status(),
+        },
+        "concurrency": {
+            class_name: limit.get_status() for class_name, limit in concurrency_limits.items()
+        },
+    }
+    status_code = status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+    return serialization.FastJSONResponse(content, status_code=status_code)
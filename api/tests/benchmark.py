@@ -0,0 +1,352 @@
+"""
+Load test and micro-benchmarks of every endpoint, driven through the ASGI app in-process.
+
+    python -m api.tests.benchmark --parts 100000 --concurrency 20 --output results.json
+
+Seeds a dataset of the requested size (the same one for the same --seed), then sends --requests
+requests per scenario from --concurrency concurrent clients. Runs against mongomock by default,
+or against a MongoDB server with --mongo-uri (the benchmark database is emptied and re-seeded).
+Results are written as JSON, so runs of different releases can be diffed; a summary goes to stderr.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import math
+import platform
+import random
+import sys
+import time
+import httpx
+from mongomock_motor import AsyncMongoMockClient
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from .. import main
+from ..main import app, get_db
+from ..data import generator
+from ..data.generator import get_serial, get_part, WORDS
+from ..data.indexes import ensure_indexes
+
+BASE_CATEGORIES = 5
+CHILD_CATEGORIES = 10
+CATEGORIES = BASE_CATEGORIES * (1 + CHILD_CATEGORIES)
+SEED_BATCH_SIZE = 10000
+BULK_SIZE = 100
+BATCH_SIZE = 100  # serial numbers per batch read
+HOT_PARTS = 10  # parts receiving the stock adjustments
+
+# -------------------------- Database round trips -------------------------- #
+
+# Collection methods which send a command to the database.
+# A cursor is counted once, when it's created; reading further batches isn't counted.
+COUNTED_METHODS = {
+    "aggregate", "bulk_write", "count_documents", "delete_many", "delete_one", "distinct",
+    "find", "find_one", "find_one_and_delete", "find_one_and_replace", "find_one_and_update",
+    "index_information", "insert_many", "insert_one", "replace_one", "update_many", "update_one",
+}
+
+_round_trips = contextvars.ContextVar("round_trips", default=None)
+
+
+class CountingCollection:
+    """
+    Proxy of a Motor collection counting the commands sent by the current request.
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in COUNTED_METHODS:
+            return attribute
+
+        def counted(*args, **kwargs):
+            round_trips = _round_trips.get()
+            if round_trips is not None:
+                round_trips[0] += 1
+            return attribute(*args, **kwargs)
+        return counted
+
+
+class CountingDatabase:
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        return CountingCollection(getattr(self._db, name))
+
+    def __getitem__(self, name):
+        return CountingCollection(self._db[name])
+
+
+# -------------------------- Dataset -------------------------- #
+
+
+def get_leaf_category_names() -> list:
+    return [
+        generator.get_category_name(index, BASE_CATEGORIES)
+        for index in range(BASE_CATEGORIES, CATEGORIES)
+    ]
+
+
+async def seed_dataset(db, parts: int, seed: int):
+    """
+    Replaces all data with BASE_CATEGORIES base categories, CHILD_CATEGORIES children of each
+    and the given number of parts spread over the child categories.
+    """
+    await ensure_indexes(db)
+    await generator.generate(
+        db,
+        parts=parts,
+        seed=seed,
+        categories=CATEGORIES,
+        base_categories=BASE_CATEGORIES,
+        fan_out=CHILD_CATEGORIES,
+        chunk_size=SEED_BATCH_SIZE,
+    )
+
+
+# -------------------------- Scenarios -------------------------- #
+
+
+def get_scenarios(parts: int, requests: int, seed: int) -> list:
+    """
+    Returns (name, list of (method, url, request kwargs)) pairs, in the order they're ran.
+    Reads go first; writes only touch data created by earlier write scenarios, or update in place.
+    """
+    rng = random.Random(seed + 1)
+    leaf_names = get_leaf_category_names()
+    heavy = max(1, requests // 20)  # for scenarios reading the whole dataset
+
+    def repeat(make_spec, count=requests) -> list:
+        return [make_spec() for _ in range(count)]
+
+    def new_part(index: int) -> dict:
+        return get_part(rng, parts + index, rng.choice(leaf_names))
+
+    def updated_part() -> dict:
+        # Same serial number and location as an existing part, the other fields change
+        return get_part(rng, rng.randrange(parts), rng.choice(leaf_names))
+
+    new_parts = [new_part(i) for i in range(requests)]
+    bulk_parts = [
+        [new_part(requests + i * BULK_SIZE + j) for j in range(BULK_SIZE)] for i in range(requests)
+    ]
+    updated_parts = repeat(updated_part)
+    new_categories = [f"bench{i}" for i in range(requests)]
+    ndjson = {"headers": {"Accept": "application/x-ndjson"}}
+
+    return [
+        ("read_part", repeat(lambda: ("GET", f"/parts/{get_serial(rng.randrange(parts))}", {}))),
+        ("read_parts_batch", repeat(lambda: ("POST", "/parts/batch", {"json": {
+            "serial_numbers": [get_serial(rng.randrange(parts)) for _ in range(BATCH_SIZE)]
+        }}))),
+        ("read_parts_page", repeat(lambda: ("GET", "/parts", {"params": {"limit": 100}}))),
+        ("search_parts", repeat(
+            lambda: ("GET", "/parts", {"params": {"q": rng.choice(WORDS)[:5], "limit": 100}})
+        )),
+        ("filter_parts", repeat(lambda: ("GET", "/parts", {"params": {
+            "price": f"..{rng.randint(10, 100)}", "quantity": "10..", "sort": "-price", "limit": 100
+        }}))),
+        ("filter_parts_facets", repeat(lambda: ("GET", "/parts", {"params": {
+            "room": "room0", "facets": "category", "limit": 100
+        }}))),
+        ("read_parts_all", repeat(lambda: ("GET", "/parts", {}), heavy)),
+        ("read_parts_all_ndjson", repeat(lambda: ("GET", "/parts", ndjson), heavy)),
+        ("read_categories", repeat(lambda: ("GET", "/categories", {}))),
+        ("read_category", repeat(lambda: ("GET", f"/categories/{rng.choice(leaf_names)}", {}))),
+        ("read_category_tree", repeat(lambda: ("GET", "/categories/tree", {}))),
+        ("read_category_stats", repeat(
+            lambda: ("GET", f"/categories/base{rng.randrange(BASE_CATEGORIES)}/stats", {})
+        )),
+        ("valuation_report", repeat(lambda: ("GET", "/reports/valuation", {}))),
+        ("low_stock_report", repeat(
+            lambda: ("GET", "/reports/low-stock", {"params": {"threshold": rng.randint(0, 10)}})
+        )),
+        ("free_locations", repeat(
+            lambda: ("GET", "/locations/free", {"params": {"room": "room0", "count": 10}})
+        )),
+        ("export", repeat(lambda: ("GET", "/export", {}), heavy)),
+        ("create_part", [("POST", "/parts", {"json": part}) for part in new_parts]),
+        ("update_part", [
+            ("PUT", f"/parts/{part['serial_number']}", {"json": part}) for part in updated_parts
+        ]),
+        # Restocking a few hot parts, the access pattern adjustment coalescing is meant for
+        ("adjust_part", repeat(lambda: (
+            "POST",
+            f"/parts/{get_serial(rng.randrange(min(parts, HOT_PARTS)))}/adjust",
+            {"json": {"delta": rng.randint(1, 5)}},
+        ))),
+        ("delete_part", [("DELETE", f"/parts/{part['serial_number']}", {}) for part in new_parts]),
+        ("create_parts_bulk", [("POST", "/parts/bulk", {"json": chunk}) for chunk in bulk_parts]),
+        ("create_category", [
+            ("POST", "/categories", {"json": {"name": name, "parent_name": "base0"}})
+            for name in new_categories
+        ]),
+        ("update_category", [
+            ("PUT", f"/categories/{name}", {"json": {"name": name, "parent_name": "base1"}})
+            for name in new_categories
+        ]),
+        ("delete_category", [("DELETE", f"/categories/{name}", {}) for name in new_categories]),
+    ]
+
+
+def get_percentile(sorted_values: list, percentile: float) -> float:
+    # Nearest-rank method
+    rank = max(1, math.ceil(percentile / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+async def run_scenario(http_client: httpx.AsyncClient, specs: list, concurrency: int) -> dict:
+    latencies = []
+    round_trip_counts = []
+    errors = 0
+    pending = iter(specs)
+
+    async def worker():
+        nonlocal errors
+        for method, url, kwargs in pending:  # the workers share the iterator
+            round_trips = [0]
+            _round_trips.set(round_trips)
+            start = time.perf_counter()
+            response = await http_client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            round_trip_counts.append(round_trips[0])
+            if response.status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / elapsed, 2),
+        "latency_ms": {
+            "p50": round(get_percentile(latencies, 50) * 1000, 3),
+            "p95": round(get_percentile(latencies, 95) * 1000, 3),
+            "p99": round(get_percentile(latencies, 99) * 1000, 3),
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3),
+        },
+        "round_trips": {
+            "mean": round(sum(round_trip_counts) / len(round_trip_counts), 2),
+            "max": max(round_trip_counts),
+        },
+    }
+
+
+async def run_benchmark(
+    parts: int = 1000,
+    requests: int = 200,
+    concurrency: int = 10,
+    seed: int = 0,
+    mongo_uri: str = None,
+    database: str = "benchmark",
+    scenarios: list = None,
+) -> dict:
+    """
+    Seeds the dataset and runs the scenarios (all of them, or the named ones).
+    The app's database dependency is overridden for the duration of the run.
+    """
+    if mongo_uri is None:
+        db = AsyncMongoMockClient()[database]
+    else:
+        db = AsyncIOMotorClient(mongo_uri)[database]
+
+    start = time.perf_counter()
+    await seed_dataset(db, parts, seed)
+    seed_seconds = time.perf_counter() - start
+
+    counting_db = CountingDatabase(db)
+
+    async def override_db():
+        yield counting_db
+
+    previous_override = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_db
+    main.category_cache.clear()
+    main.occupancy_index.clear()
+    results = {}
+    try:
+        transport = httpx.ASGITransport(app=app)
+        http_client = httpx.AsyncClient(transport=transport, base_url="http://benchmark")
+        async with http_client:
+            for name, specs in get_scenarios(parts, requests, seed):
+                if scenarios is None or name in scenarios:
+                    results[name] = await run_scenario(http_client, specs, concurrency)
+    finally:
+        if previous_override is None:
+            app.dependency_overrides.pop(get_db, None)
+        else:
+            app.dependency_overrides[get_db] = previous_override
+        main.category_cache.clear()
+        main.occupancy_index.clear()
+
+    return {
+        "parameters": {
+            "parts": parts,
+            "requests": requests,
+            "concurrency": concurrency,
+            "seed": seed,
+            "backend": "mongomock" if mongo_uri is None else "mongodb",
+            "python": platform.python_version(),
+        },
+        "seed_seconds": round(seed_seconds, 3),
+        "scenarios": results,
+    }
+
+
+def format_summary(report: dict) -> str:
+    lines = [
+        f"{'scenario':<24}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{'trips':>8}{'errors':>8}"
+    ]
+    for name, result in report["scenarios"].items():
+        latency = result["latency_ms"]
+        lines.append(
+            f"{name:<24}{result['requests_per_second']:>10}{latency['p50']:>10}{latency['p95']:>10}"
+            f"{latency['p99']:>10}{result['round_trips']['mean']:>8}{result['errors']:>8}"
+        )
+    return "\n".join(lines)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0].strip())
+    parser.add_argument(
+        "--parts", type=int, default=1000, help="dataset size, e.g. 1000, 100000 or 1000000"
+    )
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--mongo-uri", default=None, help="benchmark a MongoDB server instead of mongomock"
+    )
+    parser.add_argument("--database", default="benchmark")
+    parser.add_argument("--scenarios", default=None, help="comma separated scenario names")
+    parser.add_argument("--output", default=None, help="JSON results file, stdout by default")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(
+        parts=args.parts,
+        requests=args.requests,
+        concurrency=args.concurrency,
+        seed=args.seed,
+        mongo_uri=args.mongo_uri,
+        database=args.database,
+        scenarios=args.scenarios.split(",") if args.scenarios else None,
+    ))
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    print(format_summary(report), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main_cli()
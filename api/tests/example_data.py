@@ -1,6 +1,8 @@
-from pymongo import database
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from bson.objectid import ObjectId
 
+from ..data import search, tree, counters, occupancy
+
 fixture_part_1 = {
     "serial_number": "example_serial_no",
     "name": "Some Transistor",
@@ -96,7 +98,7 @@ def fixture_deep_copy(fixture: dict):
     return copy
 
 
-def add_test_data(db: database):
+async def add_test_data(db: AsyncIOMotorDatabase):
     # NOTE: fixtures aren't entered directly because user-side representation uses string names
     # and db side uses ObjectIDs to reference categories.
     # Similarly, db-side categories are created directly, without parent_name.
@@ -109,7 +111,7 @@ def add_test_data(db: database):
     edit_test_3 = {"_id": ObjectId(), "name": "edit_cat3", "parent_id": edit_test_1["_id"]}
     delete_test = {"_id": ObjectId(), "name": "deleteme", "parent_id": edit_test_1["_id"]}
 
-    db.categories.insert_many([
+    categories = [
         base_parts,
         test_parts,
         new_parts,
@@ -117,7 +119,13 @@ def add_test_data(db: database):
         edit_test_2,
         edit_test_3,
         delete_test
-    ])
+    ]
+    categories_by_id = {category["_id"]: category for category in categories}
+    for category in categories:  # parents are listed before their children
+        parent = categories_by_id.get(category["parent_id"])
+        category[tree.ANCESTORS_FIELD] = tree.get_ancestors(parent)
+        category[search.GRAMS_FIELD] = search.get_category_grams(category)
+    await db.categories.insert_many(categories)
 
     part_1 = fixture_deep_copy(fixture_part_1)
     part_1["category"] = test_parts["_id"]
@@ -138,4 +146,9 @@ def add_test_data(db: database):
     part_6 = fixture_deep_copy(fixture_part_5)
     part_6["category"] = new_parts["_id"]
 
-    db.parts.insert_many([part_1, part_2, part_3, part_4, part_5, part_6])
+    parts = [part_1, part_2, part_3, part_4, part_5, part_6]
+    for part in parts:
+        part[search.GRAMS_FIELD] = search.get_part_grams(part)
+    await db.parts.insert_many(parts)
+    await counters.reconcile_part_counters(db)
+    await occupancy.rebuild_occupancy(db)
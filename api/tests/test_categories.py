@@ -1,25 +1,44 @@
+import asyncio
+import pytest
 from fastapi.testclient import TestClient
 from fastapi import status
-import mongomock
+from mongomock_motor import AsyncMongoMockClient
 
+from .. import main
 from ..main import app, get_db
+from ..data.indexes import ensure_indexes
 from .example_data import add_test_data
 
 client = TestClient(app)
 
-test_client = mongomock.MongoClient()
+test_client = AsyncMongoMockClient()
 test_db = test_client["test_db"]
-add_test_data(test_db)
+asyncio.run(ensure_indexes(test_db))
+asyncio.run(add_test_data(test_db))
 
 
-def override_db():
+async def override_db():
     try:
         yield test_db
     finally:
         pass
 
 
-app.dependency_overrides[get_db] = override_db
+@pytest.fixture(autouse=True, scope="module")
+def use_test_db():
+    # The override and the app's caches are global, so they're set for this module's tests only
+    previous_override = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_db
+    main.category_cache.clear()
+    main.occupancy_index.clear()
+    yield
+    if previous_override is None:
+        app.dependency_overrides.pop(get_db, None)
+    else:
+        app.dependency_overrides[get_db] = previous_override
+    main.category_cache.clear()
+    main.occupancy_index.clear()
+    main.inventory_mirror.clear()
 
 
 # -------------------------- Add / POST -------------------------- #
@@ -121,17 +140,24 @@ def test_category_rename_with_parts_assigned():
 def test_category_rename_with_child_categories_assigned():
     # Since categories are referenced by ID in the db,
     # we can change their basic data even when their children categories have parts assigned
-    new_category_data = {"name": "new_name", "parent_name": ""}
+    new_category_data = {"name": "new_parent_name", "parent_name": ""}
     response = client.put("/categories/edit_cat1", json=new_category_data)
     assert response.json() == new_category_data
     assert response.status_code == 200
     # Revert the rename to not mess with other tests
     new_category_data["name"] = "edit_cat1"
-    response = client.put("/categories/new_name", json=new_category_data)
+    response = client.put("/categories/new_parent_name", json=new_category_data)
     assert response.json() == new_category_data
     assert response.status_code == 200
 
 
+def test_category_rename_duplicate():
+    new_category_data = {"name": "base_parts", "parent_name": "edit_cat1"}
+    response = client.put("/categories/edit_cat3", json=new_category_data)
+    assert response.json() == {"detail": "category base_parts already exists"}
+    assert response.status_code == 409
+
+
 def test_category_make_base_with_parts_assigned():
     new_category_data = {"name": "test_parts", "parent_name": ""}
     response = client.put("/categories/test_parts", json=new_category_data)
@@ -184,3 +210,144 @@ def test_category_delete():
     # Test if the entry is correctly removed from the db
     response = client.get("/categories/deleteme")
     assert response.status_code == 404
+
+
+# -------------------------- Tree -------------------------- #
+
+
+def test_category_tree():
+    response = client.get("/categories/tree")
+    assert response.status_code == 200
+    base_parts = next(node for node in response.json() if node["name"] == "base_parts")
+    assert base_parts == {
+        "name": "base_parts",
+        "children": [
+            {"name": "test_parts", "children": []},
+            {"name": "new_parts", "children": []},
+        ],
+    }
+
+
+def test_category_subtree_operations():
+    for name, parent_name in [("tree_root", ""), ("tree_mid", "tree_root"), ("tree_leaf", "tree_mid")]:
+        response = client.post("/categories", json={"name": name, "parent_name": parent_name})
+        assert response.status_code == 200
+    part = {
+        "serial_number": "tree_part",
+        "name": "Deep part",
+        "description": "Two levels below its base category",
+        "category": "tree_leaf",
+        "quantity": 1,
+        "price": 1.0,
+        "location": {"room": "tree_room", "bookcase": 1, "shelf": 1, "cuvette": 1, "column": 1, "row": 1},
+    }
+    response = client.post("/parts", json=part)
+    assert response.status_code == 200
+
+    # Parts are found at any depth below the category
+    response = client.delete("/categories/tree_root")
+    assert response.json() == {
+        "detail": "can't update/remove category tree_root: child categories have parts assigned"
+    }
+    assert response.status_code == 400
+
+    # A category can't become a child of its own descendant
+    response = client.put("/categories/tree_root", json={"name": "tree_root", "parent_name": "tree_leaf"})
+    assert response.json() == {
+        "detail": "can't move category tree_root under its own child category tree_leaf"
+    }
+    assert response.status_code == 400
+    # ...or its own parent, also when it's renamed at the same time
+    response = client.put("/categories/tree_mid", json={"name": "selfref", "parent_name": "tree_mid"})
+    assert response.json() == {"detail": "category tree_mid can't be its own parent"}
+    assert response.status_code == 400
+    assert client.get("/categories/tree_mid").json() == {"name": "tree_mid", "parent_name": "tree_root"}
+
+    # Moving a category moves its whole subtree
+    response = client.post("/categories", json={"name": "tree_root2", "parent_name": ""})
+    assert response.status_code == 200
+    response = client.put("/categories/tree_mid", json={"name": "tree_mid", "parent_name": "tree_root2"})
+    assert response.status_code == 200
+    response = client.delete("/categories/tree_root")
+    assert response.status_code == 200
+    response = client.delete("/categories/tree_root2")
+    assert response.json() == {
+        "detail": "can't update/remove category tree_root2: child categories have parts assigned"
+    }
+    assert response.status_code == 400
+
+
+# -------------------------- Stats -------------------------- #
+
+
+def test_category_stats_nonexistent():
+    response = client.get("/categories/doesntexist/stats")
+    assert response.json() == {"detail": "category {'name': 'doesntexist'} does not exist"}
+    assert response.status_code == 404
+
+
+def test_category_stats():
+    response = client.get("/categories/new_parts/stats")
+    assert response.json() == {
+        "name": "new_parts",
+        "part_count": 2,
+        "total_quantity": 6,
+        "subtree": {"part_count": 2, "total_quantity": 6},
+    }
+    assert response.status_code == 200
+
+    response = client.get("/categories/tree_mid/stats")
+    assert response.json() == {
+        "name": "tree_mid",
+        "part_count": 0,
+        "total_quantity": 0,
+        "subtree": {"part_count": 1, "total_quantity": 1},
+    }
+    assert response.status_code == 200
+
+
+# -------------------------- Field projection -------------------------- #
+
+
+def test_category_read_fields():
+    categories = client.get("/categories").json()
+    response = client.get("/categories?fields=name")
+    assert response.json() == [{"name": category["name"]} for category in categories]
+    response = client.get("/categories?fields=parent_name")
+    assert response.json() == [{"parent_name": category["parent_name"]} for category in categories]
+
+    response = client.get("/categories/new_parts?fields=parent_name")
+    assert response.json() == {"parent_name": client.get("/categories/new_parts").json()["parent_name"]}
+    response = client.get("/categories/new_parts/stats?fields=part_count,name")
+    assert response.json() == {"name": "new_parts", "part_count": 2}
+
+    response = client.get("/categories?fields=ancestors")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+# -------------------------- Conditional requests -------------------------- #
+
+
+def test_category_read_not_modified():
+    response = client.get("/categories")
+    etag = response.headers["ETag"]
+    assert etag.startswith('W/"')
+    response = client.get("/categories", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+    response = client.post("/categories", json={"name": "etag_category", "parent_name": ""})
+    assert response.status_code == 200
+    response = client.get("/categories", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert "etag_category" in [category["name"] for category in response.json()]
+
+    etag = response.headers["ETag"]
+    response = client.get("/categories/etag_category", headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    response = client.delete("/categories/etag_category")
+    assert response.status_code == 200
+    response = client.get("/categories/tree", headers={"If-None-Match": etag})
+    assert response.status_code == 200
@@ -0,0 +1,511 @@
+import asyncio
+import gzip
+import bson
+import pytest
+from bson.objectid import ObjectId
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+from .. import main
+from ..main import app, get_db
+from ..data.indexes import ensure_indexes
+from ..data.counters import reconcile_part_counters
+from ..data.generator import generate
+from ..data.occupancy import rebuild_occupancy, update_occupancy, get_slot_location, get_bit_update
+from ..data.tree import rebuild_ancestors
+from ..data.metrics import get_command_shape
+from ..data import serialization, connection
+from ..data.mirror import InventoryMirror
+from ..data.limits import ConcurrencyLimit
+from .example_data import fixture_part_1
+from .example_data import add_test_data
+from .benchmark import run_benchmark
+
+client = TestClient(app)
+
+test_client = AsyncMongoMockClient()
+test_db = test_client["test_db"]
+asyncio.run(ensure_indexes(test_db))
+asyncio.run(add_test_data(test_db))
+
+
+async def override_db():
+    try:
+        yield test_db
+    finally:
+        pass
+
+
+@pytest.fixture(autouse=True, scope="module")
+def use_test_db():
+    # The override and the app's caches are global, so they're set for this module's tests only
+    previous_override = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_db
+    main.category_cache.clear()
+    main.occupancy_index.clear()
+    yield
+    if previous_override is None:
+        app.dependency_overrides.pop(get_db, None)
+    else:
+        app.dependency_overrides[get_db] = previous_override
+    main.category_cache.clear()
+    main.occupancy_index.clear()
+    main.inventory_mirror.clear()
+
+
+# -------------------------- Export / import -------------------------- #
+
+
+def test_export_import_round_trip():
+    parts = client.get("/parts").json()
+    categories = client.get("/categories").json()
+
+    response = client.get("/export")
+    assert response.status_code == 200
+    response = client.post("/import", content=response.content)
+    assert response.json() == {"categories": len(categories), "parts": len(parts)}
+    assert response.status_code == 200
+
+    assert client.get("/parts").json() == parts
+    assert client.get("/categories").json() == categories
+
+
+def test_export_import_compressed():
+    parts = client.get("/parts").json()
+
+    response = client.get("/export?compress=true")
+    assert response.status_code == 200
+    assert gzip.decompress(response.content) == client.get("/export").content
+    response = client.post(
+        "/import",
+        content=response.content,
+        headers={"Content-Encoding": "gzip"}
+    )
+    assert response.status_code == 200
+    assert client.get("/parts").json() == parts
+
+
+def test_import_invalid():
+    snapshot = client.get("/export").content
+    response = client.post("/import", content=snapshot[:-3])
+    assert response.status_code == 400
+    # Restore the data to not mess with other tests
+    response = client.post("/import", content=snapshot)
+    assert response.status_code == 200
+
+
+def test_import_failure_repairs_derived_data():
+    snapshot = client.get("/export").content
+    room = client.get("/parts").json()[0]["location"]["room"]
+    duplicates = b"".join(
+        bson.encode(document) for document in (
+            {"$collection": "categories"},
+            {"_id": ObjectId(), "name": "dup", "parent_id": None},
+            {"_id": ObjectId(), "name": "dup", "parent_id": None},
+        )
+    )
+    response = client.post("/import", content=duplicates)
+    assert response.status_code == 400
+    assert "Duplicate" in response.json()["detail"]
+
+    # Whatever was restored is consistent
+    assert client.get("/parts").status_code == 404
+    assert client.get("/categories/dup/stats").json()["part_count"] == 0
+    first_slot = {"room": room, "bookcase": 1, "shelf": 1, "cuvette": 1, "column": 1, "row": 1}
+    assert client.get(f"/locations/free?room={room}").json() == [first_slot]
+    # Restore the data to not mess with other tests
+    response = client.post("/import", content=snapshot)
+    assert response.status_code == 200
+
+
+# -------------------------- Generated data -------------------------- #
+
+
+async def read_generated(db) -> tuple:
+    parts = await db.parts.find({}, {"_id": 0}).sort("serial_number").to_list(None)
+    categories = await db.categories.find({}).sort("_id").to_list(None)
+    occupancy = await db.occupancy.find({}, {"_id": 0}).sort("bookcase").to_list(None)
+    return parts, categories, occupancy
+
+
+def test_generator():
+    generated_db = AsyncMongoMockClient()["generated_db"]
+    asyncio.run(ensure_indexes(generated_db))
+    parameters = {"categories": 12, "base_categories": 2, "fan_out": 3, "chunk_size": 100}
+    counts = asyncio.run(generate(generated_db, parts=500, seed=1, **parameters))
+    assert counts == {"categories": 12, "parts": 500}
+    parts, categories, occupancy = asyncio.run(read_generated(generated_db))
+    assert len(parts) == 500
+    assert len({str(part["location"]) for part in parts}) == 500
+    assert len(occupancy) == 1
+
+    names = {category["_id"]: category["name"] for category in categories}
+    parent_names = {
+        category["name"]: names.get(category["parent_id"], "") for category in categories
+    }
+    assert parent_names["base1"] == ""
+    assert parent_names["cat5"] == "base1"
+    assert parent_names["cat11"] == "cat3"
+    assert {names[part["category"]] for part in parts} <= {f"cat{i}" for i in range(2, 12)}
+
+    # The derived data is already what the repairs would compute
+    assert asyncio.run(reconcile_part_counters(generated_db)) == []
+    asyncio.run(rebuild_ancestors(generated_db))
+    asyncio.run(rebuild_occupancy(generated_db))
+    assert asyncio.run(read_generated(generated_db)) == (parts, categories, occupancy)
+
+    # Deterministic
+    asyncio.run(generate(generated_db, parts=500, seed=1, **parameters))
+    assert asyncio.run(read_generated(generated_db))[0] == parts
+    asyncio.run(generate(generated_db, parts=500, seed=2, **parameters))
+    assert asyncio.run(read_generated(generated_db))[0] != parts
+
+
+def test_repopulate_generated():
+    snapshot = client.get("/export").content
+    params = {"parts": 50, "seed": 1, "categories": 4, "base_categories": 1, "fan_out": 3}
+    response = client.post("/repopulate", params=params)
+    assert response.json() == {"categories": 4, "parts": 50}
+    assert response.status_code == 200
+    assert len(client.get("/parts").json()) == 50
+    assert client.get("/categories/cat3").json() == {"name": "cat3", "parent_name": "base0"}
+
+    response = client.post("/repopulate", params=dict(params, categories=2, base_categories=2))
+    assert response.status_code == 400
+    # Restore the data to not mess with other tests
+    assert client.post("/import", content=snapshot).status_code == 200
+
+
+# -------------------------- Occupancy -------------------------- #
+
+
+def test_occupancy_updates_are_idempotent():
+    occupancy_db = AsyncMongoMockClient()["occupancy_db"]
+    first, second = (get_slot_location("drift_room", 1, slot) for slot in (0, 1))
+
+    async def get_words() -> dict:
+        document = await occupancy_db.occupancy.find_one({"room": "drift_room", "bookcase": 1})
+        return document["words"]
+
+    asyncio.run(update_occupancy(occupancy_db, taken=[first]))
+    assert asyncio.run(get_words()) == {"0": 0b01}
+    # Stale words (e.g. a slot taken twice) don't spill over into the neighbouring slots
+    asyncio.run(update_occupancy(occupancy_db, taken=[first]))
+    assert asyncio.run(get_words()) == {"0": 0b01}
+    asyncio.run(update_occupancy(occupancy_db, freed=[second]))
+    assert asyncio.run(get_words()) == {"0": 0b01}
+    asyncio.run(update_occupancy(occupancy_db, taken=[second], freed=[first]))
+    assert asyncio.run(get_words()) == {"0": 0b10}
+
+    update = get_bit_update({"0": [0b10, 0b01]})
+    assert update == {"$bit": {"words.0": {"and": ~0b01, "or": 0b10}}}
+
+
+def test_rebuild_occupancy_in_place():
+    occupancy_db = AsyncMongoMockClient()["rebuild_occupancy_db"]
+    asyncio.run(ensure_indexes(occupancy_db))
+    location = get_slot_location("rebuild_room", 2, 33)
+    asyncio.run(occupancy_db.parts.insert_one({"serial_number": "rebuilt", "location": location}))
+    # A stale bookcase of the part and one without parts, e.g. written by requests meanwhile
+    asyncio.run(update_occupancy(occupancy_db, taken=[get_slot_location("rebuild_room", 2, 0)]))
+    asyncio.run(update_occupancy(occupancy_db, taken=[get_slot_location("rebuild_room", 1, 0)]))
+
+    asyncio.run(rebuild_occupancy(occupancy_db))
+    documents = asyncio.run(occupancy_db.occupancy.find({}, {"_id": 0}).to_list(None))
+    assert documents == [{"room": "rebuild_room", "bookcase": 2, "words": {"1": 0b10}}]
+
+
+# -------------------------- Counters -------------------------- #
+
+
+def test_reconcile_part_counters():
+    asyncio.run(test_db.categories.update_one({"name": "test_parts"}, {"$set": {"part_count": 100}}))
+    assert asyncio.run(reconcile_part_counters(test_db)) == ["test_parts"]
+    category = asyncio.run(test_db.categories.find_one({"name": "test_parts"}))
+    assert category["part_count"] == 3
+    assert category["total_quantity"] == 19
+    assert category["total_value"] > 0
+    assert asyncio.run(reconcile_part_counters(test_db)) == []
+
+
+# -------------------------- Reports -------------------------- #
+
+
+def get_parent_names() -> dict:
+    return {category["name"]: category["parent_name"] for category in client.get("/categories").json()}
+
+
+def test_valuation_report():
+    parts = client.get("/parts").json()
+    parent_names = get_parent_names()
+    response = client.get("/reports/valuation")
+    assert response.status_code == 200
+    report = response.json()
+    assert [category["name"] for category in report["categories"]] == sorted(parent_names)
+
+    for category in report["categories"]:
+        assert category["parent_name"] == parent_names[category["name"]]
+        own_parts = [part for part in parts if part["category"] == category["name"]]
+        assert category["part_count"] == len(own_parts)
+        assert category["total_value"] == round(sum(p["quantity"] * p["price"] for p in own_parts), 2)
+
+        subtree_parts = []
+        for part in parts:
+            name = part["category"]
+            while name != "" and name != category["name"]:
+                name = parent_names[name]
+            if name == category["name"]:
+                subtree_parts.append(part)
+        assert category["subtree"]["part_count"] == len(subtree_parts)
+        assert category["subtree"]["total_quantity"] == sum(p["quantity"] for p in subtree_parts)
+    assert report["total"]["part_count"] == len(parts)
+
+    # Stored until the data changes
+    response = client.get("/reports/valuation", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    part = client.get("/parts/example_serial_no").json()
+    client.put("/parts/example_serial_no", json=dict(part, quantity=part["quantity"] + 10))
+    response = client.get("/reports/valuation")
+    assert response.json()["total"]["total_quantity"] == report["total"]["total_quantity"] + 10
+    client.put("/parts/example_serial_no", json=part)
+    assert client.get("/reports/valuation").json() == report
+
+
+def test_low_stock_report():
+    parts = client.get("/parts").json()
+    threshold = sorted(part["quantity"] for part in parts)[len(parts) // 2]
+    low_parts = sorted(
+        (part for part in parts if part["quantity"] <= threshold),
+        key=lambda part: (part["quantity"], part["serial_number"]),
+    )
+    response = client.get("/reports/low-stock", params={"threshold": threshold})
+    assert response.status_code == 200
+    report = response.json()
+    assert report["threshold"] == threshold
+    assert report["part_count"] == len(low_parts)
+    assert [part["serial_number"] for part in report["parts"]] == [p["serial_number"] for p in low_parts]
+    assert report["parts"][0]["category"] == low_parts[0]["category"]
+
+    # Every category with low stock counts towards all of its ancestors
+    parent_names = get_parent_names()
+    categories = {category["name"]: category for category in report["categories"]}
+    for part in low_parts:
+        assert categories[part["category"]]["part_count"] > 0
+        name = parent_names[part["category"]]
+        while name != "":
+            assert categories[name]["subtree"]["part_count"] >= categories[part["category"]]["part_count"]
+            name = parent_names[name]
+
+    for threshold in (-1, 2**63):
+        response = client.get("/reports/low-stock", params={"threshold": threshold})
+        assert response.status_code == 422
+
+
+# -------------------------- Metrics -------------------------- #
+
+
+def test_server_timing_header():
+    response = client.get("/categories")
+    assert response.status_code == 200
+    assert response.headers["server-timing"].startswith("db;dur=")
+
+
+def test_metrics_by_route():
+    client.get("/parts/example_serial_no")
+    client.get("/parts/doesntexist")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    # Requests are labelled with the route, not the requested path
+    labels = '{method="GET",route="/parts/{serial_number}",status="404"}'
+    assert f"http_request_duration_seconds_count{labels}" in response.text
+    assert f"http_request_db_commands_count{labels}" in response.text
+    assert "doesntexist" not in response.text
+
+
+def test_command_shape():
+    command = {
+        "find": "categories",
+        "filter": {"_id": {"$in": [ObjectId(), ObjectId()]}},
+        "lsid": {"id": "session"},
+    }
+    assert get_command_shape("find", command) == "find categories filter={'_id': {'$in': ['?']}}"
+
+
+# -------------------------- Serialization -------------------------- #
+
+
+def test_fast_encoding_matches_standard():
+    content = {
+        "text": "\x00\x1f\x7f\u2028 é \"quoted\" \\ \n\t",
+        "floats": [0.0, -0.0, 1e-4, 2.5, 1 / 3, 9999999999999998.0, 1e-05, 1e16, 1.5e300],
+        "ints": [0, -1, 2 ** 63 - 1, 2 ** 70],
+        "nested": {"none": None, "bool": True, "tuple": (1, "a")},
+    }
+    assert serialization.encode_json(content) == serialization.encode_json_standard(content)
+
+    for price in [2.5, 1e-05, 1e16]:
+        part = dict(fixture_part_1, price=price)
+        assert serialization.encode_part(part) == serialization.encode_json_standard(part)
+        assert serialization.encode_parts([part, part]) == serialization.encode_json_standard([part, part])
+
+
+def test_part_listings_match_standard_encoding():
+    for params in [{}, {"limit": 2}]:
+        response = client.get("/parts", params=params)
+        assert response.content == serialization.encode_json_standard(response.json())
+    response = client.get("/parts/example_serial_no")
+    assert response.content == serialization.encode_json_standard(response.json())
+
+
+# -------------------------- Inventory mirror -------------------------- #
+
+
+def test_mirror_applies_change_events():
+    mirror = InventoryMirror()
+    category_id = ObjectId()
+    part = dict(fixture_part_1, _id=ObjectId(), category=category_id)
+    events = [
+        {"operationType": "insert", "ns": {"coll": "categories"},
+         "fullDocument": {"_id": category_id, "name": "events", "parent_id": None}},
+        {"operationType": "insert", "ns": {"coll": "parts"}, "fullDocument": part},
+        {"operationType": "insert", "ns": {"coll": "versions"}, "documentKey": {"_id": "parts"},
+         "fullDocument": {"_id": "parts", "epoch": "e", "version": 1}},
+        # The looked up document may count later changes, the update description doesn't
+        {"operationType": "update", "ns": {"coll": "versions"}, "documentKey": {"_id": "parts"},
+         "updateDescription": {"updatedFields": {"version": 2}},
+         "fullDocument": {"_id": "parts", "epoch": "e", "version": 5}},
+    ]
+    for event in events:
+        asyncio.run(mirror.apply_change(test_db, event))
+    assert mirror.versions["parts"] == ("e", 2)
+    assert mirror.get_part(part["serial_number"])["category"] == "events"
+    assert mirror.category_has_parts(category_id)
+
+    moved = dict(part, serial_number="moved", location=dict(part["location"], row=8))
+    asyncio.run(mirror.apply_change(test_db, {
+        "operationType": "replace", "ns": {"coll": "parts"}, "fullDocument": moved
+    }))
+    assert mirror.get_part(part["serial_number"]) is None
+    assert [found["serial_number"] for found in mirror.find_parts()] == ["moved"]
+    asyncio.run(mirror.apply_change(test_db, {
+        "operationType": "delete", "ns": {"coll": "parts"}, "documentKey": {"_id": part["_id"]}
+    }))
+    assert mirror.find_parts() == []
+    assert not mirror.category_has_parts(category_id)
+
+
+def test_mirror_polls_only_when_allowed():
+    mirror = InventoryMirror()
+    # mongomock has no change streams
+    asyncio.run(asyncio.wait_for(mirror.run(test_db, poll_seconds=0), timeout=1))
+    assert not mirror.loaded
+
+
+# -------------------------- Benchmark -------------------------- #
+
+
+def test_benchmark_smoke():
+    report = asyncio.run(run_benchmark(parts=20, requests=2, concurrency=2))
+    assert report["parameters"]["parts"] == 20
+    for name, result in report["scenarios"].items():
+        assert result["errors"] == 0, name
+        assert result["latency_ms"]["p50"] <= result["latency_ms"]["p99"]
+    # The version lookup for the ETag and the part itself
+    assert report["scenarios"]["read_part"]["round_trips"]["max"] == 2
+    assert report["scenarios"]["read_parts_batch"]["round_trips"]["max"] == 1
+    # The app uses the test database again afterwards
+    assert client.get("/parts/example_serial_no").status_code == 200
+
+
+# -------------------------- Concurrency limits -------------------------- #
+
+
+def test_concurrency_limit_queue():
+    async def acquire_all():
+        limit = ConcurrencyLimit(1, queue_seconds=0.05)
+        assert await limit.acquire()
+        # Two requests fit in the queue and time out there, the third is rejected right away
+        results = await asyncio.gather(limit.acquire(), limit.acquire(), limit.acquire())
+        assert results == [False, False, False]
+        assert limit.get_status() == {"limit": 1, "active": 1, "waiting": 0, "rejected": 3}
+
+        waiting = asyncio.ensure_future(limit.acquire())
+        await asyncio.sleep(0)
+        limit.release()
+        assert await waiting
+        assert limit.get_status()["active"] == 1
+
+    asyncio.run(acquire_all())
+
+
+def test_concurrency_limits_by_route_class(monkeypatch):
+    limit = ConcurrencyLimit(1, queue_seconds=0.01)
+    monkeypatch.setitem(main.concurrency_limits, "listings", limit)
+    asyncio.run(limit.acquire())  # a slow listing is running
+
+    response = client.get("/categories")
+    assert response.json() == {"detail": "server is busy, try again later"}
+    assert response.headers["retry-after"] == "1"
+    assert response.status_code == 503
+    # Other classes aren't held up
+    assert client.get("/parts/example_serial_no").status_code == 200
+    assert client.get("/health/live").status_code == 200
+    assert client.get("/health/ready").json()["concurrency"]["listings"]["rejected"] == 1
+
+    limit.release()
+    assert client.get("/categories").status_code == 200
+
+
+# -------------------------- Health and connection -------------------------- #
+
+
+def test_liveness():
+    response = client.get("/health/live")
+    assert response.json() == {"status": "alive"}
+    assert response.status_code == 200
+
+
+def test_readiness_waits_for_maintenance():
+    main.maintenance_status = "not started"
+    response = client.get("/health/ready")
+    assert response.json()["status"] == "not ready"
+    assert response.status_code == 503
+
+    asyncio.run(main.run_startup_maintenance(test_db))
+    response = client.get("/health/ready")
+    assert response.json()["status"] == "ready"
+    assert response.json()["maintenance"] == "done"
+    assert "ping_ms" in response.json()["database"]
+    assert response.json()["pool"]["max_size"] == connection.get_motor_threads()
+    assert response.status_code == 200
+
+
+def test_connection_settings(monkeypatch):
+    monkeypatch.setenv("MONGO_URI", "mongodb://localhost:27017")
+    monkeypatch.setenv("MONGO_DB", "inventory")
+    monkeypatch.setenv("MONGO_MAX_POOL_SIZE", "8")
+    monkeypatch.setenv("MONGO_COMPRESSORS", "zstd,snappy")
+    monkeypatch.setenv("MONGO_READ_CONCERN", "majority")
+    assert connection.get_connection_info() == ("mongodb://localhost:27017", "inventory")
+    options = connection.get_client_options()
+    assert options["maxPoolSize"] == 8
+    assert options["compressors"] == "zstd,snappy"
+    assert options["readConcernLevel"] == "majority"
+
+    monkeypatch.setenv("MONGO_CONNECT_TIMEOUT_MS", "soon")
+    with pytest.raises(connection.ConnectionSettingsError):
+        connection.get_client_options()
+
+
+def test_lifespan_starts_without_connecting(monkeypatch):
+    monkeypatch.setenv("MONGO_URI", "mongodb://localhost:1/?serverSelectionTimeoutMS=100")
+    monkeypatch.setenv("MONGO_DB", "lifespan_test")
+    monkeypatch.setenv("STARTUP_MAINTENANCE", "false")
+    monkeypatch.setattr(main, "client", None)
+    monkeypatch.setattr(main, "_database", None)
+    monkeypatch.setattr(main, "maintenance_status", "not started")
+    with TestClient(app) as lifespan_client:
+        assert main.client is not None
+        assert main.maintenance_status == "skipped"
+        assert lifespan_client.get("/health/live").status_code == 200
@@ -0,0 +1,37 @@
+import asyncio
+from mongomock_motor import AsyncMongoMockClient
+from pymongo import IndexModel, ASCENDING, TEXT
+
+from ..data.indexes import INDEXES, ensure_indexes, get_index_drift
+
+
+def test_indexes_created():
+    test_db = AsyncMongoMockClient()["test_db"]
+    missing_drift = asyncio.run(get_index_drift(test_db))
+    assert missing_drift["parts"]["missing"] == [model.document["name"] for model in INDEXES["parts"]]
+
+    assert asyncio.run(ensure_indexes(test_db)) == {}
+    assert asyncio.run(get_index_drift(test_db)) == {}
+
+
+def test_indexes_drift_repaired():
+    test_db = AsyncMongoMockClient()["test_db"]
+    asyncio.run(test_db.parts.create_indexes([
+        IndexModel([("serial_number", ASCENDING)], name="serial_number_unique"),  # not unique
+        IndexModel([("name", ASCENDING)], name="undeclared"),
+    ]))
+    drift = asyncio.run(get_index_drift(test_db))
+    assert drift["parts"]["changed"] == ["serial_number_unique"]
+    assert drift["parts"]["undeclared"] == ["undeclared"]
+
+    # Undeclared indexes are kept unless explicitly requested
+    drift = asyncio.run(ensure_indexes(test_db))
+    assert drift == {"parts": {"missing": [], "changed": [], "undeclared": ["undeclared"]}}
+    assert asyncio.run(ensure_indexes(test_db, drop_undeclared=True)) == {}
+
+
+def test_indexes_retired_dropped():
+    test_db = AsyncMongoMockClient()["test_db"]
+    asyncio.run(test_db.categories.create_indexes([IndexModel([("$**", TEXT)], name="$**_text")]))
+    assert asyncio.run(get_index_drift(test_db))["categories"]["undeclared"] == ["$**_text"]
+    assert asyncio.run(ensure_indexes(test_db)) == {}
@@ -1,25 +1,54 @@
+import asyncio
+import pytest
+import base64
+import json
+from collections import Counter
+from bson.objectid import ObjectId
 from fastapi.testclient import TestClient
-import mongomock
+from mongomock_motor import AsyncMongoMockClient
 
+from .. import main
 from ..main import app, get_db
+from ..data.models import Location
+from ..data.adjustments import AdjustmentCoalescer
+from ..data.indexes import ensure_indexes
+from ..data.versions import bump_versions, get_versions
+from ..data.occupancy import update_occupancy
+from ..data.counters import get_empty_counters
+from ..data.tree import ANCESTORS_FIELD
 from .example_data import fixture_part_1, fixture_part_2, fixture_part_3, fixture_part_4
 from .example_data import fixture_deep_copy, add_test_data
 
 client = TestClient(app)
 
-test_client = mongomock.MongoClient()
+test_client = AsyncMongoMockClient()
 test_db = test_client["test_db"]
-add_test_data(test_db)
+asyncio.run(ensure_indexes(test_db))
+asyncio.run(add_test_data(test_db))
 
 
-def override_db():
+async def override_db():
     try:
         yield test_db
     finally:
         pass
 
 
-app.dependency_overrides[get_db] = override_db
+@pytest.fixture(autouse=True, scope="module")
+def use_test_db():
+    # The override and the app's caches are global, so they're set for this module's tests only
+    previous_override = app.dependency_overrides.get(get_db)
+    app.dependency_overrides[get_db] = override_db
+    main.category_cache.clear()
+    main.occupancy_index.clear()
+    yield
+    if previous_override is None:
+        app.dependency_overrides.pop(get_db, None)
+    else:
+        app.dependency_overrides[get_db] = previous_override
+    main.category_cache.clear()
+    main.occupancy_index.clear()
+    main.inventory_mirror.clear()
 
 
 # -------------------------- Add / POST -------------------------- #
@@ -63,6 +92,68 @@ def test_part_add_correct():
     assert response.status_code == 200
 
 
+def make_bulk_part(serial_number: str, row: int) -> dict:
+    part = fixture_deep_copy(fixture_part_1)
+    part["serial_number"] = serial_number
+    part["description"] = "bulk"
+    part["location"]["room"] = "bulk_room"
+    part["location"]["row"] = row
+    return part
+
+
+def test_part_add_bulk():
+    taken_location = make_bulk_part("bulk3", 1)
+    taken_location["location"] = fixture_part_1["location"].copy()
+    base_category = make_bulk_part("bulk5", 5)
+    base_category["category"] = "base_parts"
+    parts = [
+        make_bulk_part("bulk1", 1),
+        make_bulk_part("example_serial_no", 2),
+        taken_location,
+        make_bulk_part("bulk1", 4),  # repeated within the request
+        base_category,
+        {"serial_number": "bulk6"},
+        make_bulk_part("bulk7", 7),
+    ]
+    response = client.post("/parts/bulk", json=parts)
+    assert response.status_code == 200
+    assert response.json()["inserted"] == 2
+    assert response.json()["failed"] == 5
+    results = response.json()["results"]
+    assert [result["index"] for result in results] == list(range(7))
+    assert [result["status_code"] for result in results] == [200, 409, 400, 409, 400, 422, 200]
+    assert results[1]["detail"] == "serial example_serial_no already exists"
+    err_str = "another part (serial: example_serial_no) is already at location: "
+    err_str += "room='basement1' bookcase=1 shelf=1 cuvette=1 column=1 row=1"
+    assert results[2]["detail"] == err_str
+    assert results[4]["detail"] == "part can't be assigned to a base category (base_parts)"
+
+    response = client.get("/parts/bulk7")
+    assert response.json() == parts[6]
+
+
+def test_part_add_bulk_ndjson():
+    lines = [json.dumps(make_bulk_part("bulk8", 8)), "{not json", json.dumps(make_bulk_part("bulk1", 8))]
+    response = client.post(
+        "/parts/bulk",
+        content="\n".join(lines),
+        headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["status_code"] for result in results] == [200, 400, 409]
+    assert results[2]["detail"] == "serial bulk1 already exists"
+
+    # Clean up to not mess with other tests
+    for serial_number in ["bulk1", "bulk7", "bulk8"]:
+        assert client.delete(f"/parts/{serial_number}").status_code == 200
+
+
+def test_part_add_bulk_invalid():
+    response = client.post("/parts/bulk", json={"serial_number": "not a list"})
+    assert response.status_code == 400
+
+
 # -------------------------- Read / GET -------------------------- #
 
 def test_part_read_nonexistent():
@@ -84,6 +175,121 @@ def test_part_read_many():
     assert response.status_code == 200
 
 
+def test_part_write_after_category_removed_by_another_worker():
+    response = client.post("/categories", json={"name": "other_worker_parts", "parent_name": "base_parts"})
+    assert response.status_code == 200
+    assert client.get("/categories/other_worker_parts").status_code == 200  # cached now
+
+    # Another worker removes the category: its cache is cleared, but not the one of this worker
+    asyncio.run(test_db.categories.delete_one({"name": "other_worker_parts"}))
+    asyncio.run(bump_versions(test_db, "categories"))
+
+    part = fixture_deep_copy(fixture_part_1)
+    part.update(serial_number="other_worker_part", category="other_worker_parts")
+    part["location"]["room"] = "other_worker_room"
+    response = client.post("/parts", json=part)
+    assert response.json() == {"detail": "category {'name': 'other_worker_parts'} does not exist"}
+    assert response.status_code == 404
+
+
+def test_category_read_after_change_by_another_worker():
+    response = client.post("/categories", json={"name": "other_worker_child", "parent_name": "base_parts"})
+    assert response.status_code == 200
+    response = client.get("/categories/other_worker_child")  # cached now
+    etag = response.headers["ETag"]
+
+    # Another worker moves the category
+    parent = {
+        "_id": ObjectId(), "name": "other_worker_base", "parent_id": None,
+        ANCESTORS_FIELD: [], **get_empty_counters(),
+    }
+    asyncio.run(test_db.categories.insert_one(parent))
+    asyncio.run(test_db.categories.update_one(
+        {"name": "other_worker_child"},
+        {"$set": {"parent_id": parent["_id"], ANCESTORS_FIELD: [parent["_id"]]}},
+    ))
+    asyncio.run(bump_versions(test_db, "categories"))
+
+    response = client.get("/categories/other_worker_child", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json() == {"name": "other_worker_child", "parent_name": "other_worker_base"}
+    response = client.get(
+        "/categories/other_worker_child", headers={"If-None-Match": response.headers["ETag"]}
+    )
+    assert response.status_code == 304
+
+
+def test_part_read_after_category_rename():
+    # Category names are cached, so renaming a category has to be visible right away
+    response = client.get("/parts")
+    assert response.status_code == 200
+    rename = {"name": "renamed_parts", "parent_name": "base_parts"}
+    response = client.put("/categories/test_parts", json=rename)
+    assert response.status_code == 200
+
+    renamed_part = fixture_deep_copy(fixture_part_1)
+    renamed_part["category"] = "renamed_parts"
+    response = client.get("/parts/example_serial_no")
+    assert response.json() == renamed_part
+    response = client.get("/parts")
+    assert renamed_part in response.json()
+
+    # Revert the rename to not mess with other tests
+    rename = {"name": "test_parts", "parent_name": "base_parts"}
+    response = client.put("/categories/renamed_parts", json=rename)
+    assert response.status_code == 200
+    response = client.get("/parts/example_serial_no")
+    assert response.json() == fixture_part_1
+
+
+def test_part_read_pages():
+    all_serials = sorted(part["serial_number"] for part in client.get("/parts").json())
+
+    # Walk through all the pages using the cursor from the response headers
+    serials = []
+    response = client.get("/parts?limit=2")
+    while True:
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        serials += [part["serial_number"] for part in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        response = client.get(f"/parts?limit=2&after={response.headers['X-Next-Cursor']}")
+    assert serials == all_serials
+
+
+def encode_test_cursor(sort_values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode()).decode("ascii")
+
+
+INVALID_CURSORS = [
+    ({"sort": "price"}, [{"$gt": 0}, "zzzz"]),  # operators can't be injected into the filter
+    ({"sort": "price"}, [{"$foo": 1}, "x"]),
+    ({"sort": "price"}, ["cheap", "x"]),
+    ({"sort": "quantity"}, [True, "x"]),
+    ({}, [5]),
+    ({"q": "a"}, ["x", "y"]),
+]
+
+
+def test_part_read_invalid_cursor():
+    response = client.get("/parts?limit=2&after=%25%25%25")
+    assert response.status_code == 400
+    for params, sort_values in INVALID_CURSORS:
+        cursor = encode_test_cursor(sort_values)
+        response = client.get("/parts", params={**params, "limit": 2, "after": cursor})
+        assert response.json() == {"detail": f"invalid cursor: {cursor}"}
+        assert response.status_code == 400
+
+
+def test_part_read_ndjson():
+    response = client.get("/parts", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    parts = [json.loads(line) for line in response.text.splitlines()]
+    assert parts == client.get("/parts").json()
+
+
 def test_part_search_by_serial():
     # Search a serial
     response = client.get("/parts?q=q1w2e3")
@@ -129,6 +335,34 @@ def test_part_search_by_category():
     assert fixture_part_3 in response.json()
 
 
+def test_part_search_relevance():
+    # A match in the name counts more than a match in the description
+    response = client.get("/parts?q=brr")
+    assert response.status_code == 200
+    assert response.json().index(fixture_part_4) < response.json().index(fixture_part_2)
+
+
+def test_part_search_literal():
+    # The query is matched as a plain substring, not as a regular expression
+    response = client.get("/parts?q=.*")
+    assert response.status_code == 404
+    response = client.get("/parts?q=go brr")
+    assert response.json() == [fixture_part_2]
+
+
+def test_part_search_pages():
+    all_serials = [part["serial_number"] for part in client.get("/parts?q=parts").json()]
+    serials = []
+    response = client.get("/parts?q=parts&limit=1")
+    while True:
+        assert response.status_code == 200
+        serials += [part["serial_number"] for part in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        response = client.get(f"/parts?q=parts&limit=1&after={response.headers['X-Next-Cursor']}")
+    assert serials == all_serials
+
+
 # -------------------------- Update / PUT -------------------------- #
 
 
@@ -162,6 +396,35 @@ def test_part_update_with_taken_location():
     assert response.status_code == 400
 
 
+def test_part_update_with_taken_serial():
+    new_part_data = fixture_deep_copy(fixture_part_3)
+    new_part_data["serial_number"] = "example_serial_no"
+    response = client.put("/parts/abcde", json=new_part_data)
+    assert response.json() == {"detail": "serial example_serial_no already exists"}
+    assert response.status_code == 409
+
+
+def test_part_update_in_place():
+    # A part keeping its own serial number and location doesn't conflict with itself
+    new_part_data = fixture_deep_copy(fixture_part_3)
+    new_part_data["quantity"] = 100
+    response = client.put("/parts/abcde", json=new_part_data)
+    assert response.json() == new_part_data
+    assert response.status_code == 200
+    # Revert the change to not mess with other tests
+    response = client.put("/parts/abcde", json=fixture_part_3)
+    assert response.status_code == 200
+
+
+def test_part_update_nonexistent():
+    new_part_data = fixture_deep_copy(fixture_part_1)
+    new_part_data["serial_number"] = "doesntexist"
+    new_part_data["location"]["room"] = "nowhere_else"
+    response = client.put("/parts/doesntexist", json=new_part_data)
+    assert response.json() == {"detail": "part {'serial_number': 'doesntexist'} does not exist"}
+    assert response.status_code == 404
+
+
 def test_part_update_correct():
     new_part_data = fixture_deep_copy(fixture_part_1)
     new_part_data["location"]["row"] = 7
@@ -181,6 +444,91 @@ def test_part_update_correct():
     assert response.status_code == 200
 
 
+# -------------------------- Stock adjustments -------------------------- #
+
+
+def test_part_adjust():
+    quantity = client.get("/parts/abcde").json()["quantity"]
+    response = client.post("/parts/abcde/adjust", json={"delta": 3})
+    assert response.json() == {"serial_number": "abcde", "quantity": quantity + 3}
+    assert response.status_code == 200
+    response = client.post("/parts/abcde/adjust", json={"delta": -quantity - 3})
+    assert response.json() == {"serial_number": "abcde", "quantity": 0}
+
+    # The quantity never goes below zero
+    response = client.post("/parts/abcde/adjust", json={"delta": -1})
+    assert response.json() == {
+        "detail": "part {'serial_number': 'abcde'} doesn't have enough stock for an adjustment of -1"
+    }
+    assert response.status_code == 409
+    client.post("/parts/abcde/adjust", json={"delta": quantity})
+    assert client.get("/parts/abcde").json()["quantity"] == quantity
+
+
+def test_part_adjust_nonexistent():
+    response = client.post("/parts/doesntexist/adjust", json={"delta": 1})
+    assert response.json() == {"detail": "part {'serial_number': 'doesntexist'} does not exist"}
+    assert response.status_code == 404
+
+
+def test_part_adjust_out_of_range():
+    for delta in (2**31, -2**31 - 1, 2**70):
+        response = client.post("/parts/abcde/adjust", json={"delta": delta})
+        assert response.status_code == 422
+
+
+def test_part_adjust_coalesced_large_deltas():
+    quantity = client.get("/parts/abcde").json()["quantity"]
+    coalescer = AdjustmentCoalescer(0.01, main.flush_adjustments)
+    largest = 2**31 - 1
+
+    async def adjust_all():
+        # Their sum is larger than any single delta, so they're applied one by one
+        return await asyncio.gather(
+            coalescer.submit(test_db, "abcde", largest), coalescer.submit(test_db, "abcde", largest)
+        )
+
+    results = asyncio.run(adjust_all())
+    assert sorted(result["quantity"] for result in results) == [quantity + largest, quantity + 2 * largest]
+    client.post("/parts/abcde/adjust", json={"delta": -largest})
+    client.post("/parts/abcde/adjust", json={"delta": -largest})
+    assert client.get("/parts/abcde").json()["quantity"] == quantity
+
+
+def test_part_adjust_coalesced():
+    quantities = {serial: client.get(f"/parts/{serial}").json()["quantity"] for serial in ("abcde", "cvbbnm")}
+    coalescer = AdjustmentCoalescer(0.01, main.flush_adjustments)
+    adjustments = [
+        ("abcde", -quantities["abcde"]),
+        ("cvbbnm", 2),
+        ("abcde", -1),  # runs out, the other adjustments of the part still apply
+        ("abcde", 2),
+        ("doesntexist", 1),
+        ("cvbbnm", 3),
+    ]
+
+    async def adjust_all():
+        return await asyncio.gather(
+            *[coalescer.submit(test_db, serial, delta) for serial, delta in adjustments],
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(adjust_all())
+    assert results[0] == {"serial_number": "abcde", "quantity": 0}
+    assert results[2].status_code == 409
+    assert results[3] == {"serial_number": "abcde", "quantity": 2}
+    assert results[4].status_code == 404
+    # Adjustments of one part applied at once report the quantity after all of them
+    expected = {"serial_number": "cvbbnm", "quantity": quantities["cvbbnm"] + 5}
+    assert results[1] == results[5] == expected
+    assert client.get("/parts/cvbbnm").json()["quantity"] == quantities["cvbbnm"] + 5
+
+    client.post("/parts/abcde/adjust", json={"delta": quantities["abcde"] - 2})
+    client.post("/parts/cvbbnm/adjust", json={"delta": -5})
+    for serial, quantity in quantities.items():
+        assert client.get(f"/parts/{serial}").json()["quantity"] == quantity
+
+
 # -------------------------- Delete -------------------------- #
 
 
@@ -199,3 +547,310 @@ def test_part_delete():
     response = client.get("/parts/q1w2e3")
     assert response.status_code == 404
     assert response.json() == {"detail": "part {'serial_number': 'q1w2e3'} does not exist"}
+
+
+# -------------------------- Category counters -------------------------- #
+
+
+def test_part_writes_keep_category_counters():
+    # After all of the part writes above, recounting the parts finds nothing to repair
+    response = client.post("/reconcile")
+    assert response.json() == {"repaired": []}
+    assert response.status_code == 200
+
+
+# -------------------------- Field projection -------------------------- #
+
+
+def read_all_pages(params: dict, headers: dict = None) -> list:
+    pages = []
+    response = client.get("/parts", params=params, headers=headers)
+    pages.append((response.status_code, response.content))
+    while "X-Next-Cursor" in response.headers:
+        response = client.get(
+            "/parts", params={**params, "after": response.headers["X-Next-Cursor"]}, headers=headers
+        )
+        pages.append((response.status_code, response.content))
+    return pages
+
+
+def test_part_read_fields():
+    part = client.get("/parts/example_serial_no").json()
+    response = client.get("/parts/example_serial_no?fields=quantity,serial_number")
+    assert response.json() == {"serial_number": part["serial_number"], "quantity": part["quantity"]}
+    # The categories are only joined when their names are requested
+    assert "$lookup" not in str(main.part_read_pipeline({}, fields=("serial_number", "quantity")))
+    assert "$lookup" in str(main.part_read_pipeline({}, fields=("category",)))
+
+    response = client.get("/parts/example_serial_no?fields=name,secret")
+    assert response.status_code == 400
+
+
+def test_part_listing_fields():
+    fields = ("serial_number", "quantity")
+    for params in [{"limit": 2}, {"q": "a", "limit": 2}]:
+        full_pages = [json.loads(content) for _, content in read_all_pages(params)]
+        pages = [json.loads(content) for _, content in read_all_pages({**params, "fields": "quantity"})]
+        assert pages == [[{"quantity": part["quantity"]} for part in page] for page in full_pages]
+        pages = [
+            json.loads(content) for _, content in read_all_pages({**params, "fields": ",".join(fields)})
+        ]
+        assert pages == [
+            [{field: part[field] for field in fields} for part in page] for page in full_pages
+        ]
+
+    parts = client.get("/parts").json()
+    response = client.get("/parts?fields=category")
+    assert response.json() == [{"category": part["category"]} for part in parts]
+    assert response.headers["ETag"] != client.get("/parts").headers["ETag"]
+
+
+# -------------------------- Filters, sorting and facets -------------------------- #
+
+
+def read_page_parts(params: dict) -> list:
+    # All parts of all pages
+    return [part for _, content in read_all_pages(params) for part in json.loads(content)]
+
+
+def test_part_filters():
+    parts = sorted(client.get("/parts").json(), key=lambda part: part["serial_number"])
+    response = client.get("/parts", params={"price": "2..3", "quantity": "..4"})
+    assert sorted(response.json(), key=lambda part: part["serial_number"]) == [
+        part for part in parts if 2 <= part["price"] <= 3 and part["quantity"] <= 4
+    ]
+    response = client.get("/parts", params={"room": "basement1", "bookcase": "1..", "limit": 100})
+    assert response.json() == [
+        part for part in parts
+        if part["location"]["room"] == "basement1" and part["location"]["bookcase"] >= 1
+    ]
+    response = client.get("/parts", params={"price": "1000.."})
+    assert response.status_code == 404
+
+
+def test_part_sort():
+    parts = client.get("/parts").json()
+    expected = sorted(parts, key=lambda part: (part["price"], part["serial_number"]), reverse=True)
+    assert read_page_parts({"sort": "-price", "limit": 2}) == expected
+    expected = sorted(parts, key=lambda part: (part["quantity"], part["serial_number"]))
+    assert read_page_parts({"sort": "quantity", "limit": 3, "fields": "serial_number"}) == [
+        {"serial_number": part["serial_number"]} for part in expected
+    ]
+
+    # Search results in another order than relevance
+    found = {part["serial_number"] for part in client.get("/parts?q=a").json()}
+    assert read_page_parts({"q": "a", "sort": "quantity", "limit": 1}) == [
+        part for part in expected if part["serial_number"] in found
+    ]
+
+
+def test_part_facets():
+    parts = [part for part in client.get("/parts").json() if part["price"] <= 10]
+    response = client.get("/parts", params={"facets": "room,category", "price": "..10", "limit": 1})
+    assert response.status_code == 200
+    body = response.json()
+    assert len(body["parts"]) == 1
+    assert "X-Next-Cursor" in response.headers
+    for facet, get_value in [
+        ("room", lambda part: part["location"]["room"]),
+        ("category", lambda part: part["category"]),
+    ]:
+        counts = {bucket["value"]: bucket["count"] for bucket in body["facets"][facet]}
+        assert counts == dict(Counter(get_value(part) for part in parts))
+        bucket_counts = [bucket["count"] for bucket in body["facets"][facet]]
+        assert bucket_counts == sorted(counts.values(), reverse=True)
+
+
+def test_part_filters_invalid():
+    for params in [{"price": "cheap"}, {"quantity": ".."}, {"sort": "name"}, {"facets": "color"}]:
+        response = client.get("/parts", params=params)
+        assert response.status_code == 400, params
+
+
+# -------------------------- Batch reads -------------------------- #
+
+
+def test_part_read_batch():
+    first, second = client.get("/parts?limit=2").json()
+    serials = [second["serial_number"], "no_such_part", first["serial_number"], second["serial_number"]]
+    response = client.post("/parts/batch", json={"serial_numbers": serials})
+    assert response.status_code == 200
+    assert response.json() == {"parts": [second, first], "missing": ["no_such_part"]}
+
+    response = client.get("/parts", params={"serials": ",".join(serials)})
+    assert response.status_code == 200
+    assert response.json() == {"parts": [second, first], "missing": ["no_such_part"]}
+
+
+def test_part_read_batch_invalid():
+    response = client.post("/parts/batch", json={"serial_numbers": []})
+    assert response.status_code == 422
+    response = client.get("/parts", params={"serials": ","})
+    assert response.status_code == 400
+    response = client.get("/parts", params={"serials": "a", "limit": 1})
+    assert response.status_code == 400
+    # Filters, sorting and facets would be ignored
+    for params in [{"price": "100.."}, {"room": "basement1"}, {"sort": "-price"}, {"facets": "room"}]:
+        response = client.get("/parts", params={"serials": "example_serial_no", **params})
+        assert response.json() == {"detail": f"serials can't be combined with {next(iter(params))}"}
+        assert response.status_code == 400
+
+
+# -------------------------- Conditional requests -------------------------- #
+
+
+def test_part_read_not_modified():
+    response = client.get("/parts/example_serial_no")
+    etag = response.headers["ETag"]
+    response = client.get("/parts/example_serial_no", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    # The two representations of the list have different tags
+    json_etag = client.get("/parts?limit=1").headers["ETag"]
+    ndjson_etag = client.get("/parts", headers={"Accept": "application/x-ndjson"}).headers["ETag"]
+    assert json_etag != ndjson_etag
+    response = client.get("/parts?limit=1", headers={"If-None-Match": f'"x", {json_etag}'})
+    assert response.status_code == 304
+
+    part = fixture_deep_copy(fixture_part_1)
+    part["serial_number"] = "etag_part"
+    part["location"]["room"] = "etag_room"
+    response = client.post("/parts", json=part)
+    assert response.status_code == 200
+    response = client.get("/parts/example_serial_no", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    response = client.delete("/parts/etag_part")
+    assert response.status_code == 200
+
+
+# -------------------------- Free locations -------------------------- #
+
+
+def test_free_locations_follow_part_writes():
+    response = client.get("/locations/free?room=free_room")
+    first_slot = {"room": "free_room", "bookcase": 1, "shelf": 1, "cuvette": 1, "column": 1, "row": 1}
+    assert response.json() == [first_slot]
+
+    part = fixture_deep_copy(fixture_part_1)
+    part["serial_number"] = "free_slot_part"
+    part["location"] = dict(first_slot)
+    response = client.post("/parts", json=part)
+    assert response.status_code == 200
+    response = client.get("/locations/free?room=free_room&count=2")
+    assert response.json() == [dict(first_slot, row=2), dict(first_slot, row=3)]
+
+    response = client.delete("/parts/free_slot_part")
+    assert response.status_code == 200
+    response = client.get("/locations/free?room=free_room")
+    assert response.json() == [first_slot]
+
+
+def test_free_locations_follow_other_workers():
+    first_slot = {"room": "other_worker_room", "bookcase": 1, "shelf": 1, "cuvette": 1, "column": 1, "row": 1}
+    response = client.get("/locations/free?room=other_worker_room")
+    assert response.json() == [first_slot]
+    # Writes of this worker don't need a reload
+    part = fixture_deep_copy(fixture_part_1)
+    part.update(serial_number="own_worker_part", location=dict(first_slot, row=2))
+    assert client.post("/parts", json=part).status_code == 200
+    version = asyncio.run(get_versions(test_db, ("parts",)))["parts"]
+    assert main.occupancy_index.is_current(version)
+
+    # Another worker takes a slot
+    asyncio.run(update_occupancy(test_db, taken=[first_slot]))
+    asyncio.run(bump_versions(test_db, "parts"))
+    response = client.get("/locations/free?room=other_worker_room")
+    assert response.json() == [dict(first_slot, row=3)]
+
+    asyncio.run(update_occupancy(test_db, freed=[first_slot]))
+    asyncio.run(bump_versions(test_db, "parts"))
+    assert client.delete("/parts/own_worker_part").status_code == 200
+    response = client.get("/locations/free?room=other_worker_room")
+    assert response.json() == [first_slot]
+
+
+# -------------------------- Inventory mirror -------------------------- #
+
+
+def test_reads_from_mirror_match_database():
+    listings = [
+        {"limit": 2},
+        {"q": "a", "limit": 2},
+        {"q": "ex", "limit": 1},
+        {"q": "no_such_part"},
+        {"q": "a", "limit": 2, "fields": "quantity"},
+        {"limit": 3, "fields": "category,serial_number"},
+    ]
+    categories = client.get("/categories").content
+    part = client.get("/parts/example_serial_no")
+    pages = [read_all_pages(params) for params in listings]
+    ndjson_pages = read_all_pages({"limit": 3}, {"Accept": "application/x-ndjson"})
+    searched = client.get("/parts", params={"q": "a"}).content
+    batch = {"serial_numbers": ["0451", "no_such_part", "example_serial_no"]}
+    batch_parts = client.post("/parts/batch", json=batch).content
+
+    asyncio.run(main.inventory_mirror.sync(test_db))
+    try:
+        assert client.get("/categories").content == categories
+        response = client.get("/parts/example_serial_no")
+        assert response.content == part.content
+        assert response.headers["ETag"] == part.headers["ETag"]
+        assert [read_all_pages(params) for params in listings] == pages
+        assert read_all_pages({"limit": 3}, {"Accept": "application/x-ndjson"}) == ndjson_pages
+        # Unpaged reads are sorted by serial number instead of streamed in storage order
+        assert client.get("/parts", params={"q": "a"}).content == searched
+        assert client.get("/parts/no_such_part").status_code == 404
+        assert client.post("/parts/batch", json=batch).content == batch_parts
+    finally:
+        main.inventory_mirror.clear()
+
+
+def test_mirror_rejects_invalid_cursors():
+    asyncio.run(main.inventory_mirror.sync(test_db))
+    try:
+        assert main.get_mirror() is main.inventory_mirror
+        for params, sort_values in INVALID_CURSORS:
+            cursor = encode_test_cursor(sort_values)
+            response = client.get("/parts", params={**params, "limit": 2, "after": cursor})
+            assert response.status_code == 400
+    finally:
+        main.inventory_mirror.clear()
+
+
+def test_writes_are_read_back_from_mirror():
+    asyncio.run(main.inventory_mirror.sync(test_db))
+    try:
+        part = fixture_deep_copy(fixture_part_1)
+        part["serial_number"] = "mirror_part"
+        part["location"]["room"] = "mirror_room"
+        etag = client.get("/parts/example_serial_no").headers["ETag"]
+        response = client.post("/parts", json=part)
+        assert response.status_code == 200
+        # The write doesn't wait for the polling, reads go to the database until it catches up
+        assert main.get_mirror() is None
+        response = client.get("/parts/mirror_part")
+        assert response.json() == part
+        asyncio.run(main.inventory_mirror.sync(test_db))
+        assert main.get_mirror() is main.inventory_mirror
+        response = client.get("/parts/mirror_part")
+        assert response.json() == part
+        response = client.get("/parts/example_serial_no", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+
+        # Validations are answered by the mirror too
+        response = client.post("/parts", json=dict(part, serial_number="mirror_part2"))
+        assert response.json() == {
+            "detail": f"another part (serial: mirror_part) is already at location: {Location(**part['location'])}"
+        }
+        response = client.delete(f"/categories/{part['category']}")
+        assert response.status_code == 400
+
+        response = client.delete("/parts/mirror_part")
+        assert response.status_code == 200
+        assert client.get("/parts/mirror_part").status_code == 404
+        asyncio.run(main.inventory_mirror.sync(test_db))
+        assert client.get("/parts/mirror_part").status_code == 404
+    finally:
+        main.inventory_mirror.clear()